@@ -24,10 +24,12 @@ parser.add_argument('--hf_model_dir', required=True, help='Path to HF model dire
 parser.add_argument('--tokenizer', default='Salesforce/codegen-16B-multi', help='Name or path to the tokenizer')
 parser.add_argument('--rebase', default=None, help='Path to rebase the model store to (e.g. for Docker)')
 parser.add_argument('-n', '--num_gpu', help='Number of GPUs to use', type=int, default=1)
+parser.add_argument('--decoupled', action='store_true', help='Stream tokens back to the client as they are generated')
 args = parser.parse_args()
 
 # Vars we need to fill in:
 # name
+# tokenizer
 # tensor_para_size
 # max_seq_len
 # is_half
@@ -41,6 +43,7 @@ args = parser.parse_args()
 # name
 # rotary_embedding
 # checkpoint_path
+# decoupled
 
 # Global options
 if args.hf_model_dir.endswith('/'):
@@ -59,6 +62,8 @@ version = '1'
 params = {}
 params['tensor_para_size'] = args.num_gpu
 params['name'] = model_name
+# Tells the proxy which tokenizer to use for this model
+params['tokenizer'] = args.tokenizer
 params['max_seq_len'] = max_seq_len
 params['is_half'] = is_half
 params['head_num'] = config.n_head
@@ -81,6 +86,7 @@ else:
     rebased_weights_path = weights_path
 
 params['checkpoint_path'] = rebased_weights_path
+params['decoupled'] = 'true' if args.decoupled else 'false'
 triton_config = template.substitute(params)
 assert '${' not in triton_config
 
@@ -1,22 +1,58 @@
 import logging
 import os
+from typing import Optional
 
 import uvicorn
-from fastapi import FastAPI, Request, Response
+from fastapi import FastAPI, Header, Request, Response
 from fastapi.responses import JSONResponse
 from sse_starlette.sse import EventSourceResponse
 
 from config.log_config import uvicorn_logger
 from models import OpenAIinput
+from utils.admission import Overloaded
 from utils.codegen import CodeGenProxy
 from utils.errors import FauxPilotException
 
 logging.config.dictConfig(uvicorn_logger)
 
+
+def optional_env(name: str, type_=int):
+    value = os.environ.get(name)
+    return type_(value) if value else None
+
+
+request_deadline_ms = optional_env("REQUEST_DEADLINE_MS", float)
 codegen = CodeGenProxy(
     host=os.environ.get("TRITON_HOST", "triton"),
     port=os.environ.get("TRITON_PORT", 8001),
-    verbose=os.environ.get("TRITON_VERBOSITY", False)
+    verbose=os.environ.get("TRITON_VERBOSITY", False),
+    num_channels=int(os.environ.get("TRITON_CHANNELS", 4)),
+    client_timeout=optional_env("TRITON_CLIENT_TIMEOUT", float),
+    keepalive_time_ms=optional_env("TRITON_KEEPALIVE_TIME_MS"),
+    keepalive_timeout_ms=optional_env("TRITON_KEEPALIVE_TIMEOUT_MS"),
+    decoupled=os.environ.get("TRITON_DECOUPLED", "0").lower() in ["1", "true"],
+    cache_size=int(os.environ.get("COMPLETION_CACHE_SIZE", 1024)),
+    cache_ttl=float(os.environ.get("COMPLETION_CACHE_TTL", 300)),
+    typeahead_sessions=int(os.environ.get("TYPEAHEAD_SESSIONS", 1024)),
+    typeahead_ttl=float(os.environ.get("TYPEAHEAD_TTL", 60)),
+    prefix_tokenizer_entries=int(os.environ.get("PREFIX_TOKENIZER_ENTRIES", 64)),
+    verify_prefix_tokenizer=os.environ.get("PREFIX_TOKENIZER_VERIFY", "0").lower() in ["1", "true"],
+    batch_window=float(os.environ.get("BATCH_WINDOW_MS", 0)) / 1000,
+    max_batch_size=int(os.environ.get("BATCH_MAX_SIZE", 1024)),
+    endpoints=[e.strip() for e in os.environ.get("TRITON_ENDPOINTS", "").split(",") if e.strip()],
+    session_affinity=os.environ.get("TRITON_SESSION_AFFINITY", "0").lower() in ["1", "true"],
+    health_interval=float(os.environ.get("TRITON_HEALTH_INTERVAL", 5)),
+    retries=int(os.environ.get("TRITON_RETRIES", 2)),
+    deadline=request_deadline_ms / 1000 if request_deadline_ms else None,
+    hedge_percentile=float(os.environ.get("TRITON_HEDGE_PERCENTILE", 0)),
+    truncate_prompts=os.environ.get("PROMPT_TRUNCATE", "0").lower() in ["1", "true"],
+    max_prompt_tokens=optional_env("PROMPT_MAX_TOKENS"),
+    truncate_at_lines=os.environ.get("PROMPT_TRUNCATE_AT_LINES", "1").lower() in ["1", "true"],
+    max_concurrent_requests=int(os.environ.get("ADMISSION_MAX_CONCURRENT", 0)),
+    max_queued_requests=int(os.environ.get("ADMISSION_MAX_QUEUE", 256)),
+    max_queue_time=float(os.environ.get("ADMISSION_MAX_QUEUE_TIME_MS", 500)) / 1000,
+    tokenizer_path=os.environ.get("TOKENIZER_PATH", "/python-docker/cgtok/tokenizer.json"),
+    model_refresh_interval=float(os.environ.get("MODEL_REFRESH_INTERVAL", 60)),
 )
 
 app = FastAPI(
@@ -28,6 +64,16 @@ app = FastAPI(
 )
 
 
+@app.on_event("startup")
+async def discover_models():
+    await codegen.start()
+
+
+@app.on_event("shutdown")
+async def close_triton_clients():
+    await codegen.close()
+
+
 @app.exception_handler(FauxPilotException)
 async def fauxpilot_handler(request: Request, exc: FauxPilotException):
     return JSONResponse(
@@ -36,6 +82,15 @@ async def fauxpilot_handler(request: Request, exc: FauxPilotException):
     )
 
 
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(
+        status_code=429,
+        content=FauxPilotException(message=str(exc), error_type="server_overloaded").json(),
+        headers={"Retry-After": str(int(exc.retry_after))},
+    )
+
+
 # Used to support copilot.vim
 @app.get("/copilot_internal/v2/token")
 def get_copilot_token():
@@ -46,14 +101,38 @@ def get_copilot_token():
     )
 
 
+@app.get("/v1/models")
+async def list_models():
+    models = [{'id': name, 'object': 'model', 'owned_by': 'fauxpilot'} for name in codegen.models.names()]
+    return JSONResponse(status_code=200, content={'object': 'list', 'data': models})
+
+
+@app.get("/metrics")
+async def metrics():
+    # Rendered on the event loop, where the metrics are recorded
+    return Response(content=codegen.render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/v1/engines/codegen/completions")
 # Used to support copilot.vim
 @app.post("/v1/engines/copilot-codex/completions")
 @app.post("/v1/completions")
-async def completions(data: OpenAIinput):
+async def completions(request: Request, data: OpenAIinput, cache_control: Optional[str] = Header(default=None),
+                      x_share_samples: Optional[str] = Header(default=None),
+                      x_deadline_ms: Optional[float] = Header(default=None)):
     data = data.dict()
+    # `Cache-Control: no-cache` forces a fresh completion even for deterministic requests
+    use_cache = cache_control is None or "no-cache" not in cache_control
+    # `X-Share-Samples: 1` lets identical sampled requests that are in flight at the same time share one completion
+    share_samples = x_share_samples is not None and x_share_samples.lower() in ["1", "true"]
+    # `X-Deadline-Ms` is how long the client is willing to wait for the completion, overriding REQUEST_DEADLINE_MS
+    # Suggestions are remembered per editor; clients that don't identify their user are told apart by address
+    session = data.get("user") or (request.client.host if request.client else None)
     try:
-        content = codegen(data=data)
+        content = await codegen(
+            data=data, use_cache=use_cache, session=session, share_samples=share_samples,
+            is_disconnected=request.is_disconnected, timeout=x_deadline_ms / 1000 if x_deadline_ms else None,
+        )
     except codegen.TokensExceedsMaximum as E:
         raise FauxPilotException(
             message=str(E),
@@ -61,6 +140,13 @@ async def completions(data: OpenAIinput):
             param=None,
             code=None,
         )
+    except codegen.UnknownModel as E:
+        raise FauxPilotException(
+            message=str(E),
+            error_type="invalid_request_error",
+            param="model",
+            code=None,
+        )
 
     if data.get("stream") is not None:
         return EventSourceResponse(
@@ -2,7 +2,8 @@ from typing import Optional, Union
 
 from pydantic import BaseModel, constr
 
-ModelType = constr(regex="^(fastertransformer|py-model)$")
+# Any model Triton serves; which ones it does is only known at runtime
+ModelType = constr(regex=r"^[\w.\-/]+$")
 
 
 class OpenAIinput(BaseModel):
@@ -0,0 +1,149 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from typing import Dict, List, Optional
+
+
+class Overloaded(Exception):
+    """Raised instead of queueing a request that wouldn't be answered in time."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ('future', 'cancelled')
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.cancelled = False
+
+
+class AdmissionController:
+    """
+    Limits how many requests the proxy sends to Triton at once, and sheds the load it can't take.
+
+    Requests beyond `max_concurrent` wait in a queue, and are let through in the order of fair queueing: every user
+    gets an equal share of the model, measured in the tokens they ask for, however many requests they send. A user
+    sending many requests only delays their own.
+
+    Completions are only useful for as long as the user hasn't typed on, so a request that is expected to wait longer
+    than `max_queue_time`, or that does wait that long, fails right away with `Overloaded`. So does a request that finds
+    `max_queue` requests waiting already. The client can retry after the time the queue is expected to take to drain.
+    With `max_concurrent` at 0 every request is let through at once.
+    """
+
+    def __init__(self, max_concurrent: int = 0, max_queue: int = 256, max_queue_time: float = 0.5):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_queue_time = max_queue_time
+        self.active = 0
+        # (virtual start time, arrival order, waiter); the smallest start is let through first
+        self._queue: List[tuple] = []
+        self._queued = 0
+        self._order = itertools.count()
+        # Virtual time: the start of the request let through last. A user's next request starts after their previous
+        # one finishes, in tokens, or now, whichever is later.
+        self._virtual_time = 0.0
+        self._finish: Dict[Optional[str], float] = {}
+        # Moving average of how long a request holds its slot
+        self.service_time: Optional[float] = None
+        self.admitted = 0
+        self.shed = 0
+        self.timed_out = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_concurrent > 0
+
+    def expected_wait(self, ahead: int) -> float:
+        if self.service_time is None:
+            return 0.0
+        return (ahead + 1) * self.service_time / self.max_concurrent
+
+    def _overloaded(self, reason: str, ahead: int) -> Overloaded:
+        self.shed += 1
+        return Overloaded(reason, retry_after=max(1.0, math.ceil(self.expected_wait(ahead))))
+
+    def check(self):
+        """Raises `Overloaded` if a request arriving now would be shed."""
+        if not self.enabled or (self.active < self.max_concurrent and not self._queued):
+            return
+        if self._queued >= self.max_queue:
+            raise self._overloaded("Too many requests are waiting for the model", self._queued)
+        if self.expected_wait(self._queued) > self.max_queue_time:
+            raise self._overloaded("The model is too busy to answer in time", self._queued)
+
+    async def acquire(self, user: Optional[str], cost: float = 1.0) -> float:
+        """
+        Waits for a slot, which is then held until `release()` is called. Returns the seconds spent waiting.
+
+        `cost` is the work the request asks for, like the number of tokens to generate.
+        """
+        if not self.enabled:
+            return 0.0
+        if self.active < self.max_concurrent and not self._queued:
+            self._admit()
+            return 0.0
+        self.check()
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future())
+        virtual_start = max(self._virtual_time, self._finish.get(user, 0.0))
+        self._finish[user] = virtual_start + cost
+        heapq.heappush(self._queue, (virtual_start, next(self._order), waiter))
+        self._queued += 1
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.max_queue_time)
+        except asyncio.TimeoutError:
+            # Unless it was let through just in time
+            if not waiter.future.done():
+                waiter.cancelled = True
+                self._queued -= 1
+                self.timed_out += 1
+                raise self._overloaded("The request waited too long for the model", self._queued)
+        except asyncio.CancelledError:
+            if waiter.future.done():
+                self.release()
+            else:
+                waiter.cancelled = True
+                self._queued -= 1
+            raise
+        return time.monotonic() - start
+
+    def _admit(self):
+        self.active += 1
+        self.admitted += 1
+
+    def release(self, admitted_at: Optional[float] = None):
+        """Frees the slot of a request; `admitted_at` is the time.monotonic() it got the slot at, if it was used."""
+        if not self.enabled:
+            return
+        self.active -= 1
+        if admitted_at is not None:
+            sample = time.monotonic() - admitted_at
+            self.service_time = sample if self.service_time is None else 0.9 * self.service_time + 0.1 * sample
+        while self._queue and self.active < self.max_concurrent:
+            virtual_start, _, waiter = heapq.heappop(self._queue)
+            if waiter.cancelled:
+                continue
+            self._queued -= 1
+            self._virtual_time = virtual_start
+            self._admit()
+            waiter.future.set_result(None)
+        if not self._queue:
+            # Nobody is behind anymore, so nobody's share needs to be remembered
+            self._finish.clear()
+
+    def stats(self) -> dict:
+        return {
+            'active': self.active,
+            'queued': self._queued,
+            'admitted': self.admitted,
+            'shed': self.shed,
+            'timed_out': self.timed_out,
+            'service_seconds': self.service_time or 0.0,
+        }
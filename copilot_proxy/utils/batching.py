@@ -0,0 +1,194 @@
+import asyncio
+import dataclasses
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+import numpy as np
+
+# Tensors that hold one variable length list per row, and the values to pad each of their components with
+_PADDED_TENSORS = {
+    'input_ids': None,  # padded with the end id of the row
+    'bad_words_list': (0, -1),  # token ids, offsets
+    'stop_words_list': (0, -1),
+}
+
+
+class BatchSlice:
+    """The rows of a batched Triton result that belong to one of the requests in the batch."""
+
+    def __init__(self, result, start: int, stop: int):
+        self.result = result
+        self.start = start
+        self.stop = stop
+
+    def as_numpy(self, name: str) -> Optional[np.ndarray]:
+        data = self.result.as_numpy(name)
+        return None if data is None else data[self.start:self.stop]
+
+
+@dataclasses.dataclass
+class _Batch:
+    requests: List[Any] = dataclasses.field(default_factory=list)
+    futures: List[asyncio.Future] = dataclasses.field(default_factory=list)
+    rows: int = 0
+    max_rows: int = 0
+    timer: Optional[asyncio.TimerHandle] = None
+    task: Optional[asyncio.Task] = None
+
+
+def _rows(request) -> int:
+    """Returns the number of rows in the output of a request."""
+    if 'n' in request.tensors:
+        return int(request.tensors['n'].sum())
+    return request.tensors['input_ids'].shape[0]
+
+
+def _pad(tensor: np.ndarray, width: int, values) -> np.ndarray:
+    missing = width - tensor.shape[-1]
+    if missing == 0:
+        return tensor
+    if tensor.ndim == 2:
+        # One pad value per row
+        pad = np.repeat(np.asarray(values, dtype=tensor.dtype).reshape(-1, 1), missing, axis=1)
+    else:
+        # One pad value per component, e.g. ids and offsets of word lists
+        pad = np.empty(tensor.shape[:-1] + (missing,), dtype=tensor.dtype)
+        for i, value in enumerate(values):
+            pad[:, i] = value
+    return np.concatenate([tensor, pad], axis=-1)
+
+
+def merge_requests(requests: list):
+    """
+    Stacks the input tensors of requests into those of a single request.
+
+    Prompts and word lists are right-padded to the longest one; `input_lengths` keeps track of the actual lengths.
+    """
+    tensors = {}
+    for name in requests[0].tensors:
+        parts = [r.tensors[name] for r in requests]
+        if name in _PADDED_TENSORS:
+            width = max(p.shape[-1] for p in parts)
+            if name == 'input_ids':
+                parts = [_pad(p, width, r.tensors['end_id'][:, 0]) for p, r in zip(parts, requests)]
+            else:
+                parts = [_pad(p, width, _PADDED_TENSORS[name]) for p in parts]
+        tensors[name] = np.concatenate(parts, axis=0)
+    changes = {'tensors': tensors}
+    # The batch is answered at once, so it has to be by the time the first of its requests is needed
+    deadlines = [r.deadline for r in requests if getattr(r, 'deadline', None) is not None]
+    if deadlines:
+        changes['deadline'] = min(deadlines)
+    return dataclasses.replace(requests[0], **changes)
+
+
+class MicroBatcher:
+    """
+    Sends requests that arrive within a short window of each other to Triton as a single batch.
+
+    Models are much faster at generating a batch of sequences than the same sequences one after the other, but the
+    editor requests reaching the proxy each carry a single prompt. Only requests with the same `key` are batched, as
+    some parameters apply to the batch as a whole. Every request in a batch gets back its own rows of the result.
+
+    A request that is cancelled while it waits is left out of its batch; the batch itself is only cancelled once all
+    of its requests are. A batch holds at most `max_batch_size` rows, and at most as many as `model_batch_size` returns
+    for its requests, if that is given and positive, so that batches fit the model they are sent to.
+    """
+
+    def __init__(self, infer: Callable[[Any], Awaitable[Any]], key: Callable[[Any], Hashable], window: float = 0.0,
+                 max_batch_size: int = 1024, model_batch_size: Optional[Callable[[Any], int]] = None):
+        self.infer = infer
+        self.key = key
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.model_batch_size = model_batch_size
+        self._pending: Dict[Hashable, _Batch] = {}
+        self.batches = 0
+        self.batched_requests = 0
+        self.batched_rows = 0
+        self.batch_capacity = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0 and self.max_batch_size > 1
+
+    def max_rows(self, request) -> int:
+        model_batch_size = self.model_batch_size(request) if self.model_batch_size is not None else 0
+        return min(self.max_batch_size, model_batch_size) if model_batch_size > 0 else self.max_batch_size
+
+    async def submit(self, request):
+        rows = _rows(request)
+        max_rows = self.max_rows(request)
+        if not self.enabled or rows >= max_rows:
+            return await self.infer(request)
+
+        key = self.key(request)
+        batch = self._pending.get(key)
+        if batch is not None and batch.rows + rows > max_rows:
+            self._flush(key, batch)
+            batch = None
+        if batch is None:
+            batch = self._pending[key] = _Batch(max_rows=max_rows)
+            batch.timer = asyncio.get_running_loop().call_later(self.window, self._flush, key, batch)
+
+        future = asyncio.get_running_loop().create_future()
+        batch.requests.append(request)
+        batch.futures.append(future)
+        batch.rows += rows
+        if batch.rows >= max_rows:
+            self._flush(key, batch)
+
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if batch.task is not None and all(f.done() for f in batch.futures):
+                batch.task.cancel()
+            raise
+
+    def _flush(self, key: Hashable, batch: _Batch):
+        if self._pending.get(key) is batch:
+            del self._pending[key]
+        batch.timer.cancel()
+        # Leave out the requests that have been cancelled in the meantime
+        waiting = [(r, f) for r, f in zip(batch.requests, batch.futures) if not f.done()]
+        if not waiting:
+            return
+        batch.requests, batch.futures = [r for r, _ in waiting], [f for _, f in waiting]
+        batch.rows = sum(_rows(r) for r in batch.requests)
+        self.batches += 1
+        self.batched_requests += len(batch.requests)
+        self.batched_rows += batch.rows
+        self.batch_capacity += batch.max_rows
+        batch.task = asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: _Batch):
+        try:
+            if len(batch.requests) == 1:
+                result = await self.infer(batch.requests[0])
+            else:
+                result = await self.infer(merge_requests(batch.requests))
+        except asyncio.CancelledError:
+            for future in batch.futures:
+                future.cancel()
+            raise
+        except Exception as exc:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+
+        start = 0
+        for request, future in zip(batch.requests, batch.futures):
+            stop = start + _rows(request)
+            if not future.done():
+                future.set_result(result if len(batch.requests) == 1 else BatchSlice(result, start, stop))
+            start = stop
+
+    def stats(self) -> dict:
+        return {
+            'pending_batches': len(self._pending),
+            'batches': self.batches,
+            'batched_requests': self.batched_requests,
+            'requests_per_batch': self.batched_requests / self.batches if self.batches else 0.0,
+            'rows_per_batch': self.batched_rows / self.batches if self.batches else 0.0,
+            'occupancy': self.batched_rows / self.batch_capacity if self.batches else 0.0,
+        }
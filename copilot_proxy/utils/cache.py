@@ -0,0 +1,58 @@
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+
+
+class CompletionCache:
+    """
+    A bounded LRU cache for completions of deterministic requests.
+
+    Editors re-send the exact same request on cursor moves, re-focus or undo. When the model is asked to decode
+    greedily, the answer can't change, so it can be returned without asking Triton again. Entries expire after
+    `ttl` seconds so that a cache hit never outlives e.g. a model reload by much.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, Tuple[float, Tuple[dict, list]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: Hashable) -> Optional[Tuple[dict, list]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        stored_at, (completion, choices) = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        # The response builders fill in the id and choices of the completion, so hand out copies
+        completion = dict(completion, created=int(time.time()))
+        return completion, [dict(c) for c in choices]
+
+    def put(self, key: Hashable, completion: dict, choices: list):
+        self._entries[key] = (time.monotonic(), (dict(completion), [dict(c) for c in choices]))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
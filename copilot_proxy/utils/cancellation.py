@@ -0,0 +1,101 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+class RequestTracker:
+    """
+    Cancels requests whose answer nobody is going to read anymore.
+
+    That is the case when the client has disconnected, or when the same session sent a newer request: editors drop
+    the previous request whenever the user types another character. Cancelling the task waiting for Triton cancels
+    the gRPC call, which lets Triton stop working on it.
+
+    To report how much generation time this saves, the tracker keeps a moving average of the time it takes to
+    generate a token, and counts the time the cancelled requests would still have needed to finish.
+    """
+
+    def __init__(self, poll_interval: float = 0.05):
+        self.poll_interval = poll_interval
+        self._active: Dict[str, Callable[[], None]] = {}
+        self.superseded = 0
+        self.disconnected = 0
+        self.saved_seconds = 0.0
+        self.seconds_per_token: Optional[float] = None
+
+    def record_generation(self, tokens: int, seconds: float):
+        if tokens <= 0:
+            return
+        sample = seconds / tokens
+        if self.seconds_per_token is None:
+            self.seconds_per_token = sample
+        else:
+            self.seconds_per_token = 0.9 * self.seconds_per_token + 0.1 * sample
+
+    def record_cancellation(self, max_tokens: int, elapsed: float):
+        if self.seconds_per_token is not None:
+            self.saved_seconds += max(0.0, max_tokens * self.seconds_per_token - elapsed)
+
+    def supersede(self, session: Optional[str], cancel: Callable[[], None]) -> Callable[[], None]:
+        """
+        Cancels what `session` currently has in flight and registers `cancel` for the new request instead.
+
+        Returns a function to call once the new request is done.
+        """
+        if session is None:
+            return lambda: None
+        previous = self._active.get(session)
+        if previous is not None:
+            self.superseded += 1
+            previous()
+        self._active[session] = cancel
+
+        def done():
+            if self._active.get(session) is cancel:
+                del self._active[session]
+
+        return done
+
+    async def run(self, session: Optional[str], work: Awaitable[T], max_tokens: int,
+                  is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None) -> T:
+        """
+        Awaits `work`, unless it gets superseded by a newer request of the session or the client disconnects.
+
+        Raises RequestCancelled in both of these cases.
+        """
+        st = time.monotonic()
+        task = asyncio.ensure_future(work)
+        done = self.supersede(session, task.cancel)
+        try:
+            while True:
+                finished, _ = await asyncio.wait({task}, timeout=self.poll_interval)
+                if finished:
+                    break
+                if is_disconnected is not None and await is_disconnected():
+                    self.disconnected += 1
+                    task.cancel()
+                    break
+            return await task
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                # We are being cancelled ourselves rather than the work
+                task.cancel()
+                raise
+            self.record_cancellation(max_tokens, time.monotonic() - st)
+            raise RequestCancelled()
+        finally:
+            done()
+
+    def stats(self) -> dict:
+        return {
+            'in_flight_sessions': len(self._active),
+            'superseded': self.superseded,
+            'disconnected': self.disconnected,
+            'saved_generation_seconds': self.saved_seconds,
+        }
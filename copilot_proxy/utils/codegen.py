@@ -1,35 +1,151 @@
+import asyncio
 import json
 import random
 import string
 import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
 
 import numpy as np
 import tritonclient.grpc as client_util
-from tokenizers import Tokenizer
-from tritonclient.utils import np_to_triton_dtype, InferenceServerException
+from tritonclient.utils import InferenceServerException
+
+from utils.admission import AdmissionController, Overloaded
+from utils.batching import MicroBatcher
+from utils.cache import CompletionCache
+from utils.cancellation import RequestCancelled, RequestTracker
+from utils.metrics import TOKENS_PER_SECOND_BUCKETS, Metrics
+from utils.singleflight import SingleFlight
+from utils.streaming import CancellableStream, IncrementalDecoder, StopWordFilter
+from utils.tensors import TensorTemplates, make_input
+from utils.registry import ModelInfo, ModelRegistry
+from utils.triton_client import EndpointPool
+from utils.typeahead import Suggestion, TypeAheadSessions
 
 np.finfo(np.dtype("float32"))
 np.finfo(np.dtype("float64"))
 
 
-class CodeGenProxy:
-    def __init__(self, host: str = 'triton', port: int = 8001, verbose: bool = False):
-        self.tokenizer = Tokenizer.from_file('/python-docker/cgtok/tokenizer.json')
-        self.client = client_util.InferenceServerClient(url=f'{host}:{port}', verbose=verbose)
-        self.PAD_CHAR = 50256
+@dataclass
+class PreparedRequest:
+    """A completion request that has been tokenized and turned into Triton input tensors."""
+    model_name: str
+    prompt: str
+    prompt_len: int
+    input_len: np.ndarray
+    max_tokens: int
+    want_logprobs: bool
+    num_logprobs: int
+    stop_words: List[str]
+    tensors: Dict[str, np.ndarray]
+    model: Optional[ModelInfo] = None
+    # Requests of the same user go to the same Triton replica when session affinity is on
+    user: Optional[str] = None
+    # time.monotonic() after which nobody is waiting for the completion anymore
+    deadline: Optional[float] = None
+    # Number of tokens cut off the start of the prompt to fit the context budget
+    truncated_tokens: int = 0
+
 
-        # Max number of tokens the model can handle
-        self.MAX_MODEL_LEN = 2048
+class CodeGenProxy:
+    def __init__(self, host: str = 'triton', port: int = 8001, verbose: bool = False, num_channels: int = 1,
+                 client_timeout: Optional[float] = None, keepalive_time_ms: Optional[int] = None,
+                 keepalive_timeout_ms: Optional[int] = None, decoupled: bool = False, cache_size: int = 1024,
+                 cache_ttl: float = 300.0, typeahead_sessions: int = 1024, typeahead_ttl: float = 60.0,
+                 prefix_tokenizer_entries: int = 64, verify_prefix_tokenizer: bool = False, batch_window: float = 0.0,
+                 max_batch_size: int = 1024, endpoints: Optional[List[str]] = None, session_affinity: bool = False,
+                 health_interval: float = 5.0, retries: int = 2, deadline: Optional[float] = None,
+                 hedge_percentile: float = 0.0, truncate_prompts: bool = False, max_prompt_tokens: Optional[int] = None,
+                 truncate_at_lines: bool = True, max_concurrent_requests: int = 0, max_queued_requests: int = 256,
+                 max_queue_time: float = 0.5, tokenizer_path: str = '/python-docker/cgtok/tokenizer.json',
+                 model_refresh_interval: float = 60.0):
+        # The models Triton serves, with their tokenizers and context lengths
+        self.models = ModelRegistry(
+            tokenizer_path, prefix_tokenizer_entries=prefix_tokenizer_entries,
+            verify_prefix_tokenizer=verify_prefix_tokenizer,
+        )
+        # Seconds between looking for models added to or removed from Triton; 0 only looks once
+        self.model_refresh_interval = model_refresh_interval
+        # Triton replicas, as `host:port`; without a list, the single server at `host` and `port`
+        self.endpoints = EndpointPool(
+            endpoints or [f'{host}:{port}'], size=num_channels, verbose=verbose,
+            keepalive_time_ms=keepalive_time_ms, keepalive_timeout_ms=keepalive_timeout_ms,
+            affinity=session_affinity, health_interval=health_interval, retries=retries,
+            hedge_percentile=hedge_percentile,
+        )
+        # Seconds after which an inference request is abandoned; None waits forever
+        self.client_timeout = client_timeout
+        # Seconds after which a completion is no longer useful, unless the request sets its own deadline
+        self.deadline = deadline
+        # Decoupled models stream their output, which has to be requested through the streaming gRPC API
+        self.decoupled = decoupled
+        self.cache = CompletionCache(max_entries=cache_size, ttl=cache_ttl)
+        self.typeahead = TypeAheadSessions(max_sessions=typeahead_sessions, ttl=typeahead_ttl)
+        self.in_flight = SingleFlight()
+        self.requests = RequestTracker()
+        # Inputs shared between requests, like the constant ones and encoded stop words
+        self.templates = TensorTemplates()
+        # Bounds the requests in flight to Triton, queueing the rest fairly between users and shedding what can't wait
+        self.admission = AdmissionController(
+            max_concurrent=max_concurrent_requests, max_queue=max_queued_requests, max_queue_time=max_queue_time
+        )
+        self.batcher = MicroBatcher(self.infer, self.batch_key, window=batch_window, max_batch_size=max_batch_size,
+                                    model_batch_size=lambda request: request.model.max_batch_size)
+
+        self.metrics = Metrics()
+        self.stage_seconds = self.metrics.histogram(
+            "stage_seconds", "Time spent in each stage of answering a request", labels=("stage",)
+        )
+        self.prompt_tokens = self.metrics.counter("prompt_tokens_total", "Prompt tokens sent to the model")
+        self.completion_tokens = self.metrics.counter("completion_tokens_total", "Tokens generated by the model")
+        self.tokens_per_second = self.metrics.histogram(
+            "tokens_per_second", "Tokens generated per second for each sequence", TOKENS_PER_SECOND_BUCKETS
+        )
+        self.finish_reasons = self.metrics.counter(
+            "finish_reason_total", "Choices by the reason they ended", labels=("reason",)
+        )
+        self.truncated_prompts = self.metrics.counter(
+            "truncated_prompts_total", "Prompts whose start was cut off to fit the context budget"
+        )
+        self.truncated_tokens = self.metrics.counter(
+            "truncated_prompt_tokens_total", "Tokens cut off the start of prompts to fit the context budget"
+        )
+        self.triton_errors = self.metrics.counter(
+            "triton_errors_total", "Failed Triton requests by status code", labels=("status",)
+        )
+        self.active_requests = 0
+        for component, stats in [
+            ("cache", self.cache.stats), ("typeahead", self.typeahead.stats),
+            ("prompt_tokenizer", self.models.prompt_tokenizer_stats), ("singleflight", self.in_flight.stats),
+            ("requests", self.requests.stats), ("batcher", self.batcher.stats), ("triton", self.endpoints.stats),
+            ("admission", self.admission.stats), ("models", self.models.stats),
+        ]:
+            self.metrics.register_stats(component, stats)
+
+        # Whether to cut off the start of prompts that don't fit, rather than failing the request
+        self.truncate_prompts = truncate_prompts
+        # Prompts are truncated to this many tokens even if the model could take more, as long prompts are slow
+        self.max_prompt_tokens = max_prompt_tokens
+        # Whether to only cut prompts at the start of a line
+        self.truncate_at_lines = truncate_at_lines
 
     class TokensExceedsMaximum(Exception):
         pass
 
+    class UnknownModel(Exception):
+        pass
+
+    def model_info(self, name: str) -> ModelInfo:
+        try:
+            return self.models.get(name)
+        except KeyError:
+            raise self.UnknownModel(
+                f"The model '{name}' does not exist. The models served are: {', '.join(self.models.names())}"
+            ) from None
+
     @staticmethod
     def prepare_tensor(name: str, tensor_input):
-        t = client_util.InferInput(
-            name, tensor_input.shape, np_to_triton_dtype(tensor_input.dtype))
-        t.set_data_from_numpy(tensor_input)
-        return t
+        return make_input(name, tensor_input)
 
     @staticmethod
     def trim_with_stopwords(output: str, stopwords: list) -> str:
@@ -72,29 +188,66 @@ class CodeGenProxy:
 
         return np.array([flat_ids, offsets], dtype="int32").transpose((1, 0, 2))
 
-    def generate(self, data):
+    async def prepare_request(self, data) -> PreparedRequest:
+        # Tokenizing a long prompt takes a few ms, which is too long to block the event loop for
+        st = time.perf_counter()
+        model = self.model_info(data['model'])
+        input_ids = await asyncio.to_thread(model.prompt_tokenizer.encode, data['prompt'])
+        tokenized = time.perf_counter()
+        self.stage_seconds.observe(tokenized - st, "tokenize")
+        request = self.build_request(data, input_ids, model)
+        self.stage_seconds.observe(time.perf_counter() - tokenized, "build")
+        if request.truncated_tokens:
+            self.truncated_prompts.inc()
+            self.truncated_tokens.inc(amount=request.truncated_tokens)
+        return request
+
+    def truncate_prompt(self, input_ids: List[int], max_tokens: int, model: ModelInfo) -> Tuple[List[int], int]:
+        """
+        Cuts off the start of a prompt so that it fits the context budget, leaving the tokens closest to the cursor.
+
+        Returns the remaining tokens, and how many were cut off.
+        """
+        budget = model.max_seq_len - max_tokens
+        if self.max_prompt_tokens is not None:
+            budget = min(budget, self.max_prompt_tokens)
+        if not self.truncate_prompts or len(input_ids) <= budget or budget <= 0:
+            return input_ids, 0
+        drop = len(input_ids) - budget
+        if self.truncate_at_lines:
+            # Start at the first line that begins within the budget; a prompt without one is cut mid-line
+            line_ends = np.flatnonzero(model.vocabulary.ends_line(input_ids[drop - 1:-1]))
+            if len(line_ends):
+                drop += int(line_ends[0])
+        return input_ids[drop:], drop
+
+    def build_request(self, data, input_ids: List[int], model: Optional[ModelInfo] = None) -> PreparedRequest:
         prompt = data['prompt']
         n = data.get('n', 1)
         model_name = data["model"]
-        # ugly hack to set the data type correctly. Huggingface models want int32, but fastertransformer needs uint32
-        # i could've done the conversion from uint32 to int32 in the model but that'd be inefficient.
-        np_type = np.int32 if model_name.startswith("py-") else np.uint32
-
-        input_start_ids = np.expand_dims(self.tokenizer.encode(prompt).ids, 0)
-        input_start_ids = np.repeat(input_start_ids, n, axis=0).astype(np_type)
-        prompt_len = input_start_ids.shape[1]
-        input_len = prompt_len * np.ones([input_start_ids.shape[0], 1]).astype(np_type)
+        if model is None:
+            model = self.model_info(model_name)
         max_tokens = data.get('max_tokens', 16)
-        prompt_tokens: int = input_len[0][0]
+        input_ids, truncated_tokens = self.truncate_prompt(input_ids, max_tokens, model)
+        # Huggingface models want int32, but fastertransformer needs uint32
+        np_type = model.id_type
+
+        input_start_ids = np.asarray(input_ids, dtype=np_type).reshape(1, -1)
+        # The python backend samples n sequences from a single copy of the prompt, FasterTransformer needs n copies
+        samples_per_row = n if model.samples_on_server else 1
+        rows = n // samples_per_row
+        if rows > 1:
+            input_start_ids = np.repeat(input_start_ids, rows, axis=0)
+        prompt_len = input_start_ids.shape[1]
+        input_len = np.full((rows, 1), prompt_len, dtype=np_type)
+        prompt_tokens: int = prompt_len
         requested_tokens = max_tokens + prompt_tokens
-        if requested_tokens > self.MAX_MODEL_LEN:
-            print(1)
+        if requested_tokens > model.max_seq_len:
             raise self.TokensExceedsMaximum(
-                f"This model's maximum context length is {self.MAX_MODEL_LEN}, however you requested "
+                f"This model's maximum context length is {model.max_seq_len}, however you requested "
                 f"{requested_tokens} tokens ({prompt_tokens} in your prompt; {max_tokens} for the completion). "
                 f"Please reduce your prompt; or completion length."
             )
-        output_len = np.ones_like(input_len).astype(np_type) * max_tokens
         num_logprobs = data.get('logprobs', -1)
         if num_logprobs is None:
             num_logprobs = -1
@@ -109,91 +262,290 @@ class CodeGenProxy:
 
         top_p = data.get('top_p', 1.0)
         frequency_penalty = data.get('frequency_penalty', 1.0)
-        runtime_top_k = top_k * np.ones([input_start_ids.shape[0], 1]).astype(np_type)
-        runtime_top_p = top_p * np.ones([input_start_ids.shape[0], 1]).astype(np.float32)
-        beam_search_diversity_rate = 0.0 * np.ones([input_start_ids.shape[0], 1]).astype(np.float32)
-        random_seed = np.random.randint(0, 2 ** 31 - 1, (input_start_ids.shape[0], 1), dtype=np.int32)
-        temperature = temperature * np.ones([input_start_ids.shape[0], 1]).astype(np.float32)
-        len_penalty = 1.0 * np.ones([input_start_ids.shape[0], 1]).astype(np.float32)
-        repetition_penalty = frequency_penalty * np.ones([input_start_ids.shape[0], 1]).astype(np.float32)
-        is_return_log_probs = want_logprobs * np.ones([input_start_ids.shape[0], 1]).astype(np.bool_)
-        beam_width = (1 * np.ones([input_start_ids.shape[0], 1])).astype(np_type)
-        start_ids = self.PAD_CHAR * np.ones([input_start_ids.shape[0], 1]).astype(np_type)
-        end_ids = self.PAD_CHAR * np.ones([input_start_ids.shape[0], 1]).astype(np_type)
 
         stop_words = data.get('stop', [])
         if stop_words is None:
             stop_words = []
-        if stop_words:
-            stop_word_list = np.repeat(self.to_word_list_format([stop_words], self.tokenizer), input_start_ids.shape[0],
-                                       axis=0)
-        else:
-            stop_word_list = np.concatenate([np.zeros([input_start_ids.shape[0], 1, 1]).astype(
-                np.int32), (-1 * np.ones([input_start_ids.shape[0], 1, 1])).astype(np.int32)], axis=1)
+        elif isinstance(stop_words, str):
+            stop_words = [stop_words]
+
+        tensors = {
+            "input_ids": input_start_ids,
+            "input_lengths": input_len,
+            "request_output_len": np.full((rows, 1), max_tokens, dtype=np_type),
+            "runtime_top_k": np.full((rows, 1), top_k, dtype=np_type),
+            "runtime_top_p": np.full((rows, 1), top_p, dtype=np.float32),
+            "random_seed": np.random.randint(0, 2 ** 31 - 1, (rows, 1), dtype=np.int32),
+            "temperature": np.full((rows, 1), temperature, dtype=np.float32),
+            "repetition_penalty": np.full((rows, 1), frequency_penalty, dtype=np.float32),
+            "is_return_log_probs": np.full((rows, 1), want_logprobs, dtype=np.bool_),
+        }
+        tensors.update(self.templates.get(
+            ("constants", rows, np_type, model.end_id), lambda: self.constant_tensors(rows, np_type, model.end_id)
+        ))
+        tensors.update(self.templates.get(
+            ("stop_words", model.tokenizer_key, tuple(stop_words), rows),
+            lambda: {"stop_words_list": self.stop_word_list(stop_words, rows, model)}
+        ))
+        if model.samples_on_server:
+            tensors["n"] = np.full((rows, 1), samples_per_row, dtype=np_type)
+            # Unlike FasterTransformer, the python backend also returns the most likely alternatives to every token
+            tensors["top_k_logprobs"] = np.full((rows, 1), max(num_logprobs, 0), dtype=np_type)
+
+        return PreparedRequest(
+            model_name=model_name, prompt=prompt, prompt_len=prompt_len, input_len=input_len, max_tokens=max_tokens,
+            want_logprobs=want_logprobs, num_logprobs=num_logprobs, stop_words=stop_words, tensors=tensors,
+            model=model, user=data.get('user'), truncated_tokens=truncated_tokens,
+        )
 
+    @staticmethod
+    def constant_tensors(rows: int, np_type, end_id: int) -> Dict[str, np.ndarray]:
+        """Returns the inputs that are the same for every request with `rows` rows to a model."""
         # Not used
-        bad_words_list = np.concatenate([np.zeros([input_start_ids.shape[0], 1, 1]).astype(
-            np.int32), (-1 * np.ones([input_start_ids.shape[0], 1, 1])).astype(np.int32)], axis=1)
-
-        inputs = [
-            self.prepare_tensor("input_ids", input_start_ids),
-            self.prepare_tensor("input_lengths", input_len),
-            self.prepare_tensor("request_output_len", output_len),
-            self.prepare_tensor("runtime_top_k", runtime_top_k),
-            self.prepare_tensor("runtime_top_p", runtime_top_p),
-            self.prepare_tensor("beam_search_diversity_rate", beam_search_diversity_rate),
-            self.prepare_tensor("random_seed", random_seed),
-            self.prepare_tensor("temperature", temperature),
-            self.prepare_tensor("len_penalty", len_penalty),
-            self.prepare_tensor("repetition_penalty", repetition_penalty),
-            self.prepare_tensor("is_return_log_probs", is_return_log_probs),
-            self.prepare_tensor("beam_width", beam_width),
-            self.prepare_tensor("start_id", start_ids),
-            self.prepare_tensor("end_id", end_ids),
-            self.prepare_tensor("bad_words_list", bad_words_list),
-            self.prepare_tensor("stop_words_list", stop_word_list),
+        bad_words_list = np.concatenate([np.zeros([rows, 1, 1], dtype=np.int32),
+                                         -1 * np.ones([rows, 1, 1], dtype=np.int32)], axis=1)
+        return {
+            "beam_search_diversity_rate": np.zeros([rows, 1], dtype=np.float32),
+            "len_penalty": np.ones([rows, 1], dtype=np.float32),
+            "beam_width": np.ones([rows, 1], dtype=np_type),
+            "start_id": np.full((rows, 1), end_id, dtype=np_type),
+            "end_id": np.full((rows, 1), end_id, dtype=np_type),
+            "bad_words_list": bad_words_list,
+        }
+
+    def stop_word_list(self, stop_words: List[str], rows: int, model: ModelInfo) -> np.ndarray:
+        if stop_words:
+            return np.repeat(self.to_word_list_format([stop_words], model.tokenizer), rows, axis=0)
+        return np.concatenate([np.zeros([rows, 1, 1], dtype=np.int32),
+                               -1 * np.ones([rows, 1, 1], dtype=np.int32)], axis=1)
+
+    def infer_inputs(self, request: PreparedRequest) -> List[client_util.InferInput]:
+        return [self.templates.make_input(name, tensor) for name, tensor in request.tensors.items()]
+
+    @staticmethod
+    def batch_key(request: PreparedRequest) -> Hashable:
+        """Returns what has to be the same for requests to be sent to Triton together in one batch."""
+        if request.model.samples_on_server:
+            # The python backend ends every row after its own number of tokens
+            return request.model_name, request.want_logprobs
+        # FasterTransformer generates up to the longest requested output and returns log probs for all rows or none
+        return request.model_name, request.max_tokens, request.want_logprobs
+
+    async def infer(self, request: PreparedRequest):
+        return await self.endpoints.call(
+            lambda client: self.infer_with(client, request), request.model_name, session=request.user,
+            max_tokens=request.max_tokens,
+        )
+
+    async def infer_with(self, client, request: PreparedRequest):
+        if not self.decoupled:
+            return await client.infer(
+                request.model_name, self.infer_inputs(request), client_timeout=self.timeout_for(request)
+            )
+
+        # Decoupled models only answer on the streaming endpoint; the last response holds the whole completion
+        result = None
+        async for result, error in self.stream_infer(client, request):
+            if error is not None:
+                raise error
+        if result is None:
+            raise RuntimeError("No output data")
+        return result
+
+    def stream_infer(self, client, request: PreparedRequest):
+        async def inputs_iterator():
+            yield {'model_name': request.model_name, 'inputs': self.infer_inputs(request)}
+
+        return client.stream_infer(inputs_iterator(), stream_timeout=self.timeout_for(request))
+
+    def timeout_for(self, request: PreparedRequest) -> Optional[float]:
+        """Returns the timeout of the Triton call for a request, which has to end by the request's deadline."""
+        if request.deadline is None:
+            return self.client_timeout
+        remaining = request.deadline - time.monotonic()
+        if remaining <= 0:
+            raise InferenceServerException("Deadline exceeded before the request was sent to Triton",
+                                           status="StatusCode.DEADLINE_EXCEEDED")
+        return remaining if self.client_timeout is None else min(remaining, self.client_timeout)
+
+    @staticmethod
+    def request_key(data) -> Hashable:
+        """
+        Returns a key identifying everything that influences the output of a request.
+
+        The prompt text stands in for its token ids: tokenizing is deterministic, and skipping it keeps lookups cheap.
+        """
+        stop_words = data.get('stop') or []
+        if isinstance(stop_words, str):
+            stop_words = [stop_words]
+        return (
+            data['model'], data['prompt'], data.get('n', 1), data.get('max_tokens', 16), tuple(stop_words),
+            data.get('temperature', 0.2), data.get('top_p', 1.0), data.get('frequency_penalty', 1.0),
+            data.get('logprobs'),
+        )
+
+    @classmethod
+    def cache_key(cls, data) -> Optional[Hashable]:
+        """Returns the key of a request if its output is fully determined by it, None if the output is sampled."""
+        # Only greedy decoding (see prepare_request) always produces the same completion
+        if data.get('temperature', 0.2) != 0.0:
+            return None
+        return cls.request_key(data)
+
+    @staticmethod
+    def typeahead_params(data) -> Optional[Hashable]:
+        """
+        Returns everything except the prompt that has to match for a suggestion to be reused while it's typed out.
+        """
+        # We only keep the text of suggestions around, not their logprobs
+        if data.get('logprobs'):
+            return None
+        stop_words = data.get('stop') or []
+        if isinstance(stop_words, str):
+            stop_words = [stop_words]
+        return (
+            data['model'], data.get('n', 1), tuple(stop_words), data.get('temperature', 0.2), data.get('top_p', 1.0),
+            data.get('frequency_penalty', 1.0),
+        )
+
+    def lookup_typeahead(self, data, session: Optional[str]) -> Optional[Suggestion]:
+        params = self.typeahead_params(data)
+        if session is None or params is None or not self.typeahead.enabled:
+            return None
+        return self.typeahead.lookup(
+            session, data['prompt'], params, data.get('max_tokens', 16),
+            count_tokens=lambda text: len(self.model_info(data['model']).tokenizer.encode(text).ids),
+        )
+
+    def record_typeahead(self, data, session: Optional[str], completion: dict, choices: List[dict]):
+        params = self.typeahead_params(data)
+        if session is None or params is None or not self.typeahead.enabled:
+            return
+        self.typeahead.record(session, data['prompt'], params, choices, completion['usage'])
+
+    @staticmethod
+    def typeahead_completion(suggestion: Suggestion):
+        completion = {
+            'id': None,  # fill in
+            'model': 'codegen',
+            'object': 'text_completion',
+            'created': int(time.time()),
+            'choices': None,  # fill in
+            'usage': {
+                'completion_tokens': suggestion.completion_tokens,
+                'prompt_tokens': suggestion.prompt_tokens,
+                'total_tokens': suggestion.completion_tokens + suggestion.prompt_tokens,
+            }
+        }
+        choices = [
+            {'text': text, 'index': i, 'finish_reason': reason, 'logprobs': None}
+            for i, (text, reason) in enumerate(zip(suggestion.texts, suggestion.finish_reasons))
         ]
+        return completion, choices
+
+    async def generate(self, data, use_cache: bool = True, share_samples: bool = False,
+                       deadline: Optional[float] = None):
+        """
+        Returns the completion for a request, from the cache or from Triton.
+
+        Identical requests that arrive while one of them is being answered by Triton all get the answer of that
+        one. Deterministic requests are always coalesced; sampled ones only if every caller set `share_samples`,
+        as they would otherwise all get the same sample.
+        """
+        cache_key = self.cache_key(data) if use_cache and self.cache.enabled else None
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        if self.cache_key(data) is not None or share_samples:
+            completion, choices = await self.in_flight.do(
+                self.request_key(data), lambda: self.generate_uncached(data, deadline)
+            )
+            # The response builders fill in the completion, so every caller needs its own copy
+            completion, choices = dict(completion), [dict(c) for c in choices]
+        else:
+            completion, choices = await self.generate_uncached(data, deadline)
 
-        result = self.client.infer(model_name, inputs)
+        if cache_key is not None:
+            self.cache.put(cache_key, completion, choices)
+        return completion, choices
 
+    async def generate_uncached(self, data, deadline: Optional[float] = None):
+        request = await self.prepare_request(data)
+        request.deadline = deadline
+        # Fair shares are measured in the tokens requested
+        waited = await self.admission.acquire(request.user, request.max_tokens * data.get('n', 1))
+        self.stage_seconds.observe(waited, "queue")
+        st = time.monotonic()
+        try:
+            result = await self.batcher.submit(request)
+        finally:
+            self.admission.release(st)
+        elapsed = time.monotonic() - st
+        completion, choices = await asyncio.to_thread(self.decode_result, result, request)
+        self.stage_seconds.observe(time.monotonic() - st - elapsed, "decode")
+        self.record_completion(completion, choices, elapsed)
+        return completion, choices
+
+    def record_completion(self, completion: dict, choices: List[dict], elapsed: float):
+        self.stage_seconds.observe(elapsed, "infer")
+        usage = completion['usage']
+        self.prompt_tokens.inc(amount=usage['prompt_tokens'])
+        self.completion_tokens.inc(amount=usage['completion_tokens'])
+        # The sequences of a request are generated side by side, so use the tokens per sequence
+        tokens_per_sequence = usage['completion_tokens'] // max(1, len(choices))
+        self.requests.record_generation(tokens_per_sequence, elapsed)
+        if elapsed > 0:
+            self.tokens_per_second.observe(tokens_per_sequence / elapsed)
+        for choice in choices:
+            self.finish_reasons.inc(str(choice['finish_reason']))
+
+    def decode_result(self, result, request: PreparedRequest):
+        prompt = request.prompt
+        prompt_len = request.prompt_len
+        max_tokens = request.max_tokens
+        num_logprobs = request.num_logprobs
         output_data = result.as_numpy("output_ids")
         if output_data is None:
             raise RuntimeError("No output data")
 
         # All of these squeeze(1)s are to remove the beam width dimension.
         output_data = output_data.squeeze(1)
-        if want_logprobs:
+        if request.want_logprobs:
             lp_data = result.as_numpy("output_log_probs").squeeze(1)
             # clp_data = result.as_numpy("cum_log_probs").squeeze(1)
+            top_lp_data = result.as_numpy("top_logprobs")
+            top_id_data = result.as_numpy("top_logprob_ids")
+            if top_id_data is not None:
+                top_lp_data, top_id_data = top_lp_data.squeeze(1), top_id_data.squeeze(1)
         else:
             lp_data = [None] * output_data.shape[0]
         sequence_lengths = result.as_numpy("sequence_length").squeeze(1)
-        gen_len = sequence_lengths - input_len.squeeze(1)
+        gen_len = sequence_lengths - request.input_len.squeeze(1)
 
-        decoded = self.tokenizer.decode_batch([out[prompt_len:prompt_len + g] for g, out in zip(gen_len, output_data)])
-        trimmed = [self.trim_with_stopwords(d, stop_words) for d in decoded]
+        vocabulary = request.model.vocabulary
+        decoded = request.model.tokenizer.decode_batch(
+            [out[prompt_len:prompt_len + g] for g, out in zip(gen_len, output_data)]
+        )
+        trimmed = [self.trim_with_stopwords(d, request.stop_words) for d in decoded]
 
         choices = []
         for i, (text, tokens, lps, g) in enumerate(zip(trimmed, output_data, lp_data, gen_len)):
             reason = "length" if max_tokens == g else "stop"
             if lps is not None:
-                tokens_str = [self.tokenizer.decode([t]) for t in tokens[prompt_len:prompt_len + g]]
-                offsets = [len(prompt)] + (np.cumsum([len(t) for t in tokens_str]) + len(prompt)).tolist()[:-1]
-
-                # Fake some log probs for top_logprobs
-                top_logprobs = []
-                for ii, t in enumerate(tokens_str):
-                    fakedict = {}
-                    top_token_lp = float(lps[ii])
-                    fakedict[t] = top_token_lp
-                    while len(fakedict) < num_logprobs:
-                        random_token = random.randint(0, self.tokenizer.get_vocab_size() - 1)
-                        random_token_str = self.tokenizer.decode([random_token])
-                        if random_token_str in fakedict:
-                            continue
-                        random_token_lp = top_token_lp - random.random()
-                        fakedict[random_token_str] = random_token_lp
-                    top_logprobs.append(fakedict)
+                lps = lps[:g]
+                generated = tokens[prompt_len:prompt_len + g]
+                tokens_str = vocabulary.tokens(generated).tolist()
+                offsets = vocabulary.text_offsets(generated, start=len(prompt)).tolist()
+
+                if top_id_data is not None:
+                    top_strs = vocabulary.tokens(top_id_data[i, :g, :num_logprobs]).tolist()
+                    top_lps = top_lp_data[i, :g, :num_logprobs].tolist()
+                    top_logprobs = [dict(zip(strs, step_lps)) for strs, step_lps in zip(top_strs, top_lps)]
+                else:
+                    # FasterTransformer only returns the log prob of the chosen token
+                    top_logprobs = [{t: lp} for t, lp in zip(tokens_str, lps.tolist())]
 
                 lpdict = {
                     'token_logprobs': lps.tolist(),
@@ -224,6 +576,8 @@ class CodeGenProxy:
                 'total_tokens': int(gen_len.sum() + prompt_len),
             }
         }
+        if request.truncated_tokens:
+            completion['usage']['truncated_prompt_tokens'] = request.truncated_tokens
         return completion, choices
 
     @staticmethod
@@ -231,32 +585,211 @@ class CodeGenProxy:
         return 'cmpl-' + ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(29))
 
     def streamed_response(self, completion, choices):
+        st = time.perf_counter()
+        events = []
         for c in choices:
             completion['id'] = self.random_completion_id()
             completion['choices'] = [c]
-            yield f'{json.dumps(completion)}'
+            events.append(json.dumps(completion))
+        events.append('[DONE]')
+        self.stage_seconds.observe(time.perf_counter() - st, "serialize")
+        return iter(events)
+
+    async def incremental_response(self, request: PreparedRequest, session: Optional[str] = None,
+                                   on_complete: Optional[Callable[[dict, List[dict]], None]] = None):
+        """
+        Streams the completion to the client token by token, as Triton produces it.
+
+        Every event carries the new text of a single choice, like OpenAI's streaming API. Once all choices have hit a
+        stop word the Triton request is cancelled, so the model doesn't keep generating text nobody will read.
+        `on_complete` is called with the completion as a whole once it has been streamed entirely. A newer request
+        from the same `session`, the request's user, cancels the stream.
+        """
+        st = time.time()
+        completion = {
+            'id': self.random_completion_id(),
+            'model': 'codegen',
+            'object': 'text_completion',
+            'created': int(time.time()),
+            'choices': None,  # fill in
+        }
+
+        def event(index, text, finish_reason=None):
+            completion['choices'] = [{'text': text, 'index': index, 'finish_reason': finish_reason, 'logprobs': None}]
+            return json.dumps(completion)
+
+        decoders = []
+        stop_filters = []
+        reasons = []
+        gen_len = None
+        try:
+            self.stage_seconds.observe(await self.admission.acquire(request.user, request.max_tokens), "queue")
+        except Overloaded as exc:
+            # The queue was checked before the stream started, but may have filled up since
+            print(exc)
+            yield '[DONE]'
+            return
+        admitted_at = time.monotonic()
+        endpoint = None
+        responses = None
+        superseded = False
+        done = None
+
+        def cancel():
+            nonlocal superseded
+            superseded = True
+            if responses is not None:
+                responses.cancel()
+
+        try:
+            # Once tokens have been streamed to the client, the request can't move to another replica, so it isn't
+            # retried
+            endpoint = self.endpoints.acquire(request.user)
+            self.active_requests += 1
+            done = self.requests.supersede(session, cancel)
+            # Raises if the deadline has passed already
+            responses = CancellableStream(self.stream_infer(endpoint.clients.get(), request))
+            async for result, error in responses:
+                if error is not None:
+                    raise error
+                output_ids = result.as_numpy("output_ids").squeeze(1)
+                gen_len = result.as_numpy("sequence_length").squeeze(1) - request.prompt_len
+                if not decoders:
+                    decoders = [IncrementalDecoder(request.model.tokenizer) for _ in range(output_ids.shape[0])]
+                    stop_filters = [StopWordFilter(request.stop_words) for _ in range(output_ids.shape[0])]
+                    reasons = [None] * output_ids.shape[0]
+
+                for i, (decoder, stop_filter) in enumerate(zip(decoders, stop_filters)):
+                    if stop_filter.stopped:
+                        continue
+                    new_tokens = output_ids[i, request.prompt_len + len(decoder.tokens):request.prompt_len + gen_len[i]]
+                    text = stop_filter.push(await asyncio.to_thread(decoder.push, new_tokens.tolist()))
+                    if stop_filter.stopped:
+                        reasons[i] = "stop"
+                        yield event(i, text, reasons[i])
+                    elif text:
+                        yield event(i, text)
+
+                if all(f.stopped for f in stop_filters):
+                    break
+
+            for i, (decoder, stop_filter) in enumerate(zip(decoders, stop_filters)):
+                if stop_filter.stopped:
+                    continue
+                text = stop_filter.push(decoder.flush()) + stop_filter.flush()
+                reasons[i] = "length" if request.max_tokens == gen_len[i] and not stop_filter.stopped else "stop"
+                yield event(i, text, reasons[i])
+
+            if decoders:
+                choices = [
+                    {'text': f.text[:f.sent], 'index': i, 'finish_reason': reason, 'logprobs': None}
+                    for i, (f, reason) in enumerate(zip(stop_filters, reasons))
+                ]
+                usage = {
+                    'completion_tokens': int(gen_len.sum()),
+                    'prompt_tokens': int(request.prompt_len),
+                    'total_tokens': int(gen_len.sum() + request.prompt_len),
+                }
+                if request.truncated_tokens:
+                    usage['truncated_prompt_tokens'] = request.truncated_tokens
+                self.record_completion(dict(completion, usage=usage), choices, time.time() - st)
+                if on_complete is not None:
+                    on_complete(dict(completion, usage=usage), choices)
+        except InferenceServerException as exc:
+            self.triton_errors.inc(str(exc.status()))
+            print(exc)
+        except asyncio.CancelledError:
+            if not superseded:
+                raise
+            self.requests.record_cancellation(request.max_tokens, time.time() - st)
+            print("Stream superseded by a newer request")
+        finally:
+            # Also reached when the client goes away mid-stream
+            if responses is not None:
+                await responses.aclose()
+            if endpoint is not None:
+                self.endpoints.release(endpoint)
+                self.active_requests -= 1
+            if done is not None:
+                done()
+            self.admission.release(admitted_at)
+        ed = time.time()
+        print(f"Streamed completion in {(ed - st) * 1000} ms")
         yield '[DONE]'
 
     def non_streamed_response(self, completion, choices) -> str:
+        st = time.perf_counter()
         completion['id'] = self.random_completion_id()
         completion['choices'] = choices
-        return json.dumps(completion)
+        response = json.dumps(completion)
+        self.stage_seconds.observe(time.perf_counter() - st, "serialize")
+        return response
+
+    def render_metrics(self) -> str:
+        return self.metrics.render({'requests_in_flight': self.active_requests})
+
+    async def start(self):
+        """Starts discovering the models Triton serves, which needs the event loop to be running."""
+        self.models.start_refreshing(lambda: self.endpoints.choose().clients.get(), self.model_refresh_interval)
+
+    async def close(self):
+        self.models.stop_refreshing()
+        await self.endpoints.close()
 
-    def __call__(self, data: dict):
+    async def __call__(self, data: dict, use_cache: bool = True, session: Optional[str] = None,
+                       share_samples: bool = False, is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+                       timeout: Optional[float] = None):
         st = time.time()
+        timeout = timeout or self.deadline
+        deadline = time.monotonic() + timeout if timeout else None
+        suggestion = self.lookup_typeahead(data, session)
+        if suggestion is not None:
+            completion, choices = self.typeahead_completion(suggestion)
+            print(f"Returned rest of previous suggestion in {(time.time() - st) * 1000} ms")
+            if data.get('stream', False):
+                return self.streamed_response(completion, choices)
+            return self.non_streamed_response(completion, choices)
+
+        if self.decoupled and data.get('stream', False) and not data.get('logprobs'):
+            cache_key = self.cache_key(data) if use_cache and self.cache.enabled else None
+            cached = self.cache.get(cache_key) if cache_key is not None else None
+            if cached is not None:
+                print(f"Returned cached completion in {(time.time() - st) * 1000} ms")
+                return self.streamed_response(*cached)
+            # Validates the request up front, so the client still gets a proper error instead of a broken stream
+            request = await self.prepare_request(data)
+            request.deadline = deadline
+            self.admission.check()
+
+            def on_complete(completion, choices):
+                self.record_typeahead(data, session, completion, choices)
+
+            return self.incremental_response(request, session=data.get('user'), on_complete=on_complete)
+
+        self.active_requests += 1
         try:
-            completion, choices = self.generate(data)
+            # Only requests that say which user they come from supersede each other; many users can share an address
+            completion, choices = await self.requests.run(
+                data.get('user'), self.generate(data, use_cache, share_samples, deadline), data.get('max_tokens', 16),
+                is_disconnected,
+            )
+        except RequestCancelled:
+            print("Request cancelled: superseded by a newer request or client disconnected")
+            completion = {}
+            choices = []
         except InferenceServerException as exc:
+            self.triton_errors.inc(str(exc.status()))
             # status: unavailable -- this happens if the `model` string is invalid
             print(exc)
             if exc.status() == 'StatusCode.UNAVAILABLE':
-                print(
-                    f"WARNING: Model '{data['model']}' is not available. Please ensure that "
-                    "`model` is set to either 'fastertransformer' or 'py-model' depending on "
-                    "your installation"
-                )
+                print(f"WARNING: Model '{data['model']}' is not available. The models served are: "
+                      f"{', '.join(self.models.names()) or 'not known yet'}")
             completion = {}
             choices = []
+        else:
+            self.record_typeahead(data, session, completion, choices)
+        finally:
+            self.active_requests -= 1
         ed = time.time()
         print(f"Returned completion in {(ed - st) * 1000} ms")
         if data.get('stream', False):
@@ -0,0 +1,200 @@
+import asyncio
+import dataclasses
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import tritonclient.grpc.aio as aio_client_util
+from tokenizers import Tokenizer
+
+from utils.tokenization import IncrementalTokenizer
+from utils.vocabulary import Vocabulary
+
+# Used by models whose config doesn't say otherwise, like the ones written before these parameters were added
+DEFAULT_MAX_SEQ_LEN = 2048
+DEFAULT_END_ID = 50256
+# The max_batch_size of python_backend/config_template.pbtxt
+PYTHON_BACKEND_MAX_BATCH_SIZE = 4
+# All CodeGen models share the default tokenizer, so it doesn't need to be fetched from the Hub for them
+CODEGEN_TOKENIZERS = 'Salesforce/codegen-'
+
+_ID_TYPES = {'TYPE_INT32': np.int32, 'TYPE_UINT32': np.uint32}
+
+
+@dataclasses.dataclass
+class ModelInfo:
+    """What the proxy needs to know about a model served by Triton to prepare its requests and decode its output."""
+    name: str
+    tokenizer_key: str
+    tokenizer: Tokenizer
+    vocabulary: Vocabulary
+    prompt_tokenizer: Optional[IncrementalTokenizer]
+    max_seq_len: int = DEFAULT_MAX_SEQ_LEN
+    end_id: int = DEFAULT_END_ID
+    # Huggingface models want int32, but FasterTransformer needs uint32
+    id_type: type = np.uint32
+    # Whether the model samples `n` sequences from a single copy of the prompt and returns the most likely
+    # alternatives to every token, like the python backend
+    samples_on_server: bool = False
+    # Largest batch Triton accepts for the model; 0 if that isn't known
+    max_batch_size: int = 0
+
+
+def parse_config(config: dict) -> dict:
+    """Returns the settings of a model found in its Triton config, as written by `triton_config_gen.py` or
+    `init_model.py`."""
+    parameters = {key: value.get('string_value', '') for key, value in config.get('parameters', {}).items()}
+    inputs = {i['name']: i.get('data_type') for i in config.get('input', [])}
+    settings = {}
+    if parameters.get('tokenizer'):
+        settings['tokenizer_key'] = parameters['tokenizer']
+    elif parameters.get('org_name') and parameters.get('model_name'):
+        settings['tokenizer_key'] = f"{parameters['org_name']}/{parameters['model_name']}"
+    for name in ('max_seq_len', 'end_id'):
+        if parameters.get(name, '').isdigit():
+            settings[name] = int(parameters[name])
+    if inputs.get('input_ids') in _ID_TYPES:
+        settings['id_type'] = _ID_TYPES[inputs['input_ids']]
+    settings['samples_on_server'] = 'n' in inputs
+    if int(config.get('max_batch_size', 0)) > 0:
+        settings['max_batch_size'] = int(config['max_batch_size'])
+    return settings
+
+
+class ModelRegistry:
+    """
+    The models Triton serves, found in its repository index and the models' configs.
+
+    Each model comes with its context length, end id, token id type and tokenizer. Models sharing a tokenizer share
+    its vocabulary and prompt cache too. A tokenizer is named in the model config either by a path to its
+    `tokenizer.json`, or by a Huggingface Hub name. If it can't be loaded, the default one is used, which is the
+    tokenizer of all CodeGen models.
+
+    Until models have been discovered, any model is taken to exist and get the defaults; after that, asking for a
+    model that Triton doesn't serve raises `KeyError`.
+    """
+
+    def __init__(self, default_tokenizer_path: str, prefix_tokenizer_entries: int = 64,
+                 verify_prefix_tokenizer: bool = False):
+        self.default_tokenizer_path = default_tokenizer_path
+        self.prefix_tokenizer_entries = prefix_tokenizer_entries
+        self.verify_prefix_tokenizer = verify_prefix_tokenizer
+        # tokenizer key -> (tokenizer, vocabulary, prompt tokenizer)
+        self._tokenizers: Dict[str, tuple] = {}
+        self.default_tokenizer_key = 'default'
+        self._load_tokenizer(self.default_tokenizer_key)
+        self._models: Dict[str, ModelInfo] = {}
+        self.discovered = False
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def _load_tokenizer(self, key: str) -> tuple:
+        loaded = self._tokenizers.get(key)
+        if loaded is not None:
+            return loaded
+        if key == self.default_tokenizer_key:
+            tokenizer = Tokenizer.from_file(self.default_tokenizer_path)
+        elif key.startswith(CODEGEN_TOKENIZERS):
+            loaded = self._tokenizers[key] = self._tokenizers[self.default_tokenizer_key]
+            return loaded
+        else:
+            path = Path(key)
+            if path.is_dir():
+                path = path.joinpath('tokenizer.json')
+            try:
+                tokenizer = Tokenizer.from_file(str(path)) if path.is_file() else Tokenizer.from_pretrained(key)
+            except Exception as exc:
+                print(f"Could not load tokenizer '{key}', using the default one instead: {exc}")
+                loaded = self._tokenizers[key] = self._tokenizers[self.default_tokenizer_key]
+                return loaded
+        prompt_tokenizer = IncrementalTokenizer(
+            tokenizer, max_entries=self.prefix_tokenizer_entries, verify=self.verify_prefix_tokenizer
+        )
+        loaded = self._tokenizers[key] = (tokenizer, Vocabulary(tokenizer), prompt_tokenizer)
+        return loaded
+
+    def _make_info(self, name: str, settings: dict) -> ModelInfo:
+        key = settings.pop('tokenizer_key', self.default_tokenizer_key)
+        tokenizer, vocabulary, prompt_tokenizer = self._load_tokenizer(key)
+        return ModelInfo(name=name, tokenizer_key=key, tokenizer=tokenizer, vocabulary=vocabulary,
+                         prompt_tokenizer=prompt_tokenizer, **settings)
+
+    def default_info(self, name: str) -> ModelInfo:
+        """The settings the proxy has always assumed, from before models were discovered."""
+        python_backend = name.startswith('py-')
+        return self._make_info(name, {
+            'id_type': np.int32 if python_backend else np.uint32, 'samples_on_server': python_backend,
+            'max_batch_size': PYTHON_BACKEND_MAX_BATCH_SIZE if python_backend else 0,
+        })
+
+    def get(self, name: str) -> ModelInfo:
+        info = self._models.get(name)
+        if info is not None:
+            return info
+        if self.discovered:
+            raise KeyError(name)
+        # Not remembered, as clients could send any number of names while Triton can't be reached
+        return self.default_info(name)
+
+    def names(self) -> List[str]:
+        return sorted(self._models) if self.discovered else []
+
+    async def refresh(self, client: aio_client_util.InferenceServerClient):
+        """Replaces the known models with the ones Triton has ready."""
+        index = await client.get_model_repository_index(as_json=True)
+        models = {}
+        for entry in index.get('models', []):
+            name = entry['name']
+            if entry.get('state', 'READY') != 'READY':
+                continue
+            config = (await client.get_model_config(name, as_json=True)).get('config', {})
+            settings = parse_config(config)
+            # Loading a tokenizer and building its tables takes a while, so keep the event loop going meanwhile
+            key = settings.get('tokenizer_key')
+            if key is not None and key not in self._tokenizers:
+                await asyncio.to_thread(self._load_tokenizer, key)
+            models[name] = self._make_info(name, settings)
+        self._models = models
+        self.discovered = True
+        self.refreshes += 1
+
+    def start_refreshing(self, client: Callable[[], aio_client_util.InferenceServerClient], interval: float):
+        """Refreshes the models now and then every `interval` seconds, in the background."""
+        async def refresh_forever():
+            while True:
+                try:
+                    await self.refresh(client())
+                except asyncio.CancelledError:
+                    raise
+                except Exception as exc:
+                    self.refresh_errors += 1
+                    print(f"Could not discover the models served by Triton: {exc}")
+                if interval <= 0:
+                    return
+                await asyncio.sleep(interval)
+
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.ensure_future(refresh_forever())
+
+    def stop_refreshing(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+    def prompt_tokenizer_stats(self) -> dict:
+        totals = {}
+        for prompt_tokenizer in {id(t[2]): t[2] for t in self._tokenizers.values()}.values():
+            for key, value in prompt_tokenizer.stats().items():
+                totals[key] = totals.get(key, 0) + value
+        encoded = totals.get('reused_tokens', 0) + totals.get('encoded_tokens', 0)
+        totals['reuse_rate'] = totals.get('reused_tokens', 0) / encoded if encoded else 0.0
+        return totals
+
+    def stats(self) -> dict:
+        return {
+            'models': len(self._models),
+            'tokenizers': len({id(t[0]) for t in self._tokenizers.values()}),
+            'refreshes': self.refreshes,
+            'refresh_errors': self.refresh_errors,
+        }
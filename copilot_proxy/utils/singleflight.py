@@ -0,0 +1,48 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, List, TypeVar
+
+T = TypeVar('T')
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key onto a single execution.
+
+    The first caller for a key starts the work; everyone else arriving while it is still running waits for the same
+    result. The work runs in its own task, so one of the callers going away doesn't cancel it for the others. It is
+    only cancelled once all of them are gone.
+    """
+
+    def __init__(self):
+        # key -> (task, number of callers waiting for it)
+        self._in_flight: Dict[Hashable, List] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        entry = self._in_flight.get(key)
+        if entry is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            entry = self._in_flight[key] = [task, 0]
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if entry[1] == 1:
+                task.cancel()
+            raise
+        finally:
+            entry[1] -= 1
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self._in_flight),
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+        }
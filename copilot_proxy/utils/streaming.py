@@ -0,0 +1,121 @@
+import asyncio
+from typing import AsyncIterator, List, Optional
+
+from tokenizers import Tokenizer
+
+
+class IncrementalDecoder:
+    """
+    Turns a stream of token ids into a stream of text deltas.
+
+    Only the last couple of tokens are re-decoded at every step. A byte-level BPE token can end in the middle of a
+    multi-byte UTF-8 character, so text is held back while the decoded string ends with the replacement character.
+    """
+
+    def __init__(self, tokenizer: Tokenizer):
+        self.tokenizer = tokenizer
+        self.tokens: List[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def push(self, token_ids: List[int]) -> str:
+        self.tokens.extend(token_ids)
+        prefix_text = self.tokenizer.decode(self.tokens[self.prefix_offset:self.read_offset])
+        new_text = self.tokenizer.decode(self.tokens[self.prefix_offset:])
+        if len(new_text) > len(prefix_text) and not new_text.endswith('�'):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.tokens)
+            return new_text[len(prefix_text):]
+        return ''
+
+    def flush(self) -> str:
+        prefix_text = self.tokenizer.decode(self.tokens[self.prefix_offset:self.read_offset])
+        new_text = self.tokenizer.decode(self.tokens[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.tokens)
+        return new_text[len(prefix_text):]
+
+
+class StopWordFilter:
+    """
+    Cuts a stream of text deltas at the first stop word.
+
+    Text that could be the beginning of a stop word is held back until the next delta shows whether it is one, so
+    stop words that are split over several chunks are removed as well.
+    """
+
+    def __init__(self, stop_words: List[str]):
+        self.stop_words = [w for w in stop_words if w]
+        self.text = ''
+        self.sent = 0
+        self.stopped = False
+
+    def push(self, delta: str) -> str:
+        if self.stopped:
+            return ''
+        self.text += delta
+
+        # Everything before self.sent is known not to start a stop word
+        found = [i for i in (self.text.find(w, self.sent) for w in self.stop_words) if i != -1]
+        if found:
+            end = min(found)
+            self.stopped = True
+        else:
+            end = len(self.text) - self._held_back()
+        out = self.text[self.sent:end]
+        self.sent = end
+        return out
+
+    def flush(self) -> str:
+        if self.stopped:
+            return ''
+        out = self.text[self.sent:]
+        self.sent = len(self.text)
+        return out
+
+    def _held_back(self) -> int:
+        tail = self.text[self.sent:]
+        for k in range(min(len(tail), max((len(w) for w in self.stop_words), default=0) - 1), 0, -1):
+            if any(w.startswith(tail[-k:]) for w in self.stop_words):
+                return k
+        return 0
+
+
+class CancellableStream:
+    """
+    Iterates over the responses of a Triton stream, and can be cancelled from outside the task that iterates over it.
+
+    Depending on the tritonclient version, `stream_infer` returns an iterator with a `cancel()` method or a plain async
+    generator, which can't be closed while it waits for the next response. Every response is read in a task of its own,
+    so cancelling that task ends the stream in both cases.
+    """
+
+    def __init__(self, responses: AsyncIterator):
+        self.responses = responses
+        self.pending: Optional[asyncio.Future] = None
+        self.cancelled = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.cancelled:
+            raise asyncio.CancelledError()
+        self.pending = asyncio.ensure_future(self.responses.__anext__())
+        try:
+            return await self.pending
+        finally:
+            self.pending = None
+
+    def cancel(self):
+        """Makes the task iterating over the stream raise CancelledError."""
+        self.cancelled = True
+        if self.pending is not None:
+            self.pending.cancel()
+
+    async def aclose(self):
+        """Stops the Triton request, unless it has finished already."""
+        self.cancel()
+        if hasattr(self.responses, "aclose"):
+            await self.responses.aclose()
+        else:
+            self.responses.cancel()
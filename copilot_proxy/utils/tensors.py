@@ -0,0 +1,59 @@
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Tuple
+
+import numpy as np
+import tritonclient.grpc as client_util
+from tritonclient.utils import np_to_triton_dtype
+
+
+def make_input(name: str, tensor: np.ndarray) -> client_util.InferInput:
+    t = client_util.InferInput(name, tensor.shape, np_to_triton_dtype(tensor.dtype))
+    t.set_data_from_numpy(tensor)
+    return t
+
+
+class TensorTemplates:
+    """
+    Input tensors that many requests have in common, built once and shared between them.
+
+    Some inputs only depend on the number of rows and the id type of a request, and stop word lists repeat from one
+    request to the next. Building them, and above all serializing them into an InferInput, costs more per request
+    than the inputs that actually carry its values. Shared tensors are read-only, and the InferInputs built from them
+    are kept as well. The number of distinct tensors is bounded; the least recently used ones are dropped first.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._tensors: "OrderedDict[Hashable, Dict[str, np.ndarray]]" = OrderedDict()
+        # Ids of the shared tensors; they are kept alive by _tensors, so their ids can't be taken by other tensors
+        self._shared = set()
+        self._inputs: Dict[Tuple[int, str], client_util.InferInput] = {}
+
+    def get(self, key: Hashable, build: Callable[[], Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+        """Returns the tensors stored under `key`, building them with `build` the first time."""
+        tensors = self._tensors.get(key)
+        if tensors is not None:
+            self._tensors.move_to_end(key)
+            return tensors
+
+        tensors = build()
+        for tensor in tensors.values():
+            tensor.setflags(write=False)
+            self._shared.add(id(tensor))
+        self._tensors[key] = tensors
+        while len(self._tensors) > self.max_entries:
+            _, evicted = self._tensors.popitem(last=False)
+            for name, tensor in evicted.items():
+                self._shared.discard(id(tensor))
+                self._inputs.pop((id(tensor), name), None)
+        return tensors
+
+    def make_input(self, name: str, tensor: np.ndarray) -> client_util.InferInput:
+        """Returns the InferInput of a tensor, reusing the one built before if the tensor is shared."""
+        if id(tensor) not in self._shared:
+            return make_input(name, tensor)
+        key = (id(tensor), name)
+        infer_input = self._inputs.get(key)
+        if infer_input is None:
+            infer_input = self._inputs[key] = make_input(name, tensor)
+        return infer_input
@@ -0,0 +1,128 @@
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
+
+import numpy as np
+from tokenizers import Tokenizer
+
+
+class IncrementalTokenizer:
+    """
+    Tokenizes prompts by reusing the token ids of a recently seen prompt that starts the same way.
+
+    Successive prompts from an editor differ mostly at the end, yet encoding a 2k token prompt from scratch takes
+    several ms. The token ids of the longest common prefix are taken from the cache, and only the rest is encoded.
+
+    The prefix is cut at a line break that follows a non-whitespace character. The byte-level pre-tokenizer always
+    starts a new pre-token there, and BPE merges never cross pre-tokens, so encoding both halves separately gives
+    the same ids as encoding the whole prompt. With `verify` set, every result is compared against a full encoding.
+    """
+
+    def __init__(self, tokenizer: Tokenizer, max_entries: int = 64, max_tokens: int = 256 * 1024,
+                 max_candidates: int = 16, verify: bool = False):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.max_tokens = max_tokens
+        self.max_candidates = max_candidates
+        self.verify = verify
+        # Byte-level vocabularies spell every byte with one character, so this is the number of bytes of each token
+        self.token_bytes = np.array(
+            [len(tokenizer.id_to_token(i)) for i in range(tokenizer.get_vocab_size())], dtype=np.int64
+        )
+        # prompt -> (token ids, byte offset at which each token ends)
+        self._entries: "OrderedDict[str, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+        self._num_tokens = 0
+        self._lock = threading.Lock()
+        self.reused_tokens = 0
+        self.encoded_tokens = 0
+        self.mismatches = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def encode(self, text: str) -> List[int]:
+        if not self.enabled:
+            return self.tokenizer.encode(text).ids
+
+        prefix, cut = self._cached_prefix(text)
+        tail = np.array(self.tokenizer.encode(text[cut:]).ids, dtype=np.int64)
+        ids = np.concatenate([prefix, tail])
+
+        if self.verify:
+            expected = self.tokenizer.encode(text).ids
+            if ids.tolist() != expected:
+                self.mismatches += 1
+                print(f"WARNING: incremental tokenization differs from full tokenization after {len(prefix)} "
+                      f"reused tokens")
+                ids = np.array(expected, dtype=np.int64)
+
+        self._store(text, ids)
+        self.reused_tokens += len(prefix)
+        self.encoded_tokens += len(ids) - len(prefix)
+        return ids.tolist()
+
+    @staticmethod
+    def _common_prefix_length(a: str, b: str) -> int:
+        # Binary search, as comparing slices runs in C and beats a character by character loop
+        lo, hi = 0, min(len(a), len(b))
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if a[:mid] == b[:mid]:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    @staticmethod
+    def _safe_cut(text: str, limit: int) -> int:
+        """Returns the last position before `limit` at which the text can be tokenized in two halves."""
+        cut = text.rfind('\n', 0, limit)
+        while cut > 0 and text[cut - 1].isspace():
+            cut = text.rfind('\n', 0, cut)
+        return max(cut, 0)
+
+    def _cached_prefix(self, text: str) -> Tuple[np.ndarray, int]:
+        empty = np.zeros(0, dtype=np.int64)
+        with self._lock:
+            best_prompt, best_len = None, 0
+            for prompt in list(reversed(self._entries))[:self.max_candidates]:
+                n = self._common_prefix_length(prompt, text)
+                if n > best_len:
+                    best_prompt, best_len = prompt, n
+            if best_prompt is None:
+                return empty, 0
+            ids, byte_ends = self._entries[best_prompt]
+
+        # Both prompts agree up to best_len, so a cut strictly before it splits both of them the same way
+        cut = self._safe_cut(text, best_len)
+        if cut == 0:
+            return empty, 0
+        n_tokens = np.searchsorted(byte_ends, len(text[:cut].encode('utf-8')), side='right')
+        if n_tokens == 0 or byte_ends[n_tokens - 1] != len(text[:cut].encode('utf-8')):
+            # Not a token boundary after all, e.g. for a vocabulary that isn't byte-level
+            return empty, 0
+        return ids[:n_tokens], cut
+
+    def _store(self, text: str, ids: np.ndarray):
+        byte_ends = np.cumsum(self.token_bytes[ids])
+        with self._lock:
+            old = self._entries.pop(text, None)
+            if old is not None:
+                self._num_tokens -= len(old[0])
+            self._entries[text] = (ids, byte_ends)
+            self._num_tokens += len(ids)
+            while len(self._entries) > self.max_entries or (self._num_tokens > self.max_tokens and self._entries):
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._num_tokens -= len(evicted)
+
+    def stats(self) -> dict:
+        total = self.reused_tokens + self.encoded_tokens
+        return {
+            'entries': len(self._entries),
+            'cached_tokens': self._num_tokens,
+            'reused_tokens': self.reused_tokens,
+            'encoded_tokens': self.encoded_tokens,
+            'reuse_rate': self.reused_tokens / total if total else 0.0,
+            'mismatches': self.mismatches,
+        }
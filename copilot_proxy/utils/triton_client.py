@@ -0,0 +1,280 @@
+import asyncio
+import bisect
+import collections
+import itertools
+import time
+import zlib
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, TypeVar
+
+import tritonclient.grpc as client_util
+import tritonclient.grpc.aio as aio_client_util
+from tritonclient.utils import InferenceServerException
+
+T = TypeVar('T')
+
+
+class TritonClientPool:
+    """
+    A small pool of asyncio gRPC clients talking to a single Triton server.
+
+    Every client owns its own HTTP/2 channel, so spreading requests over several of them keeps one busy connection
+    from becoming a bottleneck when many editor sessions are in flight at once. The clients are created lazily, on
+    first use, so that they are bound to the event loop that is actually serving requests.
+    """
+
+    def __init__(self, url: str, size: int = 1, verbose: bool = False,
+                 keepalive_time_ms: Optional[int] = None, keepalive_timeout_ms: Optional[int] = None):
+        if size < 1:
+            raise ValueError(f"Pool size must be at least 1, got {size}")
+        self.url = url
+        self.size = size
+        self.verbose = verbose
+        self.keepalive_options = client_util.KeepAliveOptions()
+        if keepalive_time_ms is not None:
+            self.keepalive_options.keepalive_time_ms = keepalive_time_ms
+            # Without this, pings are only sent while a call is active, which doesn't help detecting dead idle
+            # connections between two keystrokes
+            self.keepalive_options.keepalive_permit_without_calls = True
+        if keepalive_timeout_ms is not None:
+            self.keepalive_options.keepalive_timeout_ms = keepalive_timeout_ms
+        self._clients: List[aio_client_util.InferenceServerClient] = []
+        self._next = None
+
+    def _connect(self):
+        self._clients = [
+            aio_client_util.InferenceServerClient(
+                url=self.url, verbose=self.verbose, keepalive_options=self.keepalive_options
+            )
+            for _ in range(self.size)
+        ]
+        self._next = itertools.cycle(self._clients)
+
+    def get(self) -> aio_client_util.InferenceServerClient:
+        if not self._clients:
+            self._connect()
+        return next(self._next)
+
+    async def close(self):
+        clients, self._clients = self._clients, []
+        for c in clients:
+            await c.close()
+
+
+class LatencyHistogram:
+    """Counts of request latencies in exponentially growing buckets, from a millisecond to about a minute."""
+
+    BOUNDS = [0.001 * 1.25 ** i for i in range(50)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+
+    def record(self, seconds: float):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+
+    def percentile(self, p: float) -> float:
+        """Returns the upper bound of the bucket holding the `p`th percentile of the latencies."""
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.BOUNDS[-1]
+
+
+def token_bucket(max_tokens: int) -> int:
+    """Groups requests by how many tokens they ask for, in powers of two, as the time to answer them grows with it."""
+    return max(max_tokens, 1).bit_length()
+
+
+class Endpoint:
+    """One Triton replica, with the clients talking to it and the requests it is currently answering."""
+
+    def __init__(self, url: str, clients: TritonClientPool):
+        self.url = url
+        self.clients = clients
+        self.outstanding = 0
+        self.served = 0
+        self.healthy = True
+        # token bucket -> latencies of the requests asking for that many tokens
+        self.latency: Dict[int, LatencyHistogram] = collections.defaultdict(LatencyHistogram)
+
+
+class EndpointPool:
+    """
+    Spreads requests over several Triton replicas.
+
+    Every request goes to the replica with the fewest requests outstanding, which follows how deep each replica's
+    queue actually is rather than taking turns. With `affinity`, requests of the same session stick to one replica, so
+    that its prompt cache stays warm; they only move elsewhere while that replica is down.
+
+    Replicas are health checked every `health_interval` seconds, and right away when a request to them fails with
+    UNAVAILABLE. A replica that isn't ready, or doesn't have a model it has served before ready, is ejected until a
+    later check finds it ready again. Requests failing with UNAVAILABLE are retried on another replica up to `retries`
+    times. If all replicas are ejected, requests are sent to all of them anyway rather than failed outright.
+
+    With `hedge_percentile`, a request that hasn't been answered after that percentile of its replica's latencies is
+    sent to a second replica as well. The first answer is used and the other request cancelled. This bounds the damage
+    of a slow replica to a few percent of the requests doing twice the work. Latencies are kept apart by the number of
+    tokens requested, so that long completions are only compared with each other, and hedging starts once the replica
+    has answered `hedge_min_samples` requests of about the same length.
+    """
+
+    def __init__(self, urls: List[str], size: int = 1, verbose: bool = False,
+                 keepalive_time_ms: Optional[int] = None, keepalive_timeout_ms: Optional[int] = None,
+                 affinity: bool = False, health_interval: float = 5.0, health_timeout: float = 2.0, retries: int = 2,
+                 hedge_percentile: float = 0.0, hedge_min_samples: int = 20):
+        if not urls:
+            raise ValueError("At least one Triton endpoint is needed")
+        self.endpoints = [
+            Endpoint(url, TritonClientPool(
+                url=url, size=size, verbose=verbose,
+                keepalive_time_ms=keepalive_time_ms, keepalive_timeout_ms=keepalive_timeout_ms,
+            ))
+            for url in urls
+        ]
+        self.affinity = affinity
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.retries = retries
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        # Models that have been served successfully, and so should be ready on every healthy replica
+        self.models: Set[str] = set()
+        self._health_task: Optional[asyncio.Task] = None
+        self.retried = 0
+        self.ejections = 0
+        self.readmissions = 0
+        self.hedged = 0
+        self.hedges_won = 0
+
+    def choose(self, session: Optional[str] = None, exclude: Iterable[Endpoint] = ()) -> Endpoint:
+        candidates = [e for e in self.endpoints if e not in exclude] or self.endpoints
+        candidates = [e for e in candidates if e.healthy] or candidates
+        if self.affinity and session is not None:
+            # Rendezvous hashing: a session keeps its replica as long as that one is available
+            return max(candidates, key=lambda e: zlib.crc32(f"{session}@{e.url}".encode()))
+        return min(candidates, key=lambda e: (e.outstanding, e.served))
+
+    def acquire(self, session: Optional[str] = None, exclude: Iterable[Endpoint] = ()) -> Endpoint:
+        """Picks the replica for a request and counts the request as outstanding there until it is released."""
+        if self._health_task is None and len(self.endpoints) > 1 and self.health_interval > 0:
+            self._health_task = asyncio.ensure_future(self._health_loop())
+        endpoint = self.choose(session, exclude)
+        endpoint.outstanding += 1
+        return endpoint
+
+    @staticmethod
+    def release(endpoint: Endpoint):
+        endpoint.outstanding -= 1
+        endpoint.served += 1
+
+    def hedge_delay(self, endpoint: Endpoint, max_tokens: int = 0) -> Optional[float]:
+        """
+        Returns how long to wait for `endpoint` before sending a request for `max_tokens` tokens elsewhere too, if that
+        is done at all.
+        """
+        if self.hedge_percentile <= 0 or len(self.endpoints) < 2:
+            return None
+        latency = endpoint.latency.get(token_bucket(max_tokens))
+        if latency is None or latency.count < self.hedge_min_samples:
+            return None
+        return latency.percentile(self.hedge_percentile)
+
+    async def call(self, fn: Callable[[aio_client_util.InferenceServerClient], Awaitable[T]], model_name: str,
+                   session: Optional[str] = None, max_tokens: int = 0) -> T:
+        """Calls `fn` with a client of the chosen replica, hedging it on a second replica if it is slow to answer."""
+        delay = self.hedge_delay(self.choose(session), max_tokens)
+        attempted: List[Endpoint] = []
+        primary = asyncio.ensure_future(self._call(fn, model_name, session, attempted, max_tokens))
+        if delay is None:
+            return await primary
+
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.hedged += 1
+                # The hedge avoids the replica that is being slow, but the session's one isn't worth more than a reply
+                tasks.append(asyncio.ensure_future(self._call(fn, model_name, None, list(attempted), max_tokens)))
+            while True:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                answered = [t for t in done if t.exception() is None]
+                if answered:
+                    if answered[0] is not primary:
+                        self.hedges_won += 1
+                    return answered[0].result()
+                if all(t.done() for t in tasks):
+                    return primary.result()
+                # The other request may still be answered
+                tasks = [t for t in tasks if not t.done()]
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _call(self, fn: Callable[[aio_client_util.InferenceServerClient], Awaitable[T]], model_name: str,
+                    session: Optional[str], attempted: List[Endpoint], max_tokens: int = 0) -> T:
+        """Calls `fn`, retrying on another replica while replicas are unavailable."""
+        retries = 0
+        while True:
+            endpoint = self.acquire(session, exclude=attempted)
+            attempted.append(endpoint)
+            start = time.monotonic()
+            try:
+                result = await fn(endpoint.clients.get())
+            except InferenceServerException as exc:
+                if exc.status() != 'StatusCode.UNAVAILABLE' or retries >= self.retries:
+                    raise
+                retries += 1
+                self.retried += 1
+                await self.check(endpoint)
+                continue
+            finally:
+                self.release(endpoint)
+            endpoint.latency[token_bucket(max_tokens)].record(time.monotonic() - start)
+            self.models.add(model_name)
+            return result
+
+    async def check(self, endpoint: Endpoint) -> bool:
+        """Checks whether a replica is ready, ejecting or readmitting it accordingly."""
+        client = endpoint.clients.get()
+        try:
+            ready = await asyncio.wait_for(client.is_server_ready(), self.health_timeout)
+            for model in list(self.models):
+                ready = ready and await asyncio.wait_for(client.is_model_ready(model), self.health_timeout)
+        except (InferenceServerException, asyncio.TimeoutError):
+            ready = False
+        if endpoint.healthy and not ready:
+            self.ejections += 1
+            print(f"Triton endpoint {endpoint.url} is not ready, sending requests elsewhere")
+        elif ready and not endpoint.healthy:
+            self.readmissions += 1
+            print(f"Triton endpoint {endpoint.url} is ready again")
+        endpoint.healthy = ready
+        return ready
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await asyncio.gather(*(self.check(e) for e in self.endpoints))
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        for endpoint in self.endpoints:
+            await endpoint.clients.close()
+
+    def stats(self) -> dict:
+        return {
+            'endpoints': len(self.endpoints),
+            'healthy_endpoints': sum(e.healthy for e in self.endpoints),
+            'outstanding': sum(e.outstanding for e in self.endpoints),
+            'retried': self.retried,
+            'ejections': self.ejections,
+            'readmissions': self.readmissions,
+            'hedged': self.hedged,
+            'hedges_won': self.hedges_won,
+        }
@@ -0,0 +1,101 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Hashable, List, Optional
+
+
+@dataclass
+class Suggestion:
+    """The last completion handed to an editor session."""
+    prompt: str
+    params: Hashable
+    texts: List[str]
+    finish_reasons: List[str]
+    prompt_tokens: int
+    completion_tokens: int
+    expires_at: float
+
+
+class TypeAheadSessions:
+    """
+    Remembers the last completion of every editor session, to answer requests made while the user types it out.
+
+    When the new prompt is the previous prompt followed by the beginning of the suggestion, the rest of the
+    suggestion is what the model would have come up with anyway, so it can be returned without asking Triton. The
+    table is bounded and entries expire, as users rarely come back to a suggestion after a pause.
+    """
+
+    def __init__(self, max_sessions: int = 1024, ttl: float = 60.0):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions: "OrderedDict[str, Suggestion]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_sessions > 0
+
+    def record(self, session: str, prompt: str, params: Hashable, choices: List[dict], usage: dict):
+        if not choices:
+            return
+        self._sessions[session] = Suggestion(
+            prompt=prompt,
+            params=params,
+            texts=[c['text'] for c in choices],
+            finish_reasons=[c['finish_reason'] for c in choices],
+            prompt_tokens=usage['prompt_tokens'],
+            completion_tokens=usage['completion_tokens'],
+            expires_at=time.monotonic() + self.ttl,
+        )
+        self._sessions.move_to_end(session)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def lookup(self, session: str, prompt: str, params: Hashable, max_tokens: int,
+               count_tokens: Callable[[str], int]) -> Optional[Suggestion]:
+        """
+        Returns the remainder of the session's last suggestion if `prompt` ends in a part of it the user typed out.
+
+        Token counts of the returned suggestion are adjusted by counting the tokens of the typed and of the remaining
+        text with `count_tokens`.
+        """
+        suggestion = self._sessions.get(session)
+        if suggestion is not None and time.monotonic() > suggestion.expires_at:
+            del self._sessions[session]
+            suggestion = None
+        if suggestion is None or suggestion.params != params or not prompt.startswith(suggestion.prompt):
+            self.misses += 1
+            return None
+
+        typed = prompt[len(suggestion.prompt):]
+        # Every choice has to continue what was typed and have something left to suggest
+        if not typed or not all(t.startswith(typed) and len(t) > len(typed) for t in suggestion.texts):
+            self.misses += 1
+            return None
+
+        texts = [t[len(typed):] for t in suggestion.texts]
+        completion_tokens = [count_tokens(t) for t in texts]
+        if max(completion_tokens) > max_tokens:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return Suggestion(
+            prompt=prompt,
+            params=params,
+            texts=texts,
+            finish_reasons=suggestion.finish_reasons,
+            prompt_tokens=suggestion.prompt_tokens + count_tokens(typed),
+            completion_tokens=sum(completion_tokens),
+            expires_at=suggestion.expires_at,
+        )
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'sessions': len(self._sessions),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,68 @@
+from functools import lru_cache
+from typing import Dict
+
+import numpy as np
+from tokenizers import Tokenizer
+
+
+@lru_cache()
+def byte_decoder() -> Dict[str, int]:
+    """Returns the byte each character of GPT-2's byte-level alphabet stands for."""
+    printable = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + \
+        list(range(ord("®"), ord("ÿ") + 1))
+    chars = {b: chr(b) for b in printable}
+    extra = 0
+    for b in range(256):
+        if b not in chars:
+            chars[b] = chr(256 + extra)
+            extra += 1
+    return {c: b for b, c in chars.items()}
+
+
+class Vocabulary:
+    """
+    Strings of every token of a byte-level BPE vocabulary, to look up tokens in bulk rather than decode them one by one.
+
+    A token can end in the middle of a multi-byte UTF-8 character. Like OpenAI's API, such tokens are spelled as
+    `bytes:` followed by their escaped bytes. Ids beyond the vocabulary, which models with padded embeddings can
+    produce, map to the empty string.
+    """
+
+    def __init__(self, tokenizer: Tokenizer):
+        decoder = byte_decoder()
+        size = tokenizer.get_vocab_size()
+        strings = []
+        chars = []
+        for i in range(size):
+            token = tokenizer.id_to_token(i)
+            if all(c in decoder for c in token):
+                data = bytes(decoder[c] for c in token)
+            else:
+                # Added tokens, like runs of spaces, are stored as they are
+                data = token.encode("utf-8")
+            try:
+                strings.append(data.decode("utf-8"))
+            except UnicodeDecodeError:
+                strings.append("bytes:" + "".join(f"\\x{b:02x}" for b in data))
+            # Continuation bytes don't start a character of their own
+            chars.append(sum((b & 0xC0) != 0x80 for b in data))
+        self.size = size
+        self.strings = np.array(strings + [""], dtype=object)
+        self.chars = np.array(chars + [0], dtype=np.int64)
+        self.line_ends = np.array([s.endswith("\n") for s in strings] + [False])
+
+    def _clip(self, ids) -> np.ndarray:
+        return np.minimum(np.asarray(ids, dtype=np.int64), self.size)
+
+    def tokens(self, ids) -> np.ndarray:
+        """Returns the strings of `ids`, in an object array of the same shape."""
+        return self.strings[self._clip(ids)]
+
+    def ends_line(self, ids) -> np.ndarray:
+        """Returns whether each of `ids` is the last token of a line."""
+        return self.line_ends[self._clip(ids)]
+
+    def text_offsets(self, ids, start: int = 0) -> np.ndarray:
+        """Returns the position in the decoded text at which each of `ids` starts, if the text begins at `start`."""
+        chars = self.chars[self._clip(ids)]
+        return start + np.cumsum(chars) - chars
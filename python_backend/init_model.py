@@ -18,6 +18,20 @@ parser.add_argument("--org_name", type=str, required=True)
 parser.add_argument("--use_half", type=str, default="1")
 parser.add_argument("--use_int8", type=str, default="0")
 parser.add_argument("--use_auto_device_map", type=str, default="1")
+parser.add_argument("--prefix_cache_mb", type=str, default="1024",
+                    help="Memory for the keys and values of recent prompts, reused for prompts starting the same way")
+parser.add_argument("--use_dlpack", type=str, default="0",
+                    help="Exchange tensors with Triton without copying them, if that works on this machine")
+parser.add_argument("--draft_model", type=str, default="",
+                    help="Small model with the same tokenizer, like Salesforce/codegen-350M-mono, to draft tokens with")
+parser.add_argument("--speculative_tokens", type=str, default="4",
+                    help="Number of tokens the draft model proposes at a time")
+parser.add_argument("--continuous_batching", type=str, default="0",
+                    help="Let requests join and leave the batch at every decoding step; implies --decoupled 1")
+parser.add_argument("--max_active_sequences", type=str, default="16",
+                    help="Number of sequences generated at once with continuous batching")
+parser.add_argument("--max_seq_len", type=str, default="2048", help="Context length of the model, in tokens")
+parser.add_argument("--decoupled", type=str, default="0", help="Stream every generated token back as it is decoded")
 args = parser.parse_args()
 
 
@@ -29,15 +43,24 @@ model_dir_path.mkdir(parents=True, exist_ok=True)
 shutil.copy(os.path.join(SCRIPT_DIR, 'model.py'), os.path.join(model_dir_path, 'model.py'))
 
 # Step 3: Generate config.pbtxt
+continuous_batching = args.continuous_batching.lower() in ["1", "true"]
 with open(CONFIG_TEMPLATE_PATH, 'r') as f:
     template = Template(f.read())
 
 config = template.substitute(
     org_name=args.org_name,
     model_name=args.model_name,
+    max_seq_len=args.max_seq_len,
     use_half=args.use_half,
     use_int8=args.use_int8,
     use_auto_device_map=args.use_auto_device_map,
+    prefix_cache_mb=args.prefix_cache_mb,
+    use_dlpack=args.use_dlpack,
+    draft_model=args.draft_model,
+    speculative_tokens=args.speculative_tokens,
+    continuous_batching=args.continuous_batching,
+    max_active_sequences=args.max_active_sequences,
+    decoupled="true" if args.decoupled.lower() in ["1", "true"] or continuous_batching else "false",
 )
 with open(os.path.join(model_dir_path, '../config.pbtxt'), 'w') as f:
     f.write(config)
@@ -1,24 +1,905 @@
 import json
+import threading
+from collections import OrderedDict, deque
 
 import torch
 import triton_python_backend_utils as pb_utils
-# Using dlpack causes segfaults on some machines, so not using it for now
-# But it supports zero copy transfer from triton tensors to torch tensors,
-# so worth investigating further
-# from torch.utils.dlpack import to_dlpack, from_dlpack
+from torch.utils.dlpack import to_dlpack, from_dlpack
 from transformers import AutoModelForCausalLM
+from transformers import DynamicCache
 from transformers import AutoTokenizer
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+
+
+# DLPack supports zero copy transfer between triton and torch tensors, but it causes segfaults on some machines. So it
+# is only used when the model config asks for it, and a round trip through it works at startup.
+use_dlpack = False
+
+
+def dlpack_works():
+    """Checks that a tensor survives a round trip from torch to triton and back through DLPack."""
+    try:
+        expected = torch.arange(16, dtype=torch.int32).view(2, 8)
+        tensor = pb_utils.Tensor.from_dlpack("probe", to_dlpack(expected))
+        return torch.equal(from_dlpack(tensor.to_dlpack()), expected) and \
+            torch.equal(torch.from_numpy(tensor.as_numpy()), expected)
+    except Exception as exc:
+        print(f"DLPack round trip failed: {exc}")
+        return False
 
 
 def pb2torch(request, name):
     tensor = pb_utils.get_input_tensor_by_name(request, name)
+    if tensor is None:
+        return None
+    if use_dlpack:
+        return from_dlpack(tensor.to_dlpack())
     return torch.from_numpy(tensor.as_numpy())
-    # return from_dlpack(tensor.to_dlpack())
 
 
 def torch2pb(name, tensor):
+    if use_dlpack:
+        return pb_utils.Tensor.from_dlpack(name, to_dlpack(tensor.contiguous()))
     return pb_utils.Tensor(name, tensor.numpy())
-    # return pb_utils.Tensor.from_dlpack(name, to_dlpack(tensor))
+
+
+def make_response(output_ids, eos_token_id, log_probs=None):
+    # client wants batch x beam_width x seq_len and we don't support beam_width yet
+    output_ids = output_ids.unsqueeze(1)
+    # Padding is all eos, so every other token is part of the sequence
+    sequence_length = (output_ids != eos_token_id).sum(dim=-1, dtype=torch.int32)
+
+    output_tensors = [torch2pb("output_ids", output_ids), torch2pb("sequence_length", sequence_length)]
+    for name, tensor in (log_probs or {}).items():
+        output_tensors.append(torch2pb(name, tensor.unsqueeze(1)))
+    return pb_utils.InferenceResponse(output_tensors)
+
+
+def cache_layers(cache):
+    """Returns the keys and values of every layer of a DynamicCache, each of shape batch x heads x seq_len x dim."""
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+def make_cache(layers):
+    cache = DynamicCache()
+    for layer_idx, (keys, values) in enumerate(layers):
+        cache.update(keys, values, layer_idx)
+    return cache
+
+
+class PrefixCache:
+    """
+    Keeps the KV cache of recent prompts, so that a prompt starting the same way only needs its tail prefilled.
+
+    Successive prompts from an editor share almost all of their tokens. Prompts are indexed by the hashes of their
+    blocks of `block_size` tokens, each chained with the hash of the blocks before it, so finding the longest cached
+    prefix takes one lookup per block. The match is then extended token by token. Entries are evicted least recently
+    used first once their keys and values take up more than `max_bytes`.
+    """
+
+    def __init__(self, max_bytes, block_size=32):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        # entry id -> (token ids, layers, size in bytes, block hashes)
+        self.entries = OrderedDict()
+        self.index = {}  # block hash -> entry id
+        self.next_id = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.prefilled_tokens = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def block_hashes(self, ids):
+        hashes = []
+        h = 0
+        for start in range(0, len(ids) - self.block_size + 1, self.block_size):
+            h = hash((h, tuple(ids[start:start + self.block_size])))
+            hashes.append(h)
+        return hashes
+
+    def lookup(self, ids):
+        """Returns the number of leading tokens of `ids` that are cached, and the layers of their KV cache."""
+        entry_id, matched = None, 0
+        for i, h in enumerate(self.block_hashes(ids)):
+            if h not in self.index:
+                break
+            entry_id, matched = self.index[h], (i + 1) * self.block_size
+
+        entry = self.entries.get(entry_id)
+        if entry is None or entry[0][:matched] != ids[:matched]:
+            self.misses += 1
+            return 0, None
+        cached_ids, layers, _, _ = entry
+        while matched < min(len(cached_ids), len(ids)) and cached_ids[matched] == ids[matched]:
+            matched += 1
+
+        self.entries.move_to_end(entry_id)
+        self.hits += 1
+        self.reused_tokens += matched
+        return matched, [(keys[:, :, :matched], values[:, :, :matched]) for keys, values in layers]
+
+    def store(self, ids, layers):
+        nbytes = sum(keys.nelement() * keys.element_size() * 2 for keys, _ in layers)
+        hashes = self.block_hashes(ids)
+        if nbytes > self.max_bytes or not hashes:
+            return
+        # Prompts the new one starts with are covered by it from now on
+        for entry_id in {self.index[h] for h in hashes if h in self.index}:
+            cached_ids = self.entries[entry_id][0]
+            if ids[:len(cached_ids)] == cached_ids:
+                self.evict(entry_id)
+
+        entry_id = self.next_id
+        self.next_id += 1
+        self.entries[entry_id] = (ids, layers, nbytes, hashes)
+        self.bytes += nbytes
+        for h in hashes:
+            self.index[h] = entry_id
+        while self.bytes > self.max_bytes:
+            self.evict(next(iter(self.entries)))
+
+    def evict(self, entry_id):
+        _, _, nbytes, hashes = self.entries.pop(entry_id)
+        self.bytes -= nbytes
+        for h in hashes:
+            if self.index.get(h) == entry_id:
+                del self.index[h]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        prompt_tokens = self.reused_tokens + self.prefilled_tokens
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "reused_token_rate": self.reused_tokens / prompt_tokens if prompt_tokens else 0.0,
+        }
+
+
+class Batch:
+    """
+    The requests of one execute() call, merged into a single batch for generate().
+
+    Prompts arrive right-padded, with their actual lengths in `input_lengths`. Decoder-only models need them
+    left-padded instead, so that every row continues right after its own prompt. A request asking for `n` samples
+    sends its prompt once; `sample_index` maps every row of the output to its prompt. split() takes the output apart
+    again and removes the left padding, so every request gets back its prompt followed by the generated tokens.
+    """
+
+    def __init__(self, requests, pad_token_id):
+        self.pad_token_id = pad_token_id
+        self.dtype = None  # of the ids Triton exchanges with the client
+        self.rows = []  # the slice of output rows of each request
+        prompts, repeats, max_new_tokens, top_k, top_p, temperature = [], [], [], [], [], []
+        stop_words = []
+        # Whether each request wants log probs, and how many of the most likely alternatives
+        self.want_logprobs, self.num_logprobs = [], []
+
+        for request in requests:
+            input_ids = pb2torch(request, "input_ids")
+            self.dtype = input_ids.dtype
+            n = input_ids.shape[0]
+            input_lengths = pb2torch(request, "input_lengths").view(-1)
+            prompts += [row[:length] for row, length in zip(input_ids, input_lengths.tolist())]
+            repeats.append(self.row_values(request, "n", n, 1))
+            max_new_tokens.append(pb2torch(request, "request_output_len").view(n, -1)[:, 0])
+            top_k.append(self.row_values(request, "runtime_top_k", n, 0))
+            top_p.append(self.row_values(request, "runtime_top_p", n, 1.0))
+            temperature.append(self.row_values(request, "temperature", n, 1.0))
+            stop_words += self.word_lists(request, "stop_words_list", n)
+            self.want_logprobs.append(bool(self.row_values(request, "is_return_log_probs", n, False).any()))
+            self.num_logprobs.append(int(self.row_values(request, "top_k_logprobs", n, 0).max()))
+            start = self.rows[-1].stop if self.rows else 0
+            self.rows.append(slice(start, start + int(repeats[-1].sum())))
+
+        self.prompt_len = max(len(p) for p in prompts)
+        self.input_ids = torch.full((len(prompts), self.prompt_len), pad_token_id, dtype=torch.long)
+        self.attention_mask = torch.zeros((len(prompts), self.prompt_len), dtype=torch.long)
+        for i, p in enumerate(prompts):
+            self.input_ids[i, self.prompt_len - len(p):] = p
+            self.attention_mask[i, self.prompt_len - len(p):] = 1
+
+        # Everything else is per row of the output
+        self.repeats = torch.cat(repeats).long()
+        self.sample_index = torch.repeat_interleave(torch.arange(len(prompts)), self.repeats)
+        self.padding = torch.tensor([self.prompt_len - len(p) for p in prompts])[self.sample_index]
+        self.max_new_tokens = torch.cat(max_new_tokens).long()[self.sample_index]
+        self.top_k = torch.cat(top_k).long()[self.sample_index]
+        self.top_p = torch.cat(top_p).float()[self.sample_index]
+        self.temperature = torch.cat(temperature).float()[self.sample_index]
+        self.stop_words = [stop_words[i] for i in self.sample_index.tolist()]
+
+    @staticmethod
+    def row_values(request, name, n, default):
+        tensor = pb2torch(request, name)
+        if tensor is None:
+            return torch.full((n,), default)
+        return tensor.view(n, -1)[:, 0]
+
+    @staticmethod
+    def word_lists(request, name, n):
+        """
+        Returns the words of every row of a word list tensor, as lists of token ids.
+
+        Each row holds the concatenated token ids of its words, and the offsets at which each word ends, padded with -1.
+        """
+        tensor = pb2torch(request, name)
+        if tensor is None:
+            return [[] for _ in range(n)]
+        word_lists = []
+        for ids, offsets in tensor.view(n, 2, -1).tolist():
+            ends = [end for end in offsets if end > 0]
+            word_lists.append([ids[start:end] for start, end in zip([0] + ends, ends)])
+        return word_lists
+
+    def split_rows(self, tensor):
+        """Returns the rows of every request."""
+        tensor = tensor.cpu()
+        return [tensor[rows] for rows in self.rows]
+
+    def split(self, output_ids):
+        """Returns the output of every request, without the left padding of its prompts."""
+        output_ids = output_ids.cpu()
+        outputs = []
+        for rows in self.rows:
+            padding = self.padding[rows]
+            # Shift every row left by its padding, and fill up the end with padding instead
+            positions = torch.arange(output_ids.shape[1] - int(padding.min())) + padding.unsqueeze(1)
+            output = output_ids[rows].gather(1, positions.clamp(max=output_ids.shape[1] - 1))
+            output[positions >= output_ids.shape[1]] = self.pad_token_id
+            outputs.append(output.to(self.dtype))
+        return outputs
+
+
+class SamplingLogitsProcessor(LogitsProcessor):
+    """
+    Applies the temperature, top-k and top-p of every row to its own logits.
+
+    generate() takes a single set of sampling parameters for the whole batch, yet every request brings its own.
+    """
+
+    def __init__(self, temperature, top_k, top_p):
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+
+    def __call__(self, input_ids, scores):
+        filter_value = -float("inf")
+        temperature = self.temperature.to(scores.device)
+        scores = scores / torch.where(temperature > 0, temperature, torch.ones_like(temperature)).unsqueeze(1)
+
+        top_k = self.top_k.to(scores.device).clamp(max=scores.shape[-1])
+        if (top_k > 0).any():
+            kth_largest = torch.sort(scores, descending=True).values.gather(1, (top_k.clamp(min=1) - 1).unsqueeze(1))
+            scores = scores.masked_fill((top_k > 0).unsqueeze(1) & (scores < kth_largest), filter_value)
+
+        top_p = self.top_p.to(scores.device)
+        if (top_p < 1.0).any():
+            sorted_logits, sorted_indices = torch.sort(scores, descending=False)
+            cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+            # Always keep the most likely token
+            sorted_to_remove = cumulative_probs <= (1 - top_p).unsqueeze(1)
+            sorted_to_remove[:, -1] = False
+            to_remove = sorted_to_remove.scatter(1, sorted_indices, sorted_to_remove)
+            scores = scores.masked_fill(to_remove, filter_value)
+        return scores
+
+
+class MaxNewTokensLogitsProcessor(LogitsProcessor):
+    """Ends every row once it has generated as many tokens as its request asked for."""
+
+    def __init__(self, prompt_len, max_new_tokens, eos_token_id):
+        self.prompt_len = prompt_len
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids, scores):
+        done = (self.max_new_tokens.to(scores.device) <= input_ids.shape[1] - self.prompt_len)
+        if done.any():
+            scores[done] = -float("inf")
+            scores[done, self.eos_token_id] = 0
+        return scores
+
+
+class LogProbsRecorder(LogitsProcessor):
+    """
+    Records the log probability of every generated token, and the `top_k` most likely tokens at every step.
+
+    It has to come first among the logits processors, to see the scores of the model itself. Which token got chosen
+    at a step is only known from the next step on, so the log probs of the previous step are kept until then;
+    finish() collects those of the last step.
+    """
+
+    def __init__(self, top_k):
+        self.top_k = top_k
+        self.previous = None
+        self.token_logprobs = []
+        self.top_logprobs = []
+        self.top_logprob_ids = []
+
+    def __call__(self, input_ids, scores):
+        self.collect(input_ids[:, -1])
+        self.previous = scores.float().log_softmax(dim=-1)
+        if self.top_k > 0:
+            top = self.previous.topk(self.top_k, dim=-1)
+            self.top_logprobs.append(top.values)
+            self.top_logprob_ids.append(top.indices)
+        return scores
+
+    def collect(self, tokens):
+        if self.previous is not None:
+            self.token_logprobs.append(self.previous.gather(1, tokens.view(-1, 1)).squeeze(1))
+            self.previous = None
+
+    def finish(self, output_ids, eos_token_id):
+        """Returns the log prob tensors of the whole batch, once generate() is done."""
+        self.collect(output_ids[:, -1])
+        steps = len(self.token_logprobs)
+        token_logprobs = torch.stack(self.token_logprobs, dim=1)
+        # Only count the tokens up to the end of every sequence, like sequence_length does
+        generated = output_ids[:, output_ids.shape[1] - steps:]
+        in_sequence = (generated == eos_token_id).cumsum(dim=1) == 0
+        log_probs = {
+            "output_log_probs": token_logprobs,
+            "cum_log_probs": (token_logprobs * in_sequence).sum(dim=1),
+        }
+        if self.top_k > 0:
+            log_probs["top_logprobs"] = torch.stack(self.top_logprobs, dim=1)
+            log_probs["top_logprob_ids"] = torch.stack(self.top_logprob_ids, dim=1).int()
+        return log_probs
+
+
+class StopWordsCriteria(StoppingCriteria):
+    """Stops generating for every row as soon as it has generated one of its stop words."""
+
+    def __init__(self, prompt_len, stop_words):
+        self.prompt_len = prompt_len
+        self.stop_words = stop_words
+        self.max_len = max((len(w) for words in stop_words for w in words), default=0)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids.shape[1] - self.prompt_len
+        # A single transfer of the last few tokens of every row, rather than one per row and word
+        tails = input_ids[:, -min(self.max_len, generated):].tolist()
+        stop = [
+            any(len(w) <= generated and tail[len(tail) - len(w):] == w for w in words)
+            for tail, words in zip(tails, self.stop_words)
+        ]
+        return torch.tensor(stop, dtype=torch.bool, device=input_ids.device)
+
+
+class TritonStreamer(BaseStreamer):
+    """
+    Sends the sequences generated so far back to the clients after every decoding step.
+
+    Responses have the same layout as the non-streamed ones (prompt followed by the generated tokens), so the client
+    can handle both the same way.
+    """
+
+    def __init__(self, batch, response_senders, eos_token_id):
+        self.batch = batch
+        self.response_senders = response_senders
+        self.eos_token_id = eos_token_id
+        self.output_ids = None
+
+    def put(self, value):
+        value = value.cpu()
+        # generate() first hands us the prompt, then one new token per sequence per step (or several, when decoding
+        # speculatively)
+        if self.output_ids is None:
+            self.output_ids = value
+            return
+        new_tokens = value.view(self.output_ids.shape[0], -1).to(self.output_ids.dtype)
+        self.output_ids = torch.cat([self.output_ids, new_tokens], dim=1)
+        for response_sender, output_ids in zip(self.response_senders, self.batch.split(self.output_ids)):
+            response_sender.send(make_response(output_ids, self.eos_token_id))
+
+    def end(self):
+        pass
+
+
+class CancellationCriteria(StoppingCriteria):
+    """
+    Stops generating for a request as soon as Triton reports it as cancelled, e.g. because the client went away.
+
+    The other requests of the batch carry on. Triton only reports cancellations from version 23.10 on; with older
+    versions, this never stops generation.
+    """
+
+    def __init__(self, batch, is_cancelled):
+        self.batch = batch
+        self.is_cancelled = is_cancelled
+        self.steps = 0
+        self.cancelled_at = [None] * len(is_cancelled)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.steps = input_ids.shape[1] - self.batch.prompt_len
+        stop = torch.zeros((input_ids.shape[0],), dtype=torch.bool)
+        for i, (is_cancelled, rows) in enumerate(zip(self.is_cancelled, self.batch.rows)):
+            if self.cancelled_at[i] is None and is_cancelled is not None and is_cancelled():
+                self.cancelled_at[i] = self.steps
+            if self.cancelled_at[i] is not None:
+                stop[rows] = True
+        return stop.to(input_ids.device)
+
+    @property
+    def cancelled(self):
+        return sum(step is not None for step in self.cancelled_at)
+
+    @property
+    def skipped_steps(self):
+        return sum(
+            max(0, int(self.batch.max_new_tokens[rows].max()) - step)
+            for step, rows in zip(self.cancelled_at, self.batch.rows) if step is not None
+        )
+
+
+class SpeculativeDecoder:
+    """
+    Generates with a small draft model proposing `k` tokens, which the model then checks in a single forward pass.
+
+    A drafted token x is accepted with probability min(1, p(x) / q(x)), where p and q are the distributions the model
+    and the draft model sample from, after every row's temperature, top-k and top-p. At the first rejected token, a
+    token is drawn from max(0, p - q), normalized, instead; after k accepted ones, one more is drawn from p. Either way
+    every token is distributed exactly as if the model had sampled it on its own, so the draft model only changes how
+    fast the output comes, not what it looks like.
+
+    All rows of the batch move on by the same number of tokens, one more than the fewest drafted tokens an unfinished
+    row accepted, so that their KV caches stay aligned. That last token is still a correct sample for every row: its
+    accepted draft token where there is one, and its resampled token otherwise.
+    """
+
+    def __init__(self, model, draft_model, k):
+        self.model = model
+        self.draft_model = draft_model
+        self.k = k
+        # Both models have to share the tokenizer, but their embeddings may be padded to different sizes
+        self.vocab_size = min(model.config.vocab_size, draft_model.config.vocab_size)
+        # Drafted tokens proposed to and accepted by unfinished rows
+        self.proposed = 0
+        self.accepted = 0
+        # Passes of the model, and the tokens every row moved on by in them
+        self.passes = 0
+        self.emitted = 0
+
+    @staticmethod
+    def forward(model, cache, tokens, attention_mask):
+        """Feeds `tokens` to a model after those in its `cache`, and returns their logits."""
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, -tokens.shape[1]:]
+        outputs = model(
+            input_ids=tokens, attention_mask=attention_mask, position_ids=position_ids, past_key_values=cache,
+            use_cache=True,
+        )
+        return outputs.logits.float()
+
+    @staticmethod
+    def sampling_probs(sampling, logits):
+        """Returns the distributions of shape rows x steps x vocab that the tokens are sampled from."""
+        rows, steps, vocab = logits.shape
+        return sampling(None, logits.reshape(rows * steps, vocab)).softmax(dim=-1).view(rows, steps, vocab)
+
+    @torch.no_grad()
+    def generate(self, batch, input_ids, attention_mask, caches, eos_token_id, stopping_criteria, recorder=None,
+                 streamer=None):
+        """
+        Generates the completions of a batch like generate() does, and returns the prompts followed by them.
+
+        `caches` hold the keys and values of every prompt but its last token, for the model and the draft model.
+        """
+        device = input_ids.device
+        rows = input_ids.shape[0]
+        k = self.k
+        target_cache, draft_cache = caches
+        max_new_tokens = batch.max_new_tokens.to(device)
+        longest = int(max_new_tokens.max())
+
+        def per_step(steps):
+            return SamplingLogitsProcessor(*(
+                t.repeat_interleave(steps) for t in (batch.temperature, batch.top_k, batch.top_p)
+            ))
+        draft_sampling, target_sampling = per_step(1), per_step(k + 1)
+
+        if streamer is not None:
+            streamer.put(input_ids)
+        done = torch.zeros(rows, dtype=torch.bool, device=device)
+        generated = 0
+        while generated < longest and not done.all():
+            seq_len = input_ids.shape[1]
+            # Up to k drafted tokens and one more from the model are added in this pass
+            mask = torch.cat([attention_mask, attention_mask.new_ones((rows, k + 1))], dim=1)
+
+            # The draft model proposes k tokens, catching up on those it hasn't seen yet first
+            tokens = input_ids[:, draft_cache.get_seq_length():]
+            drafted, draft_probs = [], []
+            for i in range(k):
+                logits = self.forward(self.draft_model, draft_cache, tokens, mask[:, :seq_len + i])
+                probs = self.sampling_probs(draft_sampling, logits[:, -1:, :self.vocab_size])[:, 0]
+                tokens = torch.multinomial(probs, 1)
+                drafted.append(tokens)
+                draft_probs.append(probs)
+            drafted = torch.cat(drafted, dim=1)
+            draft_probs = torch.stack(draft_probs, dim=1)
+
+            # The model scores the last token and all drafted ones at once
+            target_logits = self.forward(
+                self.model, target_cache, torch.cat([input_ids[:, -1:], drafted], dim=1), mask[:, :seq_len + k],
+            )[:, :, :self.vocab_size]
+            target_probs = self.sampling_probs(target_sampling, target_logits)
+
+            p = target_probs[:, :k].gather(2, drafted.unsqueeze(2)).squeeze(2)
+            q = draft_probs.gather(2, drafted.unsqueeze(2)).squeeze(2)
+            accepted = torch.rand_like(q) * q < p
+            num_accepted = accepted.long().cumprod(dim=1).sum(dim=1)
+            m = int(num_accepted[~done].min())
+            self.proposed += k * int((~done).sum())
+            self.accepted += int(num_accepted[~done].sum())
+            self.passes += 1
+            self.emitted += m + 1
+
+            if m < k:
+                residual = (target_probs[:, m] - draft_probs[:, m]).clamp(min=0)
+                # Where the distributions are the same, nothing gets rejected, but rounding may say otherwise
+                residual = torch.where(residual.sum(dim=-1, keepdim=True) > 0, residual, target_probs[:, m])
+                resampled = torch.multinomial(residual, 1).squeeze(1)
+                last = torch.where(num_accepted > m, drafted[:, m], resampled)
+            else:
+                last = torch.multinomial(target_probs[:, k], 1).squeeze(1)
+            new_tokens = torch.cat([drafted[:, :m], last.unsqueeze(1)], dim=1)
+
+            appended = []
+            for j in range(m + 1):
+                token = torch.where(done, eos_token_id, new_tokens[:, j])
+                if recorder is not None:
+                    recorder(input_ids, target_logits[:, j])
+                input_ids = torch.cat([input_ids, token.unsqueeze(1)], dim=1)
+                attention_mask = mask[:, :input_ids.shape[1]]
+                appended.append(token)
+                generated += 1
+                done |= (token == eos_token_id) | (max_new_tokens <= generated)
+                if len(stopping_criteria):
+                    done |= stopping_criteria(input_ids, None).to(device)
+                if generated >= longest:
+                    break
+            if streamer is not None:
+                streamer.put(torch.stack(appended, dim=1))
+
+            # Forget the keys and values of the drafted tokens that didn't make it
+            for cache in (target_cache, draft_cache):
+                rejected = cache.get_seq_length() - (seq_len + m)
+                if rejected > 0:
+                    cache.crop(-rejected)
+        return input_ids
+
+    def stats(self):
+        return {
+            "accept_rate": self.accepted / self.proposed if self.proposed else 0.0,
+            "tokens_per_pass": self.emitted / self.passes if self.passes else 0.0,
+        }
+
+
+class Sequence:
+    """One row of the output of a request, while the ContinuousBatcher generates it."""
+
+    def __init__(self, prompt, max_new_tokens, stop_words, num_logprobs):
+        self.tokens = prompt
+        self.prompt_len = len(prompt)
+        self.max_new_tokens = max_new_tokens
+        self.stop_words = stop_words
+        # -1 without log probs, otherwise the number of most likely alternatives to return as well
+        self.num_logprobs = num_logprobs
+        self.token_logprobs = []
+        self.top_logprobs = []
+        self.top_logprob_ids = []
+        self.finished = max_new_tokens <= 0
+
+    @property
+    def generated(self):
+        return len(self.tokens) - self.prompt_len
+
+    def push(self, token, eos_token_id):
+        self.tokens.append(token)
+        self.finished = token == eos_token_id or self.generated >= self.max_new_tokens or any(
+            len(w) <= self.generated and self.tokens[len(self.tokens) - len(w):] == w for w in self.stop_words
+        )
+
+
+class StreamingRequest:
+    """A request the ContinuousBatcher generates for, with the sequences of its rows."""
+
+    def __init__(self, batch, response_sender):
+        # Parsed right away, as the inputs only live as long as execute()
+        self.batch = batch
+        self.response_sender = response_sender
+        self.is_cancelled = getattr(response_sender, "is_cancelled", None)
+        self.sequences = []
+
+    @property
+    def rows(self):
+        return len(self.batch.sample_index)
+
+    @property
+    def finished(self):
+        return all(s.finished for s in self.sequences)
+
+    def response(self, eos_token_id, final=False):
+        """Returns the prompts followed by the tokens generated so far, and the log probs in the final response."""
+        length = max(len(s.tokens) for s in self.sequences)
+        output_ids = torch.full((len(self.sequences), length), eos_token_id, dtype=self.batch.dtype)
+        for row, sequence in zip(output_ids, self.sequences):
+            row[:len(sequence.tokens)] = torch.tensor(sequence.tokens, dtype=self.batch.dtype)
+        log_probs = None
+        if final and self.batch.want_logprobs[0]:
+            steps = max(s.generated for s in self.sequences)
+            token_logprobs = torch.zeros((len(self.sequences), steps))
+            in_sequence = torch.zeros((len(self.sequences), steps))
+            for row, in_row, sequence in zip(token_logprobs, in_sequence, self.sequences):
+                row[:len(sequence.token_logprobs)] = torch.tensor(sequence.token_logprobs)
+                # Only count the tokens up to the end of the sequence, like sequence_length does
+                ended = sequence.generated > 0 and sequence.tokens[-1] == eos_token_id
+                in_row[:len(sequence.token_logprobs) - ended] = 1
+            log_probs = {"output_log_probs": token_logprobs, "cum_log_probs": (token_logprobs * in_sequence).sum(dim=1)}
+            num_logprobs = self.batch.num_logprobs[0]
+            if num_logprobs > 0:
+                shape = (len(self.sequences), steps, num_logprobs)
+                top_logprobs = torch.zeros(shape)
+                top_logprob_ids = torch.full(shape, eos_token_id, dtype=torch.int32)
+                for i, sequence in enumerate(self.sequences):
+                    if sequence.top_logprobs:
+                        top_logprobs[i, :len(sequence.top_logprobs)] = torch.tensor(sequence.top_logprobs)
+                        top_logprob_ids[i, :len(sequence.top_logprob_ids)] = torch.tensor(sequence.top_logprob_ids)
+                log_probs.update(top_logprobs=top_logprobs, top_logprob_ids=top_logprob_ids)
+        return make_response(output_ids, eos_token_id, log_probs)
+
+
+class ContinuousBatcher:
+    """
+    Generates for all requests at once, one token at a time, letting requests join and leave between any two steps.
+
+    generate() runs a batch of requests until the longest of them is done, while newer requests wait for it. Here,
+    requests are prefilled as soon as the current decoding step is done and join the next one, and every sequence leaves
+    as soon as it is done, so that a long completion doesn't hold up short ones. Every sequence is sampled with its own
+    parameters and stops at its own stop words and length. This needs decoupled mode, as every request gets its
+    responses whenever its tokens are ready: one per step, and a final one with the log probs.
+
+    The keys and values of all sequences are kept in a single cache, left-padded to the longest of them like the
+    prompts of a batch. Up to `max_sequences` sequences are generated at once; further requests wait their turn.
+    """
+
+    def __init__(self, model, prefill, max_sequences):
+        self.model = model
+        self.prefill = prefill
+        self.max_sequences = max_sequences
+        self.eos_token_id = model.config.eos_token_id
+        self.waiting = deque()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.requests = []
+        # The sequence of every row of the cache
+        self.rows = []
+        self.cache = None
+        # Which cached positions of every row hold a token rather than padding
+        self.mask = None
+        # The last token of every row, which isn't in the cache yet
+        self.next_tokens = None
+        # Sampling parameters and number of log probs of every row
+        self.params = None
+        self.steps = 0
+        self.sequence_steps = 0
+        self.cancelled = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, requests):
+        """Queues requests from execute(), which can return right away."""
+        for request in requests:
+            response_sender = request.get_response_sender()
+            try:
+                streaming_request = StreamingRequest(Batch([request], pad_token_id=self.eos_token_id), response_sender)
+            except Exception as exc:
+                response_sender.send(pb_utils.InferenceResponse(error=pb_utils.TritonError(str(exc))),
+                                     flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL)
+                continue
+            with self.condition:
+                self.waiting.append(streaming_request)
+                self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+
+    @torch.no_grad()
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.waiting and not self.rows and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+            try:
+                self.admit()
+                if self.rows:
+                    self.step()
+                self.finish()
+            except Exception as exc:
+                self.fail(exc)
+
+    def admit(self):
+        """Adds the waiting requests that fit to the batch."""
+        admitted = []
+        with self.condition:
+            rows = len(self.rows)
+            # A request with more rows than fit at all still gets its turn, on its own
+            while self.waiting and (rows == 0 or rows + self.waiting[0].rows <= self.max_sequences):
+                admitted.append(self.waiting.popleft())
+                rows += admitted[-1].rows
+        for request in admitted:
+            self.add(request)
+        if admitted:
+            print(f"Continuous batching: {len(admitted)} requests joined, {len(self.rows)} sequences in the batch, "
+                  f"{len(self.waiting)} requests waiting")
+
+    def add(self, request):
+        batch = request.batch
+        device = self.model.device
+        input_ids = batch.input_ids.to(device)[batch.sample_index]
+        attention_mask = batch.attention_mask.to(device)[batch.sample_index]
+        layers = None
+        if batch.prompt_len > 1:
+            # Every prompt is prefilled once, and its samples continue from the same keys and values
+            cache = self.prefill(batch.input_ids.to(device), batch.attention_mask.to(device))
+            cache.batch_select_indices(batch.sample_index.to(device))
+            layers = cache_layers(cache)
+        self.merge(layers, attention_mask[:, :-1])
+
+        num_logprobs = batch.num_logprobs[0] if batch.want_logprobs[0] else -1
+        request.sequences = [
+            Sequence(ids[mask.bool()].tolist(), int(max_new_tokens), stop_words, num_logprobs)
+            for ids, mask, max_new_tokens, stop_words in zip(
+                input_ids, attention_mask, batch.max_new_tokens, batch.stop_words,
+            )
+        ]
+        self.requests.append(request)
+        self.rows += request.sequences
+        params = {
+            "temperature": batch.temperature, "top_k": batch.top_k, "top_p": batch.top_p,
+            "num_logprobs": torch.full((request.rows,), num_logprobs),
+        }
+        if self.params is None:
+            self.next_tokens, self.params = input_ids[:, -1], params
+        else:
+            self.next_tokens = torch.cat([self.next_tokens, input_ids[:, -1]])
+            self.params = {name: torch.cat([self.params[name], values]) for name, values in params.items()}
+
+    def merge(self, layers, mask):
+        """Appends the rows of a cache, and their attention mask, to the batch, left-padding both to the same width."""
+        width = max(mask.shape[1], self.mask.shape[1] if self.mask is not None else 0)
+
+        def pad(tensor, dim):
+            padding = [0, 0] * (tensor.dim() - 1 - dim) + [width - tensor.shape[dim], 0]
+            return torch.nn.functional.pad(tensor, padding)
+
+        if self.cache is not None or layers is not None:
+            old_layers = cache_layers(self.cache) if self.cache is not None else None
+            reference = old_layers or layers
+            merged = []
+            for layer_idx, (ref_keys, ref_values) in enumerate(reference):
+                keys, values = [], []
+                for source, rows in ((old_layers, len(self.rows)), (layers, mask.shape[0])):
+                    if source is not None:
+                        k, v = source[layer_idx]
+                    else:
+                        # Rows whose prompt is a single token have nothing cached yet
+                        k = ref_keys.new_zeros((rows, ref_keys.shape[1], 0, ref_keys.shape[3]))
+                        v = ref_values.new_zeros((rows, ref_values.shape[1], 0, ref_values.shape[3]))
+                    keys.append(pad(k, 2))
+                    values.append(pad(v, 2))
+                merged.append((torch.cat(keys), torch.cat(values)))
+            self.cache = make_cache(merged)
+        self.mask = pad(mask, 1) if self.mask is None else torch.cat([pad(self.mask, 1), pad(mask, 1)])
+
+    def step(self):
+        """Generates the next token of every sequence."""
+        rows = len(self.rows)
+        mask = torch.cat([self.mask, self.mask.new_ones((rows, 1))], dim=1)
+        outputs = self.model(
+            input_ids=self.next_tokens.unsqueeze(1), attention_mask=mask,
+            position_ids=mask.sum(dim=1, keepdim=True) - 1,
+            past_key_values=self.cache if self.cache is not None else DynamicCache(), use_cache=True,
+        )
+        self.cache, self.mask = outputs.past_key_values, mask
+        logits = outputs.logits[:, -1].float()
+        sampling = SamplingLogitsProcessor(self.params["temperature"], self.params["top_k"], self.params["top_p"])
+        tokens = torch.multinomial(sampling(None, logits).softmax(dim=-1), 1).squeeze(1)
+        self.next_tokens = tokens
+
+        num_logprobs = self.params["num_logprobs"]
+        if (num_logprobs >= 0).any():
+            log_probs = logits.log_softmax(dim=-1)
+            token_logprobs = log_probs.gather(1, tokens.unsqueeze(1)).squeeze(1).tolist()
+            top_k = int(num_logprobs.max())
+            if top_k > 0:
+                top = log_probs.topk(top_k, dim=-1)
+                top_logprobs, top_logprob_ids = top.values.tolist(), top.indices.tolist()
+            for i, sequence in enumerate(self.rows):
+                if sequence.num_logprobs >= 0:
+                    sequence.token_logprobs.append(token_logprobs[i])
+                if sequence.num_logprobs > 0:
+                    sequence.top_logprobs.append(top_logprobs[i][:sequence.num_logprobs])
+                    sequence.top_logprob_ids.append(top_logprob_ids[i][:sequence.num_logprobs])
+
+        for sequence, token in zip(self.rows, tokens.tolist()):
+            # Sequences that asked for no tokens at all are done before their first step
+            if not sequence.finished:
+                sequence.push(token, self.eos_token_id)
+        self.steps += 1
+        self.sequence_steps += rows
+
+    def finish(self):
+        """Sends every request the tokens generated in the last step, and lets the sequences that are done go."""
+        for request in list(self.requests):
+            cancelled = request.is_cancelled is not None and not request.finished and request.is_cancelled()
+            if cancelled:
+                self.cancelled += 1
+                for sequence in request.sequences:
+                    sequence.finished = True
+            elif request.finished:
+                request.response_sender.send(request.response(self.eos_token_id, final=True))
+            else:
+                request.response_sender.send(request.response(self.eos_token_id))
+            if request.finished:
+                request.response_sender.send(flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL)
+                self.requests.remove(request)
+
+        keep = [i for i, sequence in enumerate(self.rows) if not sequence.finished]
+        if len(keep) < len(self.rows):
+            self.select(keep)
+
+    def select(self, keep):
+        """Keeps only the rows at the indices `keep`."""
+        self.rows = [self.rows[i] for i in keep]
+        if not self.rows:
+            self.cache = self.mask = self.next_tokens = self.params = None
+            return
+        index = torch.tensor(keep, device=self.mask.device)
+        self.mask = self.mask[index]
+        self.next_tokens = self.next_tokens[index]
+        self.params = {name: values[index.cpu()] for name, values in self.params.items()}
+        if self.cache is not None:
+            self.cache.batch_select_indices(index)
+        # Padding that no row needs anymore, now that the longest rows are gone
+        unused = int((self.mask.sum(dim=0) == 0).long().cumprod(dim=0).sum())
+        if unused:
+            self.mask = self.mask[:, unused:]
+            if self.cache is not None:
+                self.cache = make_cache([(k[:, :, unused:], v[:, :, unused:]) for k, v in cache_layers(self.cache)])
+
+    def fail(self, exc):
+        """Fails every request in the batch, which has to start over afterwards."""
+        print(f"Continuous batching failed: {exc}")
+        for request in self.requests:
+            request.response_sender.send(pb_utils.InferenceResponse(error=pb_utils.TritonError(str(exc))),
+                                         flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL)
+        self.requests = []
+        self.rows = []
+        self.cache = self.mask = self.next_tokens = self.params = None
+
+    def stats(self):
+        return {
+            "sequences": len(self.rows),
+            "waiting": len(self.waiting),
+            "mean_batch_size": self.sequence_steps / self.steps if self.steps else 0.0,
+            "cancelled": self.cancelled,
+        }
 
 
 class TritonPythonModel:
@@ -48,55 +929,238 @@ class TritonPythonModel:
         print(f"Model {model_name} Loaded. Footprint: {self.model.get_memory_footprint()}")
 
         # set max_batch_size
-        self.max_batch_size = 0  # model_config["max_batch_size"]
+        self.max_batch_size = model_config["max_batch_size"]
 
-    def execute(self, requests):
-        # TODO: don't just loop over requests. batch them up
+        # In decoupled mode, every decoding step is sent back as its own response
+        self.decoupled = pb_utils.using_decoupled_model_transaction_policy(model_config)
+        print(f"decoupled: {self.decoupled}")
 
-        responses = []
+        # Requests stopped early because the client didn't want their result anymore
+        self.cancelled_requests = 0
+        self.skipped_steps = 0
 
-        for request in requests:
-            input_ids_torch = pb2torch(request, "input_ids")
-            input_lengths_torch = pb2torch(request, "input_lengths")
-            request_output_len_torch = pb2torch(request, "request_output_len")
-
-            # Attention mask
-            attention_mask = None
-            if input_lengths_torch.min() != input_lengths_torch.max():
-                attention_mask = torch.zeros(input_ids_torch.shape, dtype=torch.long)
-                for i, l in enumerate(input_lengths_torch):
-                    attention_mask[i, :l] = 1
-
-            # Output length
-            max_new_tokens = request_output_len_torch[0][0]
-
-            top_k = pb_utils.get_input_tensor_by_name(request, "runtime_top_k").as_numpy().tolist()[0]
-            top_p = pb_utils.get_input_tensor_by_name(request, "runtime_top_p").as_numpy().tolist()[0]
-            temperature = pb_utils.get_input_tensor_by_name(request, "temperature").as_numpy().tolist()[0]
-            # n_samples = pb_utils.get_input_tensor_by_name(request, "n")
-            n_samples = 1  # TODO: client doesn't send this yet. instead it duplicates the request n times
-
-            # Generate
+        prefix_cache_mb = model_config["parameters"].get("prefix_cache_mb", {"string_value": "0"})["string_value"]
+        prefix_cache_mb = float(prefix_cache_mb)
+        self.prefix_cache = PrefixCache(max_bytes=int(prefix_cache_mb * 2 ** 20))
+        print(f"prefix cache: {prefix_cache_mb} MB")
+
+        global use_dlpack
+        use_dlpack = "use_dlpack" in model_config["parameters"] and get_bool("use_dlpack") and dlpack_works()
+        print(f"use_dlpack: {use_dlpack}")
+
+        # A small model with the same tokenizer, e.g. codegen-350M for codegen-6B, drafts tokens for this one to check
+        draft_model_name = model_config["parameters"].get("draft_model", {"string_value": ""})["string_value"]
+        self.speculative = None
+        if draft_model_name:
+            k = int(model_config["parameters"].get("speculative_tokens", {"string_value": "4"})["string_value"])
+            draft_model = AutoModelForCausalLM.from_pretrained(
+                draft_model_name, torch_dtype=self.model.dtype, low_cpu_mem_usage=True,
+            ).to(self.model.device)
+            self.speculative = SpeculativeDecoder(self.model, draft_model, k)
+            print(f"Draft model {draft_model_name} loaded, drafting {k} tokens at a time")
+            # Shown by Triton's metrics endpoint, next to its own metrics
+            self.draft_token_metrics = None
+            if hasattr(pb_utils, "MetricFamily"):
+                family = pb_utils.MetricFamily(
+                    name="fauxpilot_draft_tokens_total", description="Tokens drafted by the draft model, by outcome",
+                    kind=pb_utils.MetricFamily.COUNTER,
+                )
+                self.draft_token_metrics = {
+                    outcome: family.Metric(labels={"model": model_name, "outcome": outcome})
+                    for outcome in ("proposed", "accepted")
+                }
+
+        # Requests join and leave the batch at every decoding step, rather than waiting for the whole batch to be done
+        self.continuous_batcher = None
+        if "continuous_batching" in model_config["parameters"] and get_bool("continuous_batching"):
+            if not self.decoupled:
+                print("Continuous batching needs decoupled mode, so it is off")
+            else:
+                if self.speculative is not None:
+                    print("Speculative decoding is not used with continuous batching")
+                max_sequences = int(
+                    model_config["parameters"].get("max_active_sequences", {"string_value": "16"})["string_value"]
+                )
+                self.continuous_batcher = ContinuousBatcher(self.model, self.prefill, max_sequences)
+                print(f"Continuous batching of up to {max_sequences} sequences")
+
+    @torch.no_grad()
+    def prefill(self, input_ids, attention_mask, model=None):
+        """
+        Runs the model over all but the last token of the prompts, and returns the resulting KV cache.
+
+        generate() then only has to feed the last token of every prompt. With the prefix cache enabled, every prompt
+        is prefilled on its own, starting from the longest cached prefix. A draft `model` doesn't use the prefix cache.
+        """
+        model = model or self.model
+        if model is not self.model or not self.prefix_cache.enabled:
+            attention_mask = attention_mask[:, :-1]
+            position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+            outputs = model(
+                input_ids=input_ids[:, :-1], attention_mask=attention_mask, position_ids=position_ids,
+                past_key_values=DynamicCache(), use_cache=True,
+            )
+            return outputs.past_key_values
+
+        rows = []
+        for ids, mask in zip(input_ids, attention_mask):
+            prompt = ids[mask.bool()][:-1]
+            prompt_ids = prompt.tolist()
+            reused, layers = self.prefix_cache.lookup(prompt_ids)
+            if reused == len(prompt):
+                rows.append(layers)
+                continue
+            cache = make_cache(layers) if layers is not None else DynamicCache()
+            outputs = self.model(
+                input_ids=prompt[reused:].unsqueeze(0), attention_mask=torch.ones_like(prompt).unsqueeze(0),
+                position_ids=torch.arange(reused, len(prompt), device=prompt.device).unsqueeze(0),
+                past_key_values=cache, use_cache=True,
+            )
+            layers = cache_layers(outputs.past_key_values)
+            self.prefix_cache.prefilled_tokens += len(prompt) - reused
+            self.prefix_cache.store(prompt_ids, layers)
+            rows.append(layers)
+
+        # Left-pad the keys and values of every prompt to the same length, like the prompts themselves
+        width = input_ids.shape[1] - 1
+        reference = next(layers for layers in rows if layers is not None)
+        batch_layers = []
+        for layer_idx, (ref_keys, ref_values) in enumerate(reference):
+            keys, values = [], []
+            for layers in rows:
+                k, v = layers[layer_idx] if layers is not None else (ref_keys[:, :, :0], ref_values[:, :, :0])
+                keys.append(torch.nn.functional.pad(k, (0, 0, width - k.shape[2], 0)))
+                values.append(torch.nn.functional.pad(v, (0, 0, width - v.shape[2], 0)))
+            batch_layers.append((torch.cat(keys), torch.cat(values)))
+
+        stats = self.prefix_cache.stats()
+        print(f"Prefix cache: {stats['entries']} prompts in {stats['bytes'] / 2 ** 20:.1f} MB, "
+              f"hit rate {stats['hit_rate']:.2f}, {stats['reused_token_rate']:.2f} of prompt tokens reused")
+        return make_cache(batch_layers)
+
+    def generate(self, requests, response_senders=None, is_cancelled=None):
+        """
+        Generates the completions of all requests in a single batch.
+
+        Every row is sampled with its own parameters and ends after the number of tokens its request asked for.
+        Returns the output ids of every request, and its log prob tensors if it asked for them.
+        """
+        eos_token_id = self.model.config.eos_token_id
+        batch = Batch(requests, pad_token_id=eos_token_id)
+
+        logits_processor = LogitsProcessorList([
+            SamplingLogitsProcessor(batch.temperature, batch.top_k, batch.top_p),
+            MaxNewTokensLogitsProcessor(batch.prompt_len, batch.max_new_tokens, eos_token_id),
+        ])
+        recorder = None
+        if any(batch.want_logprobs):
+            recorder = LogProbsRecorder(top_k=max(batch.num_logprobs))
+            logits_processor.insert(0, recorder)
+        stopping_criteria = StoppingCriteriaList()
+        if any(batch.stop_words):
+            stopping_criteria.append(StopWordsCriteria(batch.prompt_len, batch.stop_words))
+        cancellation = None
+        if is_cancelled is not None:
+            cancellation = CancellationCriteria(batch, is_cancelled)
+            stopping_criteria.append(cancellation)
+        streamer = None
+        if response_senders is not None:
+            streamer = TritonStreamer(batch, response_senders, eos_token_id)
+
+        input_ids = batch.input_ids.to(self.model.device)
+        attention_mask = batch.attention_mask.to(self.model.device)
+        if self.speculative is not None:
+            output_ids = self.generate_speculatively(batch, input_ids, attention_mask, stopping_criteria, recorder,
+                                                     streamer)
+        else:
+            past_key_values = None
+            if batch.prompt_len > 1 and (self.prefix_cache.enabled or (batch.repeats > 1).any()):
+                # Prefill every prompt once, and let all of its samples continue from the same cache
+                past_key_values = self.prefill(input_ids, attention_mask)
+                past_key_values.batch_select_indices(batch.sample_index.to(self.model.device))
+            input_ids = input_ids[batch.sample_index]
+            attention_mask = attention_mask[batch.sample_index]
+
+            # Generate. Sampling is done by our logits processor, so turn off generate()'s own one
             output_ids = self.model.generate(
-                input_ids=input_ids_torch, attention_mask=attention_mask,
-                max_new_tokens=max_new_tokens, do_sample=True, top_k=top_k, top_p=top_p, num_return_sequences=n_samples,
-                temperature=temperature,
+                input_ids=input_ids, attention_mask=attention_mask, past_key_values=past_key_values,
+                max_new_tokens=int(batch.max_new_tokens.max()), do_sample=True, top_k=0, top_p=1.0, temperature=1.0,
+                pad_token_id=eos_token_id, logits_processor=logits_processor, streamer=streamer,
+                stopping_criteria=stopping_criteria,
             )
 
-            # client wants batch x beam_width x seq_len and we don't support beam_width yet
-            output_ids = output_ids.unsqueeze(1)
+        if cancellation is not None and cancellation.cancelled:
+            self.cancelled_requests += cancellation.cancelled
+            self.skipped_steps += cancellation.skipped_steps
+            print(f"{cancellation.cancelled} of {len(requests)} requests cancelled. Cancelled so far: "
+                  f"{self.cancelled_requests} requests, {self.skipped_steps} decoding steps skipped")
 
-            # create output tensors
-            out_tensor_pb = torch2pb("output_ids", output_ids)
+        log_probs = [None] * len(requests)
+        if recorder is not None:
+            tensors = recorder.finish(output_ids, eos_token_id)
+            split = {name: batch.split_rows(tensor) for name, tensor in tensors.items()}
+            log_probs = [
+                {name: tensors[i] for name, tensors in split.items()} if want else None
+                for i, want in enumerate(batch.want_logprobs)
+            ]
+        return list(zip(batch.split(output_ids), log_probs))
 
-            # calculate sequence_length
-            sequence_length = torch.zeros(output_ids.shape[:2], dtype=torch.int32)
-            for i in range(output_ids.shape[0]):
-                sequence_length[i, 0] = torch.sum(output_ids[i, 0] != self.model.config.eos_token_id).item()
-            sequence_length_pb = torch2pb("sequence_length", sequence_length)
+    def generate_speculatively(self, batch, input_ids, attention_mask, stopping_criteria, recorder, streamer):
+        """Generates with the draft model's help, and returns the output ids of the whole batch."""
+        caches = []
+        for model in (self.model, self.speculative.draft_model):
+            if batch.prompt_len > 1:
+                cache = self.prefill(input_ids, attention_mask, model)
+                cache.batch_select_indices(batch.sample_index.to(self.model.device))
+            else:
+                cache = DynamicCache()
+            caches.append(cache)
 
-            # create response
-            response = pb_utils.InferenceResponse([out_tensor_pb, sequence_length_pb])
-            responses.append(response)
+        proposed, accepted = self.speculative.proposed, self.speculative.accepted
+        output_ids = self.speculative.generate(
+            batch, input_ids[batch.sample_index], attention_mask[batch.sample_index], caches,
+            self.model.config.eos_token_id, stopping_criteria, recorder=recorder, streamer=streamer,
+        )
+        if self.draft_token_metrics is not None:
+            self.draft_token_metrics["proposed"].increment(self.speculative.proposed - proposed)
+            self.draft_token_metrics["accepted"].increment(self.speculative.accepted - accepted)
+        stats = self.speculative.stats()
+        print(f"Speculative decoding: {stats['accept_rate']:.2f} of drafted tokens accepted, "
+              f"{stats['tokens_per_pass']:.2f} tokens per pass of the model")
+        return output_ids
+
+    def execute(self, requests):
+        eos_token_id = self.model.config.eos_token_id
+
+        if self.continuous_batcher is not None:
+            # Responses are sent from the batcher's thread
+            self.continuous_batcher.submit(requests)
+            return None
+
+        if self.decoupled:
+            response_senders = [request.get_response_sender() for request in requests]
+            try:
+                outputs = self.generate(
+                    requests, response_senders=response_senders,
+                    is_cancelled=[getattr(sender, "is_cancelled", None) for sender in response_senders],
+                )
+                # The streamed responses don't know the log prob of the last token yet, so repeat the final one
+                for response_sender, (output_ids, log_probs) in zip(response_senders, outputs):
+                    if log_probs is not None:
+                        response_sender.send(make_response(output_ids, eos_token_id, log_probs))
+            except Exception as exc:
+                # The clients are waiting for the final flag, so errors have to be sent rather than raised
+                for response_sender in response_senders:
+                    response_sender.send(pb_utils.InferenceResponse(error=pb_utils.TritonError(str(exc))))
+            for response_sender in response_senders:
+                response_sender.send(flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL)
+            return None
+
+        outputs = self.generate(
+            requests, is_cancelled=[getattr(request, "is_cancelled", None) for request in requests],
+        )
+        return [make_response(output_ids, eos_token_id, log_probs) for output_ids, log_probs in outputs]
 
-        return responses
+    def finalize(self):
+        if self.continuous_batcher is not None:
+            self.continuous_batcher.stop()
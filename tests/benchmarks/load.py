@@ -0,0 +1,143 @@
+"""
+Replays a trace of completion requests against the proxy and reports their latency, throughput and errors as JSON.
+
+Requests are sent at exponentially distributed intervals, with `--rate` requests per second on average, whether or not
+the previous ones have been answered. This open loop is what editors do, and unlike a fixed number of clients waiting
+on each other, it shows how latency grows once the proxy or the model falls behind.
+
+Every line of the trace is a JSON object with the fields of a completion request. Instead of a `prompt`, it can give
+a `prompt_tokens` count for a prompt of about that length to be made up. The trace is replayed in a loop until
+`--requests` have been sent.
+
+The proxy drops a request once a newer one from the same `user` comes in, and remembers the last suggestion of every
+`user`, or without one of every address. Unless the trace sets it, every request is sent as a different user, or as one
+of `--users` users taking turns.
+
+    python tests/benchmarks/load.py --url http://localhost:5000 --trace tests/benchmarks/traces/editor.jsonl --rate 20
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import httpx
+
+# About 22 tokens of code, repeated to make up prompts of a given length
+PROMPT_LINES = "def add(first, second):\n    \"\"\"Adds two numbers.\"\"\"\n    return first + second\n\n"
+TOKENS_PER_LINES = 22
+
+
+def load_trace(path: Path, model: Optional[str]) -> List[dict]:
+    requests = []
+    for i, line in enumerate(path.read_text().splitlines()):
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        if "prompt" not in request:
+            repeats = max(1, request.pop("prompt_tokens", 100) // TOKENS_PER_LINES)
+            # Numbered, so that the prompts of different trace lines don't share the completion cache
+            request["prompt"] = f"# {i}\n" + PROMPT_LINES * repeats
+        if model is not None:
+            request["model"] = model
+        requests.append(request)
+    if not requests:
+        raise ValueError(f"No requests in {path}")
+    return requests
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summarize(name: str, values: List[float]) -> dict:
+    return {f"{name}_p{p}": percentile(values, p) for p in (50, 95, 99)}
+
+
+async def send(client: httpx.AsyncClient, url: str, request: dict) -> dict:
+    """Sends a request and returns how it went; latencies are in seconds."""
+    start = time.perf_counter()
+    first_event = None
+    try:
+        if request.get("stream"):
+            async with client.stream("POST", url, json=request) as response:
+                async for line in response.aiter_lines():
+                    if first_event is None and line.startswith("data:"):
+                        first_event = time.perf_counter() - start
+                status = response.status_code
+        else:
+            response = await client.post(url, json=request)
+            status = response.status_code
+            if status == 200 and not response.json().get("choices"):
+                # The proxy answers failed Triton requests with an empty completion
+                status = "empty"
+    except httpx.HTTPError as exc:
+        status = type(exc).__name__
+    return {"status": status, "latency": time.perf_counter() - start, "first_event": first_event}
+
+
+async def run(url: str, trace: List[dict], rate: float, requests: int, seed: int, timeout: float,
+              users: int = 0) -> dict:
+    rng = random.Random(seed)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        tasks = []
+        start = time.perf_counter()
+        next_arrival = start
+        for i in range(requests):
+            next_arrival += rng.expovariate(rate)
+            await asyncio.sleep(max(0.0, next_arrival - time.perf_counter()))
+            request = dict(trace[i % len(trace)])
+            request.setdefault("user", f"user-{i % users if users else i}")
+            tasks.append(asyncio.ensure_future(send(client, url, request)))
+        sent = time.perf_counter() - start
+        results = await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    ok = [r for r in results if r["status"] == 200]
+    errors = {}
+    for r in results:
+        if r["status"] != 200:
+            errors[str(r["status"])] = errors.get(str(r["status"]), 0) + 1
+    report = {
+        "requests": len(results),
+        "target_rate": rate,
+        "offered_rate": len(results) / sent if sent else None,
+        "throughput": len(ok) / elapsed,
+        "error_rate": 1 - len(ok) / len(results),
+        "errors": errors,
+        **summarize("latency", [r["latency"] for r in ok]),
+        **summarize("first_event", [r["first_event"] for r in ok if r["first_event"] is not None]),
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--trace", type=Path, default=Path(__file__).parent.joinpath("traces", "editor.jsonl"))
+    parser.add_argument("--rate", type=float, default=10.0, help="Requests per second")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--model", help="Overrides the model of every request in the trace")
+    parser.add_argument("--users", type=int, default=0, help="Number of users sending the requests; 0 for one each")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds after which a request counts as failed")
+    args = parser.parse_args()
+
+    trace = load_trace(args.trace, args.model)
+    report = asyncio.run(run(
+        f"{args.url}/v1/completions", trace, args.rate, args.requests, args.seed, args.timeout, args.users
+    ))
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+A stand-in for Triton that answers the proxy's requests without a GPU, for benchmarking the proxy on its own.
+
+It serves the gRPC API the proxy uses for the `fastertransformer` and `py-model` models, in both the regular and the
+decoupled (streaming) mode. Instead of running a model, it sleeps for a configurable time per prompt token and per
+generated token, and generates the same few lines of code over and over. Like the real backends it stops a sequence at
+its stop words, so requests end with `"stop"` or `"length"` as they would in production.
+
+    python tests/benchmarks/mock_triton.py --port 8001 --token-latency 0.01
+"""
+
+import argparse
+import asyncio
+from typing import Dict, List
+
+import grpc
+import numpy as np
+from tritonclient.grpc import model_config_pb2, service_pb2, service_pb2_grpc
+
+# "    result = compute(value)\n    return result\n\n"
+GENERATED = [50284, 20274, 796, 24061, 7, 8367, 8, 198, 50284, 7783, 1255, 628]
+
+DTYPES = {"INT32": np.int32, "UINT32": np.uint32, "FP32": np.float32, "BOOL": np.bool_}
+
+# The type of the token ids each model returns
+MODELS = {"fastertransformer": "UINT32", "py-model": "INT32"}
+
+
+def input_tensors(request: service_pb2.ModelInferRequest) -> Dict[str, np.ndarray]:
+    return {
+        tensor.name: np.frombuffer(data, dtype=DTYPES[tensor.datatype]).reshape(list(tensor.shape))
+        for tensor, data in zip(request.inputs, request.raw_input_contents)
+    }
+
+
+def stop_sequences(word_list: np.ndarray) -> List[List[int]]:
+    """Decodes one row of a word list, token ids followed by the offsets at which each word ends."""
+    ids, offsets = word_list
+    words = []
+    start = 0
+    for end in offsets:
+        if end < 0:
+            break
+        words.append(ids[start:end].tolist())
+        start = end
+    return words
+
+
+def generated_length(max_tokens: int, stop_words: List[List[int]]) -> int:
+    """Returns how many tokens are generated before a stop word has been, or the maximum has been reached."""
+    tokens = []
+    for i in range(max_tokens):
+        tokens.append(GENERATED[i % len(GENERATED)])
+        if any(w and tokens[-len(w):] == w for w in stop_words):
+            return i + 1
+    return max_tokens
+
+
+class MockTriton(service_pb2_grpc.GRPCInferenceServiceServicer):
+    def __init__(self, token_latency: float, prompt_token_latency: float):
+        self.token_latency = token_latency
+        self.prompt_token_latency = prompt_token_latency
+
+    async def ServerLive(self, request, context):
+        return service_pb2.ServerLiveResponse(live=True)
+
+    async def ServerReady(self, request, context):
+        return service_pb2.ServerReadyResponse(ready=True)
+
+    async def ModelReady(self, request, context):
+        return service_pb2.ModelReadyResponse(ready=request.name in MODELS)
+
+    async def RepositoryIndex(self, request, context):
+        return service_pb2.RepositoryIndexResponse(models=[
+            service_pb2.RepositoryIndexResponse.ModelIndex(name=name, version="1", state="READY") for name in MODELS
+        ])
+
+    async def ModelConfig(self, request, context):
+        if request.name not in MODELS:
+            await context.abort(grpc.StatusCode.NOT_FOUND, f"Request for unknown model: '{request.name}'")
+        # Like python_backend/config_template.pbtxt and converter/config_template.pbtxt
+        max_batch_size = 4 if request.name.startswith("py-") else 1024
+        config = model_config_pb2.ModelConfig(name=request.name, max_batch_size=max_batch_size)
+        config.input.add(name="input_ids", data_type=getattr(model_config_pb2, f"TYPE_{MODELS[request.name]}"))
+        if request.name.startswith("py-"):
+            config.input.add(name="n", data_type=model_config_pb2.TYPE_INT32)
+        config.parameters["max_seq_len"].string_value = "2048"
+        config.parameters["end_id"].string_value = "50256"
+        return service_pb2.ModelConfigResponse(config=config)
+
+    def plan(self, request: service_pb2.ModelInferRequest):
+        """Returns the inputs of a request and the number of tokens to generate for each of its output rows."""
+        inputs = input_tensors(request)
+        max_tokens = inputs["request_output_len"][:, 0].astype(np.int64)
+        stop_words = [stop_sequences(row) for row in inputs["stop_words_list"]]
+        lengths = [generated_length(int(m), s) for m, s in zip(max_tokens, stop_words)]
+        # The python backend samples `n` sequences from every prompt
+        repeats = inputs["n"][:, 0] if "n" in inputs else np.ones(len(lengths), dtype=np.int64)
+        return inputs, np.repeat(lengths, repeats), repeats
+
+    def response(self, request, inputs, lengths, repeats, steps: int) -> service_pb2.ModelInferResponse:
+        """Builds the response holding the first `steps` generated tokens of every row."""
+        id_type = MODELS[request.model_name]
+        prompts = np.repeat(inputs["input_ids"], repeats, axis=0)
+        prompt_lengths = np.repeat(inputs["input_lengths"][:, 0], repeats)
+        end_ids = np.repeat(inputs["end_id"][:, 0], repeats)
+        generated = np.minimum(lengths, steps)
+        output_ids = np.empty((len(lengths), prompts.shape[1] + steps), dtype=DTYPES[id_type])
+        for i, (prompt, prompt_length, length, end_id) in enumerate(zip(prompts, prompt_lengths, generated, end_ids)):
+            row = prompt[:prompt_length].tolist() + [GENERATED[k % len(GENERATED)] for k in range(length)]
+            output_ids[i] = row + [end_id] * (output_ids.shape[1] - len(row))
+
+        outputs = [
+            ("output_ids", output_ids[:, None, :], id_type),
+            ("sequence_length", (prompt_lengths + generated)[:, None], id_type),
+            ("cum_log_probs", -0.5 * generated[:, None], "FP32"),
+            ("output_log_probs", np.full((len(lengths), 1, steps), -0.5), "FP32"),
+        ]
+        top_k = int(inputs["top_k_logprobs"].max()) if "top_k_logprobs" in inputs else 0
+        if top_k > 0:
+            top_ids = np.repeat(output_ids[:, None, prompts.shape[1]:, None], top_k, axis=-1)
+            outputs.append(("top_logprobs", np.full(top_ids.shape, -0.5), "FP32"))
+            outputs.append(("top_logprob_ids", top_ids, "INT32"))
+
+        response = service_pb2.ModelInferResponse(model_name=request.model_name, id=request.id)
+        for name, data, datatype in outputs:
+            response.outputs.add(name=name, datatype=datatype, shape=list(data.shape))
+            response.raw_output_contents.append(np.ascontiguousarray(data, dtype=DTYPES[datatype]).tobytes())
+        return response
+
+    async def ModelInfer(self, request, context):
+        if request.model_name not in MODELS:
+            await context.abort(grpc.StatusCode.UNAVAILABLE, f"Request for unknown model: '{request.model_name}'")
+        inputs, lengths, repeats = self.plan(request)
+        steps = int(lengths.max())
+        await asyncio.sleep(self.prompt_token_latency * inputs["input_ids"].size + self.token_latency * steps)
+        return self.response(request, inputs, lengths, repeats, steps)
+
+    async def ModelStreamInfer(self, request_iterator, context):
+        async for request in request_iterator:
+            if request.model_name not in MODELS:
+                yield service_pb2.ModelStreamInferResponse(
+                    error_message=f"Request for unknown model: '{request.model_name}'"
+                )
+                continue
+            inputs, lengths, repeats = self.plan(request)
+            await asyncio.sleep(self.prompt_token_latency * inputs["input_ids"].size)
+            for step in range(1, int(lengths.max()) + 1):
+                await asyncio.sleep(self.token_latency)
+                response = self.response(request, inputs, lengths, repeats, step)
+                yield service_pb2.ModelStreamInferResponse(infer_response=response)
+
+
+async def serve(host: str, port: int, token_latency: float, prompt_token_latency: float):
+    server = grpc.aio.server()
+    service_pb2_grpc.add_GRPCInferenceServiceServicer_to_server(MockTriton(token_latency, prompt_token_latency), server)
+    server.add_insecure_port(f"{host}:{port}")
+    await server.start()
+    print(f"Mock Triton listening on {host}:{port}", flush=True)
+    await server.wait_for_termination()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--token-latency", type=float, default=0.01, help="Seconds to generate a token")
+    parser.add_argument("--prompt-token-latency", type=float, default=0.00002,
+                        help="Seconds to process a prompt token")
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.token_latency, args.prompt_token_latency))
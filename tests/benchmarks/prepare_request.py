@@ -0,0 +1,47 @@
+"""
+Measures the CPU time the proxy spends turning a tokenized completion request into Triton inputs.
+
+Run from the repository root, with the proxy's requirements installed:
+
+    python tests/benchmarks/prepare_request.py
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.joinpath("copilot_proxy")))
+
+from utils.codegen import CodeGenProxy  # noqa: E402
+
+PROMPT = "import os\n\n" + "def f(x):\n    return x\n\n" * 100
+
+REQUESTS = {
+    "single": {"model": "fastertransformer", "max_tokens": 64, "temperature": 0.1, "stop": ["\n\n"]},
+    "n=10": {"model": "fastertransformer", "max_tokens": 64, "temperature": 0.6, "stop": ["\n\n"], "n": 10},
+    "py-model": {"model": "py-model", "max_tokens": 64, "temperature": 0.1, "stop": ["\n\n", "\ndef "]},
+    "no stop": {"model": "fastertransformer", "max_tokens": 64, "temperature": 0.1},
+}
+
+
+def measure(proxy: CodeGenProxy, data: dict, iterations: int) -> float:
+    data = dict(data, prompt=PROMPT)
+    input_ids = proxy.models.get(data["model"]).tokenizer.encode(PROMPT).ids
+    start = time.process_time()
+    for _ in range(iterations):
+        proxy.infer_inputs(proxy.build_request(data, input_ids))
+    return (time.process_time() - start) / iterations
+
+
+def main(iterations: int):
+    proxy = CodeGenProxy()
+    for name, data in REQUESTS.items():
+        seconds = measure(proxy, data, iterations)
+        print(f"{name:>10}: {seconds * 1e6:8.1f} us per request")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=5000)
+    main(parser.parse_args().iterations)
@@ -0,0 +1,76 @@
+"""
+Benchmarks the proxy against the mock Triton server, on a machine without a GPU.
+
+Starts the mock server and the proxy, replays a trace with `load.py` and prints its JSON report. Environment variables
+configuring the proxy, like `BATCH_WINDOW_MS` or `TRITON_DECOUPLED`, are passed on to it, so that two settings, or two
+commits, can be compared under the same load:
+
+    python tests/benchmarks/run.py --rate 20 --requests 1000 > before.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+benchmarks_dir = Path(__file__).parent
+proxy_dir = benchmarks_dir.parent.parent.joinpath("copilot_proxy")
+
+
+def wait_until_up(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{url} didn't come up within {timeout} s")
+            time.sleep(0.2)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--triton-port", type=int, default=18001)
+    parser.add_argument("--proxy-port", type=int, default=15000)
+    parser.add_argument("--token-latency", type=float, default=0.01, help="Seconds the mock takes to generate a token")
+    args, load_args = parser.parse_known_args()
+
+    mock = subprocess.Popen([
+        sys.executable, str(benchmarks_dir.joinpath("mock_triton.py")),
+        "--port", str(args.triton_port), "--token-latency", str(args.token_latency),
+    ], stdout=subprocess.DEVNULL)
+    # The repository's copy of the tokenizer, rather than the one in the proxy's Docker image
+    env = dict(os.environ, TRITON_HOST="127.0.0.1", TRITON_PORT=str(args.triton_port),
+               TOKENIZER_PATH=str(proxy_dir.joinpath("cgtok", "tokenizer.json").resolve()))
+    proxy = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(args.proxy_port), "--log-level", "warning"],
+        cwd=proxy_dir, env=env, stdout=subprocess.DEVNULL,
+    )
+    try:
+        url = f"http://127.0.0.1:{args.proxy_port}"
+        wait_until_up(f"{url}/metrics")
+        report = subprocess.run(
+            [sys.executable, str(benchmarks_dir.joinpath("load.py")), "--url", url] + load_args,
+            check=True, capture_output=True, text=True,
+        ).stdout
+        result = json.loads(report)
+        prefixes = ("TRITON_", "BATCH_", "COMPLETION_", "REQUEST_", "PROMPT_", "ADMISSION_")
+        result["proxy"] = {k: v for k, v in env.items() if k.startswith(prefixes)}
+        result["token_latency"] = args.token_latency
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    finally:
+        proxy.terminate()
+        mock.terminate()
+        proxy.wait()
+        mock.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+"""
+The proxy is run from inside its own directory (see proxy.Dockerfile), so its modules import each other as top-level
+packages. Make them importable the same way here.
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.joinpath("copilot_proxy")))
@@ -0,0 +1,56 @@
+"""
+Tests for admission control and fair queueing of requests
+"""
+
+import asyncio
+
+import pytest
+
+from utils.admission import AdmissionController, Overloaded
+
+
+def test_users_take_turns():
+    admission = AdmissionController(max_concurrent=1, max_queue_time=10)
+    order = []
+
+    async def request(user):
+        await admission.acquire(user, cost=10)
+        order.append(user)
+        await asyncio.sleep(0.001)
+        admission.release()
+
+    async def run():
+        await admission.acquire("first")
+        # One user floods the queue before another one shows up
+        tasks = [asyncio.ensure_future(request("greedy")) for _ in range(4)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(request("modest")))
+        await asyncio.sleep(0)
+        admission.release()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order.index("modest") <= 1
+    assert admission.stats()["active"] == 0
+    assert admission.stats()["queued"] == 0
+
+
+def test_requests_are_shed_when_the_queue_is_full_or_too_slow():
+    admission = AdmissionController(max_concurrent=1, max_queue=1, max_queue_time=0.05)
+
+    async def run():
+        await admission.acquire("a")
+        waiting = asyncio.ensure_future(admission.acquire("b"))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded):
+            await admission.acquire("c")
+        # The one in the queue gives up after the queue time
+        with pytest.raises(Overloaded) as info:
+            await waiting
+        assert info.value.retry_after >= 1
+
+    asyncio.run(run())
+    stats = admission.stats()
+    assert stats["shed"] == 2
+    assert stats["timed_out"] == 1
+    assert stats["queued"] == 0
@@ -0,0 +1,121 @@
+"""
+Tests for batching concurrent requests into one Triton request
+"""
+
+import asyncio
+from dataclasses import dataclass
+from typing import Dict
+
+import numpy as np
+
+from utils.batching import MicroBatcher, merge_requests
+
+
+@dataclass
+class Request:
+    tensors: Dict[str, np.ndarray]
+
+
+def make_request(ids, stop_ids=(0,)):
+    ids = np.array([ids], dtype=np.uint32)
+    return Request(tensors={
+        "input_ids": ids,
+        "input_lengths": np.array([[ids.shape[1]]], dtype=np.uint32),
+        "end_id": np.array([[50256]], dtype=np.uint32),
+        "stop_words_list": np.array([[list(stop_ids), [len(stop_ids)] + [-1] * (len(stop_ids) - 1)]], dtype=np.int32),
+    })
+
+
+class EchoResult:
+    def __init__(self, request):
+        self.request = request
+
+    def as_numpy(self, name):
+        return self.request.tensors["input_ids"] if name == "output_ids" else None
+
+
+def test_merge_pads_prompts_and_word_lists():
+    merged = merge_requests([make_request([1, 2, 3]), make_request([4], stop_ids=(5, 6))])
+    assert merged.tensors["input_ids"].tolist() == [[1, 2, 3], [4, 50256, 50256]]
+    assert merged.tensors["input_lengths"].tolist() == [[3], [1]]
+    assert merged.tensors["stop_words_list"].tolist() == [[[0, 0], [1, -1]], [[5, 6], [2, -1]]]
+
+
+def test_concurrent_requests_share_a_batch():
+    calls = []
+
+    async def infer(request):
+        calls.append(request.tensors["input_ids"].shape[0])
+        await asyncio.sleep(0.01)
+        return EchoResult(request)
+
+    batcher = MicroBatcher(infer, key=lambda r: None, window=0.01, max_batch_size=4)
+
+    async def main():
+        return await asyncio.gather(*(batcher.submit(make_request([i] * i)) for i in range(1, 6)))
+
+    results = asyncio.run(main())
+    assert calls == [4, 1]
+    assert [r.as_numpy("output_ids")[0, 0] for r in results] == [1, 2, 3, 4, 5]
+    assert batcher.stats()["occupancy"] == 5 / 8
+
+
+def test_batches_fit_the_model():
+    calls = []
+
+    async def infer(request):
+        calls.append(request.tensors["input_ids"].shape[0])
+        return EchoResult(request)
+
+    # The model takes batches of 2, although the proxy would make them bigger
+    batcher = MicroBatcher(infer, key=lambda r: None, window=0.01, max_batch_size=4, model_batch_size=lambda r: 2)
+
+    async def main():
+        return await asyncio.gather(*(batcher.submit(make_request([i])) for i in range(5)))
+
+    asyncio.run(main())
+    assert calls == [2, 2, 1]
+    assert batcher.stats()["occupancy"] == 5 / 6
+
+
+def test_cancelled_request_is_left_out():
+    calls = []
+
+    async def infer(request):
+        calls.append(request.tensors["input_ids"].tolist())
+        return EchoResult(request)
+
+    batcher = MicroBatcher(infer, key=lambda r: None, window=0.01)
+
+    async def main():
+        cancelled = asyncio.ensure_future(batcher.submit(make_request([1])))
+        kept = asyncio.ensure_future(batcher.submit(make_request([2])))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        return await kept
+
+    assert asyncio.run(main()).as_numpy("output_ids").tolist() == [[2]]
+    assert calls == [[[2]]]
+
+
+def test_samples_of_a_prompt_are_split_out_together():
+    class SampledResult:
+        def __init__(self, request):
+            self.rows = np.repeat(request.tensors["input_ids"], request.tensors["n"][:, 0], axis=0)
+
+        def as_numpy(self, name):
+            return self.rows
+
+    async def infer(request):
+        return SampledResult(request)
+
+    batcher = MicroBatcher(infer, key=lambda r: None, window=0.01)
+    requests = [make_request([1]), make_request([2])]
+    for request, n in zip(requests, [3, 1]):
+        request.tensors["n"] = np.array([[n]], dtype=np.uint32)
+
+    async def main():
+        return await asyncio.gather(*(batcher.submit(r) for r in requests))
+
+    results = asyncio.run(main())
+    assert [r.as_numpy("output_ids").tolist() for r in results] == [[[1], [1], [1]], [[2]]]
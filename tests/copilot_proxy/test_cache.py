@@ -0,0 +1,42 @@
+"""
+Tests for the completion cache of the copilot proxy
+"""
+
+import time
+
+from utils.cache import CompletionCache
+
+
+def test_hit_returns_copies():
+    cache = CompletionCache(max_entries=4, ttl=60)
+    cache.put("key", {"usage": {}}, [{"text": "foo"}])
+
+    completion, choices = cache.get("key")
+    completion["id"] = "cmpl-1"
+    choices[0]["text"] = "bar"
+
+    completion, choices = cache.get("key")
+    assert "id" not in completion
+    assert choices[0]["text"] == "foo"
+    assert cache.stats()["hits"] == 2
+
+
+def test_lru_eviction():
+    cache = CompletionCache(max_entries=2, ttl=60)
+    cache.put("a", {}, [])
+    cache.put("b", {}, [])
+    assert cache.get("a") is not None  # "b" is now the least recently used entry
+    cache.put("c", {}, [])
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def test_ttl_expiry():
+    cache = CompletionCache(max_entries=2, ttl=0.01)
+    cache.put("a", {}, [])
+    time.sleep(0.02)
+
+    assert cache.get("a") is None
+    assert cache.stats() == {"entries": 0, "hits": 0, "misses": 1, "hit_rate": 0.0}
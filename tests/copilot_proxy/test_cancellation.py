@@ -0,0 +1,42 @@
+"""
+Tests for cancelling requests nobody waits for anymore
+"""
+
+import asyncio
+
+import pytest
+
+from utils.cancellation import RequestCancelled, RequestTracker
+
+
+def test_newer_request_supersedes_older_one():
+    tracker = RequestTracker(poll_interval=0.01)
+    tracker.record_generation(tokens=10, seconds=1.0)
+
+    async def main():
+        older = asyncio.ensure_future(tracker.run("alice", asyncio.sleep(10, "older"), max_tokens=100))
+        await asyncio.sleep(0.01)
+        newer = await tracker.run("alice", asyncio.sleep(0.01, "newer"), max_tokens=100)
+        with pytest.raises(RequestCancelled):
+            await older
+        return newer
+
+    assert asyncio.run(main()) == "newer"
+    stats = tracker.stats()
+    assert stats["superseded"] == 1
+    assert stats["in_flight_sessions"] == 0
+    assert 9 < stats["saved_generation_seconds"] < 10
+
+
+def test_disconnected_client_cancels_request():
+    tracker = RequestTracker(poll_interval=0.01)
+
+    async def is_disconnected():
+        return True
+
+    async def main():
+        await tracker.run(None, asyncio.sleep(10), max_tokens=16, is_disconnected=is_disconnected)
+
+    with pytest.raises(RequestCancelled):
+        asyncio.run(main())
+    assert tracker.stats()["disconnected"] == 1
@@ -0,0 +1,31 @@
+"""
+Tests for the Prometheus metrics of the proxy
+"""
+
+from utils.metrics import Metrics
+
+
+def test_render_counters_histograms_and_stats():
+    metrics = Metrics()
+    reasons = metrics.counter("finish_reason_total", "Choices by the reason they ended", labels=("reason",))
+    stages = metrics.histogram("stage_seconds", "Time per stage", buckets=(0.01, 0.1), labels=("stage",))
+    metrics.register_stats("cache", lambda: {"hits": 3, "hit_rate": 0.75, "enabled": True, "name": "lru"})
+
+    reasons.inc("stop")
+    reasons.inc("stop")
+    reasons.inc("length")
+    stages.observe(0.005, "tokenize")
+    stages.observe(0.05, "tokenize")
+    stages.observe(1.0, "tokenize")
+
+    lines = metrics.render({"requests_in_flight": 2}).splitlines()
+    assert 'fauxpilot_finish_reason_total{reason="stop"} 2' in lines
+    assert 'fauxpilot_finish_reason_total{reason="length"} 1' in lines
+    assert 'fauxpilot_stage_seconds_bucket{stage="tokenize",le="0.01"} 1' in lines
+    assert 'fauxpilot_stage_seconds_bucket{stage="tokenize",le="0.1"} 2' in lines
+    assert 'fauxpilot_stage_seconds_bucket{stage="tokenize",le="+Inf"} 3' in lines
+    assert 'fauxpilot_stage_seconds_count{stage="tokenize"} 3' in lines
+    assert "fauxpilot_requests_in_flight 2" in lines
+    assert "fauxpilot_cache_hit_rate 0.75" in lines
+    # Only numbers are exported
+    assert not any(line.startswith(("fauxpilot_cache_enabled", "fauxpilot_cache_name")) for line in lines)
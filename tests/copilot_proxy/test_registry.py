@@ -0,0 +1,94 @@
+"""
+Tests for discovering the models served by Triton
+"""
+
+import asyncio
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from utils.registry import DEFAULT_MAX_SEQ_LEN, ModelRegistry, parse_config
+
+proxy_dir = Path(__file__).parent.parent.parent.joinpath("copilot_proxy")
+
+FASTERTRANSFORMER_CONFIG = {
+    "name": "fastertransformer",
+    "max_batch_size": 1024,
+    "input": [{"name": "input_ids", "data_type": "TYPE_UINT32"}, {"name": "end_id", "data_type": "TYPE_UINT32"}],
+    "parameters": {
+        "tokenizer": {"string_value": "Salesforce/codegen-350M-multi"},
+        "max_seq_len": {"string_value": "4096"},
+        "end_id": {"string_value": "50256"},
+    },
+}
+PYTHON_BACKEND_CONFIG = {
+    "name": "py-model",
+    "input": [{"name": "input_ids", "data_type": "TYPE_INT32"}, {"name": "n", "data_type": "TYPE_INT32"}],
+    "parameters": {"org_name": {"string_value": "Salesforce"}, "model_name": {"string_value": "codegen-2B-mono"}},
+}
+
+
+class FakeClient:
+    def __init__(self, configs, unavailable=()):
+        self.configs = configs
+        self.unavailable = unavailable
+
+    async def get_model_repository_index(self, as_json=False):
+        return {"models": [
+            {"name": name, "state": "UNAVAILABLE" if name in self.unavailable else "READY"} for name in self.configs
+        ]}
+
+    async def get_model_config(self, model_name, as_json=False):
+        return {"config": self.configs[model_name]}
+
+
+@pytest.fixture
+def registry():
+    return ModelRegistry(str(proxy_dir.joinpath("cgtok", "tokenizer.json")))
+
+
+def test_parse_config():
+    assert parse_config(FASTERTRANSFORMER_CONFIG) == {
+        "tokenizer_key": "Salesforce/codegen-350M-multi", "max_seq_len": 4096, "end_id": 50256,
+        "id_type": np.uint32, "samples_on_server": False, "max_batch_size": 1024,
+    }
+    assert parse_config(PYTHON_BACKEND_CONFIG) == {
+        "tokenizer_key": "Salesforce/codegen-2B-mono", "id_type": np.int32, "samples_on_server": True,
+    }
+
+
+def test_models_before_and_after_discovery(registry):
+    # Until Triton has been asked, any model goes, with the settings the proxy always assumed
+    assert registry.get("py-anything").id_type == np.int32
+    assert registry.get("py-anything").max_batch_size == 4
+    assert registry.get("fastertransformer").max_seq_len == DEFAULT_MAX_SEQ_LEN
+    assert registry.names() == []
+    assert registry.stats()["models"] == 0
+
+    client = FakeClient({"fastertransformer": FASTERTRANSFORMER_CONFIG, "py-model": PYTHON_BACKEND_CONFIG,
+                         "broken": {}}, unavailable={"broken"})
+    asyncio.run(registry.refresh(client))
+    assert registry.names() == ["fastertransformer", "py-model"]
+    assert registry.get("fastertransformer").max_seq_len == 4096
+    assert registry.get("py-model").samples_on_server
+    # CodeGen models share the default tokenizer
+    assert registry.get("py-model").tokenizer is registry.get("fastertransformer").tokenizer
+    assert registry.stats()["tokenizers"] == 1
+    with pytest.raises(KeyError):
+        registry.get("py-anything")
+
+
+def test_tokenizers_are_loaded_from_paths(registry, tmp_path):
+    custom = tmp_path.joinpath("custom")
+    custom.mkdir()
+    custom.joinpath("tokenizer.json").write_text(proxy_dir.joinpath("cgtok", "tokenizer.json").read_text())
+    client = FakeClient({
+        "custom": dict(FASTERTRANSFORMER_CONFIG, parameters={"tokenizer": {"string_value": str(custom)}}),
+        "missing": dict(FASTERTRANSFORMER_CONFIG, parameters={"tokenizer": {"string_value": str(tmp_path)}}),
+    })
+    asyncio.run(registry.refresh(client))
+    default = registry.get("missing").tokenizer
+    assert registry.get("custom").tokenizer is not default
+    assert registry.get("custom").tokenizer.encode("def f():").ids == default.encode("def f():").ids
+    assert registry.stats()["tokenizers"] == 2
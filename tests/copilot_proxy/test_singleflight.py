@@ -0,0 +1,41 @@
+"""
+Tests for coalescing identical in-flight requests
+"""
+
+import asyncio
+
+from utils.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight()
+    executions = []
+
+    async def work(key):
+        executions.append(key)
+        await asyncio.sleep(0.01)
+        return key * 2
+
+    async def main():
+        return await asyncio.gather(*(flight.do(k, lambda k=k: work(k)) for k in [1, 1, 1, 2]))
+
+    assert asyncio.run(main()) == [2, 2, 2, 4]
+    assert executions == [1, 2]
+    assert flight.stats() == {"in_flight": 0, "calls": 2, "coalesced": 2}
+
+
+def test_cancelled_caller_doesnt_cancel_others():
+    flight = SingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.01)
+        return "done"
+
+    async def main():
+        first = asyncio.ensure_future(flight.do("key", work))
+        second = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main()) == "done"
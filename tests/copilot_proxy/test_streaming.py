@@ -0,0 +1,92 @@
+"""
+Tests for streaming completions token by token
+"""
+
+import asyncio
+from pathlib import Path
+
+import pytest
+from tokenizers import Tokenizer
+
+from utils.streaming import CancellableStream, IncrementalDecoder, StopWordFilter
+
+proxy_dir = Path(__file__).parent.parent.parent.joinpath("copilot_proxy")
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return Tokenizer.from_file(str(proxy_dir.joinpath("cgtok", "tokenizer.json")))
+
+
+def test_decoder_matches_full_decoding(tokenizer):
+    text = "def héllo():\n    return '😀 wörld'\n"
+    ids = tokenizer.encode(text).ids
+    decoder = IncrementalDecoder(tokenizer)
+    deltas = [decoder.push([token_id]) for token_id in ids] + [decoder.flush()]
+    assert "".join(deltas) == tokenizer.decode(ids)
+    # No delta ends in the middle of a multi-byte character
+    assert not any(delta.endswith('�') for delta in deltas)
+
+
+def test_stop_word_split_over_deltas():
+    stop_filter = StopWordFilter(["\ndef ", ""])
+    assert stop_filter.push("return x\n") == "return x"
+    assert stop_filter.push("de") == ""
+    assert stop_filter.push("f g") == ""
+    assert stop_filter.stopped
+    assert stop_filter.push("more") == stop_filter.flush() == ""
+    assert stop_filter.text[:stop_filter.sent] == "return x"
+
+
+def test_held_back_text_is_released():
+    stop_filter = StopWordFilter(["\nclass"])
+    assert stop_filter.push("x = 1\ncl") == "x = 1"
+    assert stop_filter.push("ose()") == "\nclose()"
+    assert stop_filter.push("\n") == ""
+    assert stop_filter.flush() == "\n"
+    assert not stop_filter.stopped
+
+
+async def responses(count, started=None):
+    # Like the async generator tritonclient's stream_infer returns, which has no cancel()
+    for i in range(count):
+        if i == 1 and started is not None:
+            started.set()
+            await asyncio.sleep(10)
+        yield i
+
+
+def test_stream_is_closed():
+    async def main():
+        stream = CancellableStream(responses(3))
+        assert [r async for r in stream] == [0, 1, 2]
+        stream = CancellableStream(responses(3))
+        assert await stream.__anext__() == 0
+        await stream.aclose()
+        with pytest.raises(asyncio.CancelledError):
+            await stream.__anext__()
+
+    asyncio.run(main())
+
+
+def test_stream_is_cancelled_from_another_task():
+    async def main():
+        started = asyncio.Event()
+        stream = CancellableStream(responses(3, started))
+        received = []
+
+        async def consume():
+            try:
+                async for r in stream:
+                    received.append(r)
+            finally:
+                await stream.aclose()
+
+        task = asyncio.ensure_future(consume())
+        await started.wait()
+        stream.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(task, 1)
+        assert received == [0]
+
+    asyncio.run(main())
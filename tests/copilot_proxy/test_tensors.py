@@ -0,0 +1,33 @@
+"""
+Tests for the input tensors shared between requests
+"""
+
+import numpy as np
+
+from utils.tensors import TensorTemplates
+
+
+def build():
+    return {"end_id": np.full((2, 1), 50256, dtype=np.uint32)}
+
+
+def test_shared_tensors_and_inputs_are_reused():
+    templates = TensorTemplates()
+    tensors = templates.get(("constants", 2), build)
+    assert templates.get(("constants", 2), build) is tensors
+    assert not tensors["end_id"].flags.writeable
+    assert templates.make_input("end_id", tensors["end_id"]) is templates.make_input("end_id", tensors["end_id"])
+
+    # Tensors of a single request get an input of their own every time
+    own = np.ones((2, 1), dtype=np.uint32)
+    assert templates.make_input("temperature", own) is not templates.make_input("temperature", own)
+
+
+def test_least_recently_used_tensors_are_dropped():
+    templates = TensorTemplates(max_entries=2)
+    first = templates.get("a", build)
+    templates.get("b", build)
+    templates.get("a", build)
+    templates.get("c", build)
+    assert templates.get("a", build) is first
+    assert list(templates._tensors) == ["c", "a"]
@@ -0,0 +1,43 @@
+"""
+Tests for the incremental prompt tokenizer
+"""
+
+import random
+from pathlib import Path
+
+import pytest
+from tokenizers import Tokenizer
+
+from utils.tokenization import IncrementalTokenizer
+
+proxy_dir = Path(__file__).parent.parent.parent.joinpath("copilot_proxy")
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return Tokenizer.from_file(str(proxy_dir.joinpath("cgtok", "tokenizer.json")))
+
+
+def test_matches_full_tokenization(tokenizer):
+    source = proxy_dir.joinpath("utils", "codegen.py").read_text() + "\n# héllo wörld 😀\n  \n\t\tx = 1\n"
+    # The token budget is made large enough for the prompts drawn from the source file, however long it grows
+    incremental = IncrementalTokenizer(tokenizer, max_tokens=1024 * 1024)
+    rng = random.Random(0)
+
+    for _ in range(200):
+        prompt = source[:rng.randint(0, len(source))]
+        if rng.random() < 0.3:
+            prompt = prompt[:-rng.randint(0, 50)] + rng.choice(["x", "  ", "\n", "é", "\t\t", "😀", " def"])
+        assert incremental.encode(prompt) == tokenizer.encode(prompt).ids
+
+    stats = incremental.stats()
+    assert stats["reuse_rate"] > 0.5
+    assert stats["entries"] == 64
+
+
+def test_memory_is_bounded(tokenizer):
+    incremental = IncrementalTokenizer(tokenizer, max_tokens=100)
+    for i in range(10):
+        incremental.encode(f"def f{i}():\n    return {i}\n" * 5)
+
+    assert incremental.stats()["cached_tokens"] <= 100
@@ -0,0 +1,104 @@
+"""
+Tests for spreading requests over several Triton replicas
+"""
+
+import asyncio
+
+from tritonclient.utils import InferenceServerException
+
+from utils.triton_client import EndpointPool, token_bucket
+
+
+class FakeClient:
+    def __init__(self, name):
+        self.name = name
+        self.ready = True
+
+    async def is_server_ready(self):
+        return self.ready
+
+    async def is_model_ready(self, model):
+        return self.ready
+
+    async def close(self):
+        pass
+
+    def get(self):
+        return self
+
+
+def make_pool(**kwargs):
+    pool = EndpointPool(["a:8001", "b:8001", "c:8001"], health_interval=0, **kwargs)
+    for endpoint in pool.endpoints:
+        endpoint.clients = FakeClient(endpoint.url)
+    return pool
+
+
+def test_least_outstanding_and_affinity():
+    pool = make_pool()
+    first = pool.acquire()
+    second = pool.acquire()
+    third = pool.acquire()
+    assert len({first, second, third}) == 3
+    pool.release(first)
+    assert pool.acquire() is first
+
+    pool = make_pool(affinity=True)
+    chosen = pool.choose("alice")
+    assert all(pool.choose("alice") is chosen for _ in range(3))
+    # The session moves elsewhere while its replica is ejected
+    chosen.healthy = False
+    assert pool.choose("alice") is not chosen
+
+
+def test_unavailable_replica_is_ejected_and_retried_elsewhere():
+    pool = make_pool()
+    down = pool.endpoints[0]
+    down.clients.ready = False
+
+    async def infer(client):
+        if not client.ready:
+            raise InferenceServerException("connection refused", status="StatusCode.UNAVAILABLE")
+        return client.name
+
+    async def run():
+        return [await pool.call(infer, "py-model") for _ in range(4)]
+
+    assert "a:8001" not in asyncio.run(run())
+    assert not down.healthy
+    assert pool.stats()["retried"] == 1
+    assert pool.stats()["outstanding"] == 0
+
+    down.clients.ready = True
+    assert asyncio.run(pool.check(down))
+    assert pool.stats()["readmissions"] == 1
+
+
+def test_slow_requests_are_hedged_on_another_replica():
+    pool = make_pool(hedge_percentile=90, hedge_min_samples=10)
+    slow = pool.endpoints[0]
+    for endpoint in pool.endpoints:
+        for _ in range(10):
+            endpoint.latency[token_bucket(16)].record(0.01)
+    assert 0.01 <= pool.hedge_delay(slow, max_tokens=20) < 0.02
+    # Longer completions are only compared with each other
+    assert pool.hedge_delay(slow, max_tokens=256) is None
+    cancelled = []
+
+    async def infer(client):
+        try:
+            await asyncio.sleep(1 if client is slow.clients else 0.001)
+        except asyncio.CancelledError:
+            cancelled.append(client.name)
+            raise
+        return client.name
+
+    async def run():
+        # The least loaded replica, which is the slow one, is tried first
+        return await pool.call(infer, "py-model", max_tokens=16)
+
+    assert asyncio.run(run()) != slow.url
+    assert cancelled == [slow.url]
+    assert pool.stats()["hedged"] == 1
+    assert pool.stats()["hedges_won"] == 1
+    assert pool.stats()["outstanding"] == 0
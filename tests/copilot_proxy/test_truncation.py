@@ -0,0 +1,62 @@
+"""
+Tests for truncating prompts to the context budget
+"""
+
+import dataclasses
+from pathlib import Path
+
+import pytest
+from tokenizers import Tokenizer
+
+from utils.codegen import CodeGenProxy
+from utils.registry import ModelRegistry
+
+proxy_dir = Path(__file__).parent.parent.parent.joinpath("copilot_proxy")
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return Tokenizer.from_file(str(proxy_dir.joinpath("cgtok", "tokenizer.json")))
+
+
+@pytest.fixture(scope="module")
+def model():
+    return ModelRegistry(str(proxy_dir.joinpath("cgtok", "tokenizer.json"))).get("fastertransformer")
+
+
+def make_proxy(**settings):
+    # Only what truncating needs, without connecting to Triton
+    proxy = CodeGenProxy.__new__(CodeGenProxy)
+    proxy.truncate_prompts = True
+    proxy.max_prompt_tokens = None
+    proxy.truncate_at_lines = True
+    for name, value in settings.items():
+        setattr(proxy, name, value)
+    return proxy
+
+
+def test_prompts_are_cut_at_the_start_of_a_line(tokenizer, model):
+    prompt = "".join(f"value_{i} = compute({i})\n" for i in range(20))
+    ids = tokenizer.encode(prompt).ids
+    proxy = make_proxy(max_prompt_tokens=len(ids) // 2)
+
+    kept, dropped = proxy.truncate_prompt(ids, 16, model)
+    assert dropped + len(kept) == len(ids)
+    assert len(kept) <= len(ids) // 2
+    assert kept == ids[dropped:]
+    text = tokenizer.decode(kept)
+    assert text.startswith("value_") and prompt.endswith(text)
+
+    proxy.truncate_at_lines = False
+    kept, dropped = proxy.truncate_prompt(ids, 16, model)
+    assert len(kept) == len(ids) // 2
+
+
+def test_prompts_that_fit_are_left_alone(tokenizer, model):
+    ids = tokenizer.encode("def f(x):\n    return x\n").ids
+    assert make_proxy().truncate_prompt(ids, 16, model) == (ids, 0)
+    assert make_proxy(truncate_prompts=False, max_prompt_tokens=2).truncate_prompt(ids, 16, model) == (ids, 0)
+    # Cut to fit the model's context with the completion
+    short_model = dataclasses.replace(model, max_seq_len=len(ids) + 4)
+    kept, dropped = make_proxy().truncate_prompt(ids, 8, short_model)
+    assert len(kept) <= len(ids) - 4
@@ -0,0 +1,48 @@
+"""
+Tests for reusing suggestions while they are typed out
+"""
+
+from utils.typeahead import TypeAheadSessions
+
+USAGE = {"prompt_tokens": 3, "completion_tokens": 4}
+CHOICES = [{"text": "(a, b):\n    return a + b", "finish_reason": "stop"}]
+
+
+def count_tokens(text):
+    return len(text.split())
+
+
+def test_returns_rest_of_suggestion():
+    sessions = TypeAheadSessions()
+    sessions.record("alice", "def add", "params", CHOICES, USAGE)
+
+    suggestion = sessions.lookup("alice", "def add(a, b):", "params", 16, count_tokens)
+    assert suggestion.texts == ["\n    return a + b"]
+    assert suggestion.finish_reasons == ["stop"]
+    assert suggestion.prompt_tokens == 3 + 2
+    assert suggestion.completion_tokens == 4
+
+
+def test_misses():
+    sessions = TypeAheadSessions()
+    sessions.record("alice", "def add", "params", CHOICES, USAGE)
+
+    assert sessions.lookup("bob", "def add(a", "params", 16, count_tokens) is None
+    assert sessions.lookup("alice", "def add(a", "other params", 16, count_tokens) is None
+    # Typed something else than suggested
+    assert sessions.lookup("alice", "def add(x", "params", 16, count_tokens) is None
+    # Nothing typed, or everything typed
+    assert sessions.lookup("alice", "def add", "params", 16, count_tokens) is None
+    assert sessions.lookup("alice", "def add" + CHOICES[0]["text"], "params", 16, count_tokens) is None
+    # Rest of the suggestion is longer than requested
+    assert sessions.lookup("alice", "def add(", "params", 2, count_tokens) is None
+    assert sessions.stats()["hits"] == 0
+
+
+def test_sessions_are_bounded():
+    sessions = TypeAheadSessions(max_sessions=1)
+    sessions.record("alice", "def add", "params", CHOICES, USAGE)
+    sessions.record("bob", "def add", "params", CHOICES, USAGE)
+
+    assert sessions.lookup("alice", "def add(", "params", 16, count_tokens) is None
+    assert sessions.lookup("bob", "def add(", "params", 16, count_tokens) is not None
@@ -0,0 +1,43 @@
+"""
+Tests for the token string table
+"""
+
+from pathlib import Path
+
+import pytest
+from tokenizers import Tokenizer
+
+from utils.vocabulary import Vocabulary
+
+proxy_dir = Path(__file__).parent.parent.parent.joinpath("copilot_proxy")
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return Tokenizer.from_file(str(proxy_dir.joinpath("cgtok", "tokenizer.json")))
+
+
+@pytest.fixture(scope="module")
+def vocabulary(tokenizer):
+    return Vocabulary(tokenizer)
+
+
+def test_tokens_match_decoding_them_one_by_one(tokenizer, vocabulary):
+    ids = tokenizer.encode("def hello():\n    return 'world'\t\t# done").ids
+    assert vocabulary.tokens(ids).tolist() == [tokenizer.decode([i]) for i in ids]
+
+
+def test_partial_characters_are_spelled_as_bytes(tokenizer, vocabulary):
+    text = "x = '日本'"
+    ids = tokenizer.encode(text).ids
+    tokens = vocabulary.tokens(ids).tolist()
+    assert any(t.startswith("bytes:\\x") for t in tokens)
+    # Offsets point at the character each token starts, or continues, in the decoded text
+    offsets = vocabulary.text_offsets(ids, start=10).tolist()
+    assert offsets[0] == 10
+    assert offsets == sorted(offsets)
+    assert offsets[-1] == 10 + len(text) - 1
+
+
+def test_ids_beyond_the_vocabulary_are_empty(vocabulary):
+    assert vocabulary.tokens([vocabulary.size + 100]).tolist() == [""]
@@ -0,0 +1,78 @@
+"""
+Helpers for the CPU tests of the python backend, which run it with tiny, randomly initialised models
+"""
+
+import numpy as np
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from triton_python_backend_utils import InferenceRequest
+
+# Token ids of the tiny models; the last one ends a sequence
+VOCAB_SIZE = 32
+EOS = VOCAB_SIZE - 1
+
+
+def tiny_model(seed, layers=2):
+    """
+    Returns a GPT-2 model with a vocabulary of VOCAB_SIZE tokens.
+
+    Its weights are drawn wider than usual, so that its distributions are far from uniform and differ between seeds.
+    """
+    torch.manual_seed(seed)
+    config = GPT2Config(
+        vocab_size=VOCAB_SIZE, n_positions=256, n_embd=32, n_layer=layers, n_head=2, initializer_range=0.3,
+        bos_token_id=EOS, eos_token_id=EOS,
+    )
+    return GPT2LMHeadModel(config).eval()
+
+
+def make_request(prompt, max_tokens, n=1, temperature=1.0, top_k=0, top_p=1.0, logprobs=-1, stop=(),
+                 response_sender=None):
+    """
+    Returns a request for a single prompt, with the inputs the proxy sends to the python backend.
+
+    `top_k=1` is greedy. `stop` holds the stop words as lists of token ids.
+    """
+    stop_ids = [token for word in stop for token in word]
+    offsets = np.cumsum([len(word) for word in stop]).tolist()
+    width = max(len(stop_ids), 1)
+    stop_words_list = [[stop_ids + [0] * (width - len(stop_ids)), offsets + [-1] * (width - len(offsets))]]
+    return InferenceRequest({
+        "input_ids": np.array([prompt], dtype=np.int32),
+        "input_lengths": np.full((1, 1), len(prompt), dtype=np.int32),
+        "request_output_len": np.full((1, 1), max_tokens, dtype=np.int32),
+        "runtime_top_k": np.full((1, 1), top_k, dtype=np.int32),
+        "runtime_top_p": np.full((1, 1), top_p, dtype=np.float32),
+        "temperature": np.full((1, 1), temperature, dtype=np.float32),
+        "is_return_log_probs": np.full((1, 1), logprobs > 0, dtype=np.bool_),
+        "top_k_logprobs": np.full((1, 1), max(logprobs, 0), dtype=np.int32),
+        "n": np.full((1, 1), n, dtype=np.int32),
+        "stop_words_list": np.array(stop_words_list, dtype=np.int32),
+    }, response_sender)
+
+
+def generated(outputs, prompt_len):
+    """Returns the tokens generated for every row of a response, up to the end of its sequence."""
+    return [
+        row[0, prompt_len:length].tolist()
+        for row, length in zip(outputs["output_ids"], outputs["sequence_length"][:, 0])
+    ]
+
+
+def chi_square(counts, probs):
+    """
+    Returns Pearson's chi-square statistic of `counts` drawn from `probs`, and the value it stays below with a
+    probability of 0.999 if they are. Outcomes expected fewer than 5 times are pooled.
+    """
+    expected = probs * counts.sum()
+    rare = expected < 5
+    observed = np.append(counts[~rare], counts[rare].sum())
+    expected = np.append(expected[~rare], expected[rare].sum())
+    if expected[-1] == 0:
+        observed, expected = observed[:-1], expected[:-1]
+    statistic = float(((observed - expected) ** 2 / expected).sum())
+    # Wilson and Hilferty's approximation of the 99.9th percentile of the chi-square distribution
+    df = len(expected) - 1
+    critical = df * (1 - 2 / (9 * df) + 3.09 * (2 / (9 * df)) ** 0.5) ** 3
+    return statistic, critical
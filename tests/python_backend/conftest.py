@@ -0,0 +1,56 @@
+"""
+The CPU tests of the python backend (`test_backend_*.py`) run `python_backend/model.py` with tiny models, and with a
+stand-in for the `triton_python_backend_utils` module Triton provides, so that they need neither Triton nor a GPU.
+"""
+
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+curdir = Path(__file__).parent
+# The stand-in has to win over a real module of that name, and the backend is imported as `model`, as in Triton
+sys.path[:0] = [str(curdir), str(curdir.parent.parent.joinpath("python_backend"))]
+
+try:
+    import torch  # noqa: F401
+    import transformers  # noqa: F401
+except ImportError:
+    # Only the Docker based test_setup.py can run
+    collect_ignore_glob = ["test_backend_*.py"]
+
+
+@pytest.fixture
+def make_backend(monkeypatch):
+    """
+    Returns a function that initializes the backend the way Triton does, with the given model config parameters.
+
+    The model `tiny/target` stands in for the CodeGen model, and `tiny/draft` for a draft model.
+    """
+    import model as backend
+    from backend_testing import tiny_model
+
+    models = {"tiny/target": lambda: tiny_model(0), "tiny/draft": lambda: tiny_model(1, layers=1)}
+    monkeypatch.setattr(backend.AutoModelForCausalLM, "from_pretrained", lambda name, **kwargs: models[name]())
+    monkeypatch.setattr(backend.AutoTokenizer, "from_pretrained", lambda name, **kwargs: None)
+    monkeypatch.setattr(backend, "use_dlpack", False)
+    backends = []
+
+    def make(decoupled=False, **parameters):
+        parameters = dict({
+            "org_name": "tiny", "model_name": "target", "use_half": "0", "use_int8": "0", "use_auto_device_map": "0",
+        }, **parameters)
+        model_config = {
+            "max_batch_size": 4,
+            "parameters": {key: {"string_value": str(value)} for key, value in parameters.items()},
+            "model_transaction_policy": {"decoupled": decoupled},
+        }
+        triton_model = backend.TritonPythonModel()
+        triton_model.initialize({"model_config": json.dumps(model_config)})
+        backends.append(triton_model)
+        return triton_model
+
+    yield make
+    for triton_model in backends:
+        triton_model.finalize()
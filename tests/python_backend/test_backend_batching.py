@@ -0,0 +1,148 @@
+"""
+Tests for batching the requests of one execute() call in the python backend
+"""
+
+import numpy as np
+import torch
+
+import model
+from backend_testing import EOS, VOCAB_SIZE, generated, make_request
+from model import Batch, SamplingLogitsProcessor, make_response
+
+
+def two_row_request(prompts, max_tokens):
+    """A request with a right-padded prompt per row, like FasterTransformer gets them."""
+    request = make_request(prompts[0], max_tokens)
+    width = max(len(p) for p in prompts)
+    for name, tensor in request.inputs.items():
+        request.inputs[name] = np.repeat(tensor, len(prompts), axis=0)
+    request.inputs["input_ids"] = np.array([p + [EOS] * (width - len(p)) for p in prompts], dtype=np.int32)
+    request.inputs["input_lengths"] = np.array([[len(p)] for p in prompts], dtype=np.int32)
+    return request
+
+
+def test_split_round_trips_mixed_length_prompts():
+    prompts = [[1, 2, 3, 4, 5], [6, 7], [8, 9, 10]]
+    batch = Batch([two_row_request(prompts[:2], 4), make_request(prompts[2], 4)], pad_token_id=EOS)
+    # Left-padded, with the mask telling padding from prompt
+    assert batch.input_ids.tolist() == [[1, 2, 3, 4, 5], [EOS, EOS, EOS, 6, 7], [EOS, EOS, 8, 9, 10]]
+    assert batch.attention_mask.tolist() == [[1, 1, 1, 1, 1], [0, 0, 0, 1, 1], [0, 0, 1, 1, 1]]
+    assert batch.rows == [slice(0, 2), slice(2, 3)]
+
+    # Whatever comes after the prompts stays with its row, and the padding moves to the end
+    continuation = torch.arange(3 * 2).view(3, 2) + 11
+    first, second = batch.split(torch.cat([batch.input_ids, continuation], dim=1))
+    assert first.dtype == second.dtype == torch.int32
+    assert first.tolist() == [[1, 2, 3, 4, 5, 11, 12], [6, 7, 13, 14, EOS, EOS, EOS]]
+    assert second.tolist() == [[8, 9, 10, 15, 16]]
+
+
+def test_sampling_parameters_only_apply_to_their_row():
+    torch.manual_seed(0)
+    scores = torch.randn(4, VOCAB_SIZE)
+    sampling = SamplingLogitsProcessor(
+        temperature=torch.tensor([1.0, 2.0, 1.0, 1.0]), top_k=torch.tensor([0, 0, 3, 0]),
+        top_p=torch.tensor([1.0, 1.0, 1.0, 0.5]),
+    )
+    processed = sampling(None, scores.clone())
+    assert torch.equal(processed[0], scores[0])
+    assert torch.allclose(processed[1], scores[1] / 2)
+
+    kept = processed[2].isfinite()
+    assert kept.sum() == 3
+    assert torch.equal(processed[2][kept].sort().values, scores[2].topk(3).values.sort().values)
+
+    # The most likely tokens, until they make up half of the probability
+    kept = processed[3].isfinite()
+    probs = scores[3].softmax(dim=-1)
+    assert probs[kept].min() >= probs[~kept].max()
+    assert probs[kept].sum() >= 0.5
+    assert probs[kept].sum() - probs[kept].min() < 0.5
+
+
+def test_rows_get_the_same_output_alone_and_batched(make_backend):
+    backend = make_backend()
+    greedy = [([1, 2, 3], 12), ([5, 6, 7, 8, 9, 10], 6), ([4], 10)]
+    alone = [backend.execute([make_request(prompt, n, top_k=1)])[0].outputs() for prompt, n in greedy]
+
+    # Among greedy requests of other lengths, and one sampled with its own parameters
+    requests = [make_request(prompt, n, top_k=1) for prompt, n in greedy]
+    requests.insert(1, make_request([7, 7, 7, 7], 16, temperature=2.0, top_p=0.9))
+    batched = [response.outputs() for response in backend.execute(requests)]
+    del batched[1]
+
+    for (prompt, _), a, b in zip(greedy, alone, batched):
+        assert generated(a, len(prompt)) == generated(b, len(prompt))
+        assert np.array_equal(a["sequence_length"], b["sequence_length"])
+        # Rows that end early are padded with the end token
+        assert (b["output_ids"][0, 0, b["sequence_length"][0, 0]:] == EOS).all()
+
+
+def test_rows_stop_at_their_own_token_budget(make_backend):
+    backend = make_backend()
+    prompt = [1, 2, 3]
+    longest = generated(backend.execute([make_request(prompt, 12, top_k=1)])[0].outputs(), len(prompt))[0]
+    assert len(longest) == 12 and EOS not in longest
+
+    responses = backend.execute([make_request(prompt, n, top_k=1) for n in (3, 12, 1)])
+    assert [generated(r.outputs(), len(prompt))[0] for r in responses] == [longest[:3], longest, longest[:1]]
+
+
+def test_samples_of_a_prompt_share_its_row():
+    batch = Batch([make_request([1, 2, 3], 4, n=3), make_request([4, 5], 4)], pad_token_id=EOS)
+    # The prompt is there once, its samples are rows of the output
+    assert batch.input_ids.tolist() == [[1, 2, 3], [EOS, 4, 5]]
+    assert batch.sample_index.tolist() == [0, 0, 0, 1]
+    assert batch.rows == [slice(0, 3), slice(3, 4)]
+    assert batch.padding.tolist() == [0, 0, 0, 1]
+
+
+def test_samples_continue_from_the_same_prompt(make_backend):
+    backend = make_backend()
+    prompt = [5, 6, 7, 8, 9, 10]
+    one = backend.execute([make_request(prompt, 8, top_k=1)])[0].outputs()
+    three, sampled = backend.execute([make_request(prompt, 8, n=3, top_k=1), make_request([1, 2], 8, n=4)])
+    three, sampled = three.outputs(), sampled.outputs()
+    assert generated(three, len(prompt)) == generated(one, len(prompt)) * 3
+    assert sampled["output_ids"].shape[:2] == (4, 1)
+    assert (sampled["output_ids"][:, 0, :2] == [1, 2]).all()
+
+
+def test_stop_words_of_every_row():
+    batch = Batch([make_request([1], 4, stop=[[7, 8], [9]]), make_request([1], 4)], pad_token_id=EOS)
+    assert batch.stop_words == [[[7, 8], [9]], []]
+
+
+def test_rows_stop_at_their_own_stop_words(make_backend):
+    backend = make_backend()
+    prompt = [1, 2, 3]
+    longest = generated(backend.execute([make_request(prompt, 16, top_k=1)])[0].outputs(), len(prompt))[0]
+    assert longest[:4] == [15, 15, 28, 13] and longest[7:9] == [8, 9]
+
+    responses = backend.execute([
+        make_request(prompt, 16, top_k=1, stop=[[28, 13]]),
+        make_request(prompt, 16, top_k=1),
+        # Only the first of the stop words to come up counts, and it has to come up as a whole
+        make_request(prompt, 16, top_k=1, stop=[[9, 9], [8, 9], [28, 9]]),
+    ])
+    # The stop word is part of the sequence; the proxy trims it off the text
+    assert [generated(r.outputs(), len(prompt))[0] for r in responses] == [longest[:4], longest, longest[:9]]
+
+
+def test_sequence_length_counts_the_tokens_before_the_padding():
+    outputs = make_response(torch.tensor([[1, 2, EOS, EOS], [3, 4, 5, 6]], dtype=torch.int32), EOS).outputs()
+    assert outputs["output_ids"].shape == (2, 1, 4)
+    assert outputs["sequence_length"].tolist() == [[2], [4]]
+
+
+def test_dlpack_gives_the_same_outputs(make_backend):
+    requests = [([1, 2, 3], 12), ([4], 10), ([5, 6, 7, 8, 9, 10], 6)]
+    expected = [r.outputs() for r in make_backend().execute([make_request(p, n, top_k=1) for p, n in requests])]
+    assert not model.use_dlpack
+
+    backend = make_backend(use_dlpack=1)
+    assert model.use_dlpack
+    for a, b in zip(expected, backend.execute([make_request(p, n, top_k=1) for p, n in requests])):
+        b = b.outputs()
+        assert a.keys() == b.keys()
+        assert all(np.array_equal(a[name], b[name]) and a[name].dtype == b[name].dtype for name in a)
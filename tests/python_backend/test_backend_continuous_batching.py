@@ -0,0 +1,150 @@
+"""
+Tests for continuous batching in the python backend, where requests join and leave the batch at every decoding step
+"""
+
+import time
+
+import numpy as np
+import pytest
+
+from backend_testing import generated, make_request
+from model import cache_layers
+from triton_python_backend_utils import ResponseSender
+
+
+def make_batcher(make_backend, **parameters):
+    """Returns a continuous batcher whose loop is stopped, so that the test can run it step by step."""
+    batcher = make_backend(decoupled=True, continuous_batching=1, **parameters).continuous_batcher
+    batcher.stop()
+    return batcher
+
+
+def run_steps(batcher, steps):
+    """Does what the batcher's loop does, `steps` times."""
+    for _ in range(steps):
+        batcher.admit()
+        if batcher.rows:
+            batcher.step()
+        batcher.finish()
+
+
+def cached_rows(batcher):
+    keys = cache_layers(batcher.cache)[0][0]
+    return keys.shape[0], keys.shape[2]
+
+
+@pytest.mark.parametrize("parameters", [{}, {"prefix_cache_mb": 1}])
+def test_late_requests_get_the_same_tokens_as_alone(make_backend, parameters):
+    # A longer prompt joining a shorter one mid-decode, and a single token prompt with nothing to prefill
+    arrivals = [
+        (0, [1, 2, 3], dict(max_tokens=12)),
+        (4, [5, 6, 7, 8, 9, 10, 11], dict(max_tokens=6, logprobs=2)),
+        (6, [4], dict(max_tokens=8, n=2, logprobs=1)),
+    ]
+    backend = make_backend(**parameters)
+    alone = [
+        backend.execute([make_request(prompt, top_k=1, **params)])[0].outputs() for _, prompt, params in arrivals
+    ]
+
+    batcher = make_batcher(make_backend, **parameters)
+    requests, steps = [], 0
+    for arrival, prompt, params in arrivals:
+        run_steps(batcher, arrival - steps)
+        steps = arrival
+        requests.append(make_request(prompt, top_k=1, **params))
+        batcher.submit(requests[-1:])
+    run_steps(batcher, 12)
+    assert not batcher.rows and batcher.cache is None
+    assert batcher.stats()["mean_batch_size"] > 1
+
+    for (_, prompt, _), request, expected in zip(arrivals, requests, alone):
+        sender = request.response_sender
+        assert sender.complete.is_set()
+        tokens = generated(expected, len(prompt))
+        # A response per step with the tokens so far, the last one with the log probs
+        for step, response in enumerate(sender.responses):
+            assert generated(response.outputs(), len(prompt)) == [row[:step + 1] for row in tokens]
+        outputs = sender.responses[-1].outputs()
+        assert generated(outputs, len(prompt)) == tokens
+        for name in ("output_log_probs", "top_logprobs", "top_logprob_ids"):
+            if name in expected:
+                assert np.allclose(outputs[name], expected[name][:, :, :outputs[name].shape[2]], atol=1e-5), name
+        if "cum_log_probs" in expected:
+            assert np.allclose(outputs["cum_log_probs"], expected["cum_log_probs"], atol=1e-5)
+        assert set(outputs) == set(expected)
+
+
+def test_finished_and_cancelled_sequences_leave_the_batch(make_backend):
+    batcher = make_batcher(make_backend)
+    done = make_request([1, 2, 3], 3, top_k=1)
+    cancelled = make_request([5, 6, 7, 8, 9, 10], 10, top_k=1, response_sender=ResponseSender(cancel_after=2))
+    last = make_request([4, 5], 10, top_k=1)
+    batcher.submit([done, cancelled, last])
+
+    run_steps(batcher, 2)
+    assert len(batcher.rows) == 3
+    # The cache holds all but the last token of every sequence, left-padded to the longest prompt
+    assert cached_rows(batcher) == (3, 5 + 2) and batcher.mask.shape == (3, 5 + 2)
+
+    run_steps(batcher, 1)
+    # The first request has all its tokens, and the client has gone away after two responses of the second one
+    assert done.response_sender.complete.is_set() and len(done.response_sender.responses) == 3
+    assert cancelled.response_sender.complete.is_set() and len(cancelled.response_sender.responses) == 2
+    assert batcher.stats() == dict(batcher.stats(), sequences=1, cancelled=1)
+    assert [r.response_sender for r in batcher.requests] == [last.response_sender]
+    assert batcher.rows == batcher.requests[0].sequences
+    # With the longest prompt gone, so is the padding it needed
+    assert cached_rows(batcher) == (1, 1 + 3) and batcher.mask.tolist() == [[1] * 4]
+    assert len(batcher.next_tokens) == len(batcher.params["temperature"]) == 1
+
+    run_steps(batcher, 7)
+    assert last.response_sender.complete.is_set() and len(last.response_sender.responses) == 10
+    assert batcher.rows == [] and batcher.requests == []
+    assert batcher.cache is batcher.mask is batcher.next_tokens is batcher.params is None
+
+
+def test_requests_wait_for_room_in_the_batch(make_backend):
+    batcher = make_batcher(make_backend, max_active_sequences=3)
+    first, second = make_request([1, 2], 2, top_k=1, n=2), make_request([3, 4], 4, top_k=1, n=2)
+    batcher.submit([first, second])
+    run_steps(batcher, 1)
+    assert batcher.stats() == dict(batcher.stats(), sequences=2, waiting=1)
+    run_steps(batcher, 2)
+    assert first.response_sender.complete.is_set()
+    assert [r.response_sender for r in batcher.requests] == [second.response_sender]
+
+
+def test_sequences_stop_at_their_own_stop_words_and_lengths(make_backend):
+    prompt = [1, 2, 3]
+    longest = generated(make_backend().execute([make_request(prompt, 16, top_k=1)])[0].outputs(), len(prompt))[0]
+    assert longest[:4] == [15, 15, 28, 13] and longest[7:9] == [8, 9]
+
+    backend = make_backend(decoupled=True, continuous_batching=1)
+    requests = [
+        make_request(prompt, 16, top_k=1, stop=[[28, 13]]),
+        make_request(prompt, 3, top_k=1, n=2),
+        make_request(prompt, 16, top_k=1),
+        make_request(prompt, 16, top_k=1, stop=[[9, 9], [8, 9], [28, 9]]),
+        make_request(prompt, 16, top_k=1, stop=[[8, 9]], n=2),
+    ]
+    # They are handed to the batcher's thread, which joins them to the batch as they come
+    for request in requests:
+        assert backend.execute([request]) is None
+    for request in requests:
+        assert request.response_sender.complete.wait(timeout=60)
+    outputs = [generated(r.response_sender.responses[-1].outputs(), len(prompt)) for r in requests]
+    assert outputs == [[longest[:4]], [longest[:3]] * 2, [longest], [longest[:9]], [longest[:9]] * 2]
+
+
+@pytest.mark.parametrize("busy", [False, True])
+def test_finalize_stops_the_loop(make_backend, busy):
+    backend = make_backend(decoupled=True, continuous_batching=1)
+    batcher = backend.continuous_batcher
+    assert batcher.thread.is_alive()
+    if busy:
+        request = make_request([1, 2, 3], 200)
+        backend.execute([request])
+        while not request.response_sender.responses:
+            time.sleep(0.01)
+    backend.finalize()
+    assert not batcher.thread.is_alive()
@@ -0,0 +1,61 @@
+"""
+Tests for the log probs the python backend returns
+"""
+
+import numpy as np
+import torch
+
+from backend_testing import generated, make_request, tiny_model
+
+
+def expected_log_probs(prompt, tokens, top_k):
+    """The log probs of `tokens` after `prompt` and the `top_k` most likely tokens at every step, from a forward pass
+    over the whole sequence without any padding."""
+    with torch.no_grad():
+        logits = tiny_model(0)(torch.tensor([prompt + tokens])).logits[0]
+    log_probs = logits[len(prompt) - 1:-1].float().log_softmax(dim=-1)
+    top = log_probs.topk(top_k, dim=-1)
+    return log_probs.gather(1, torch.tensor(tokens).view(-1, 1)).view(-1), top.values, top.indices
+
+
+def test_log_probs_match_a_forward_pass(make_backend):
+    torch.manual_seed(0)
+    backend = make_backend()
+    # Prompts of different lengths end up left-padded by different amounts, and the samples of a prompt share its row
+    requests = [
+        ([1, 2, 3], dict(top_k=1)),
+        ([5, 6, 7, 8, 9, 10, 11], dict(temperature=1.5, top_k=5, n=2)),
+        ([4], dict(temperature=0.7, top_p=0.9)),
+    ]
+    responses = backend.execute([make_request(prompt, 10, logprobs=3, **params) for prompt, params in requests])
+    plain = backend.execute([make_request([1, 2], 4)])[0].outputs()
+    assert "output_log_probs" not in plain
+
+    for (prompt, _), response in zip(requests, responses):
+        outputs = response.outputs()
+        assert outputs["output_log_probs"].shape == (len(outputs["output_ids"]), 1, 10)
+        for row, tokens in enumerate(generated(outputs, len(prompt))):
+            assert tokens
+            # The log probs are those of the model itself, before temperature, top-k and top-p
+            token_log_probs, top_values, top_ids = expected_log_probs(prompt, tokens, 3)
+            steps = len(tokens)
+            assert np.allclose(outputs["output_log_probs"][row, 0, :steps], token_log_probs, atol=1e-4)
+            assert np.isclose(outputs["cum_log_probs"][row, 0], token_log_probs.sum(), atol=1e-4)
+            assert np.allclose(outputs["top_logprobs"][row, 0, :steps], top_values, atol=1e-4)
+            assert np.array_equal(outputs["top_logprob_ids"][row, 0, :steps], top_ids)
+
+
+def test_streams_end_with_the_log_probs(make_backend):
+    prompt = [1, 2, 3]
+    expected = make_backend().execute([make_request(prompt, 6, top_k=1, logprobs=2)])[0].outputs()
+    request = make_request(prompt, 6, top_k=1, logprobs=2)
+    make_backend(decoupled=True).execute([request])
+
+    sender = request.response_sender
+    assert sender.complete.is_set()
+    # A response per step, and the last one again with the log probs
+    assert len(sender.responses) == 7
+    assert "output_log_probs" not in sender.responses[0].outputs()
+    final = sender.responses[-1].outputs()
+    assert final.keys() == expected.keys()
+    assert all(np.allclose(final[name], expected[name], atol=1e-5) for name in final)
@@ -0,0 +1,91 @@
+"""
+Tests for reusing the KV cache of recent prompts in the python backend
+"""
+
+import numpy as np
+import torch
+
+from backend_testing import EOS, generated, make_request
+from model import PrefixCache
+
+
+def layers_of(ids):
+    """A stand-in for the keys and values of a prompt, holding its token ids, in a single layer of 8 bytes a token."""
+    keys = torch.tensor(ids, dtype=torch.float32).view(1, 1, -1, 1)
+    return [(keys, keys.clone())]
+
+
+def test_longest_cached_prefix_is_found():
+    cache = PrefixCache(max_bytes=1024, block_size=4)
+    first = list(range(10))
+    assert cache.lookup(first) == (0, None)
+    cache.store(first, layers_of(first))
+
+    # Whole blocks are looked up by their hashes, the rest token by token
+    matched, layers = cache.lookup(first + [20, 21])
+    assert matched == 10
+    assert layers[0][0].view(-1).tolist() == first
+    matched, layers = cache.lookup(first[:6] + [20, 21, 22, 23])
+    assert matched == 6
+    assert layers[0][0].view(-1).tolist() == first[:6]
+    # The first block differs
+    assert cache.lookup([20] + first[1:]) == (0, None)
+
+    assert cache.hits == 2 and cache.misses == 2
+    assert cache.stats()["hit_rate"] == 0.5
+
+
+def test_least_recently_used_prompts_are_evicted():
+    cache = PrefixCache(max_bytes=8 * 25, block_size=4)
+    prompts = [[i] * 10 for i in range(3)]
+    cache.store(prompts[0], layers_of(prompts[0]))
+    cache.store(prompts[1], layers_of(prompts[1]))
+    assert cache.stats()["bytes"] == 8 * 20
+    # Using the first prompt makes the second one the least recently used
+    assert cache.lookup(prompts[0])[0] == 10
+
+    cache.store(prompts[2], layers_of(prompts[2]))
+    assert cache.stats() == dict(cache.stats(), entries=2, bytes=8 * 20)
+    assert cache.lookup(prompts[1])[0] == 0
+    assert cache.lookup(prompts[0])[0] == cache.lookup(prompts[2])[0] == 10
+
+    # A prompt that goes on from a cached one replaces it
+    longer = prompts[2] + [7] * 4
+    cache.store(longer, layers_of(longer))
+    assert cache.stats()["entries"] == 2 and cache.stats()["bytes"] <= cache.max_bytes
+    assert cache.lookup(prompts[2])[0] == 10
+    # Prompts too big for the cache are left out
+    cache.store([5] * 30, layers_of([5] * 30))
+    assert cache.lookup([5] * 30)[0] == 0
+
+
+def test_warm_prompts_give_the_same_output_as_cold_ones(make_backend):
+    torch.manual_seed(0)
+    first = torch.randint(0, EOS, (70,)).tolist()
+    # Shares two blocks of 32 tokens with the first prompt, and not a token more
+    second = first[:64] + [(first[64] + 1) % EOS] + torch.randint(0, EOS, (9,)).tolist()
+    prompts = [first, second, [(first[0] + 1) % EOS] + second[1:40]]
+
+    def run(backend, batches):
+        outputs = []
+        for batch in batches:
+            responses = backend.execute([make_request(prompts[i], 8, top_k=1, logprobs=2) for i in batch])
+            outputs += [response.outputs() for response in responses]
+        return outputs
+
+    batches = [[0], [0], [1], [1, 2]]
+    cold = run(make_backend(), batches)
+    backend = make_backend(prefix_cache_mb=1)
+    warm = run(backend, batches)
+    for i, a, b in zip(sum(batches, []), cold, warm):
+        assert generated(a, len(prompts[i])) == generated(b, len(prompts[i]))
+        for name in ("output_log_probs", "cum_log_probs", "top_logprobs"):
+            assert np.allclose(a[name], b[name], atol=1e-5), name
+
+    cache = backend.prefix_cache
+    # Prompts are cached without their last token. Only the first prompt and the one starting with another block have
+    # nothing to start from
+    assert (cache.hits, cache.misses) == (3, 2)
+    assert cache.reused_tokens == 69 + 64 + 73
+    assert cache.prefilled_tokens == 69 + 9 + 39
+    assert 0 < cache.stats()["bytes"] <= cache.max_bytes
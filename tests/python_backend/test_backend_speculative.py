@@ -0,0 +1,86 @@
+"""
+Tests for speculative decoding with a draft model in the python backend
+"""
+
+import numpy as np
+import torch
+
+from backend_testing import EOS, VOCAB_SIZE, chi_square, make_request, tiny_model
+
+
+def requests():
+    return [
+        make_request([1, 2, 3, 4, 5], 9, top_k=1, logprobs=2),
+        make_request([3, 1], 5, top_k=1, stop=[[15, 28]]),
+        make_request([2], 12, top_k=1, n=2),
+        make_request([6, 5, 4, 3, 2, 1, 0, 1, 2, 3], 16, top_k=1, logprobs=1),
+    ]
+
+
+def test_greedy_output_is_the_same_as_without_a_draft_model(make_backend):
+    expected = [r.outputs() for r in make_backend().execute(requests())]
+    for k in (1, 3):
+        backend = make_backend(draft_model="tiny/draft", speculative_tokens=k)
+        assert backend.speculative is not None and backend.speculative.k == k
+        for a, b in zip(expected, backend.execute(requests())):
+            b = b.outputs()
+            assert a.keys() == b.keys()
+            for name in a:
+                assert a[name].shape == b[name].shape and np.allclose(a[name], b[name], atol=1e-5), (k, name)
+
+
+def sampling_distribution(model, prompt, temperature, top_k):
+    with torch.no_grad():
+        logits = model(torch.tensor([prompt])).logits[0, -1] / temperature
+    if top_k:
+        logits[logits < logits.topk(top_k).values[-1]] = -float("inf")
+    return logits.softmax(dim=-1)
+
+
+def test_samples_follow_the_model_distribution(make_backend):
+    """The first two tokens of many samples, against their joint distribution under the model alone."""
+    torch.manual_seed(0)
+    backend = make_backend(draft_model="tiny/draft", speculative_tokens=3)
+    model = tiny_model(0)
+    prompt = [1, 2, 3]
+    samples = 20000
+    params = [dict(temperature=1.5, top_k=0), dict(temperature=1.0, top_k=4)]
+    responses = backend.execute([make_request(prompt, 2, n=samples, **p) for p in params])
+    # The draft model proposes other tokens than the model would, so the corrections are put to the test too
+    assert 0.2 < backend.speculative.stats()["accept_rate"] < 0.9
+
+    for p, response in zip(params, responses):
+        first = sampling_distribution(model, prompt, **p)
+        joint = torch.zeros(VOCAB_SIZE, VOCAB_SIZE)
+        for token in range(VOCAB_SIZE):
+            if token == EOS:
+                # Finished sequences are padded with the end token
+                joint[token, EOS] = first[token]
+            elif first[token] > 0:
+                joint[token] = first[token] * sampling_distribution(model, prompt + [token], **p)
+        tokens = response.outputs()["output_ids"][:, 0, len(prompt):len(prompt) + 2]
+        counts = np.bincount(tokens[:, 0] * VOCAB_SIZE + tokens[:, 1], minlength=VOCAB_SIZE ** 2)
+        statistic, critical = chi_square(counts, joint.view(-1).double().numpy())
+        assert statistic < critical, p
+        # Tokens top-k rules out never come up
+        assert counts[joint.view(-1).numpy() == 0].sum() == 0
+
+
+def test_accept_rate_is_exported(make_backend):
+    # A draft model that is the model itself has every drafted token accepted
+    backend = make_backend(draft_model="tiny/target", speculative_tokens=3)
+    backend.execute([make_request([1, 2, 3], 8, top_k=1)])
+    assert backend.speculative.stats() == {"accept_rate": 1.0, "tokens_per_pass": 4.0}
+    assert backend.speculative.proposed == backend.speculative.accepted == 6
+
+    backend = make_backend(draft_model="tiny/draft", speculative_tokens=3)
+    torch.manual_seed(0)
+    backend.execute([make_request([1, 2, 3], 16, n=4), make_request([4, 5], 8, top_k=1)])
+    speculative, metrics = backend.speculative, backend.draft_token_metrics
+    assert 0 < speculative.accepted < speculative.proposed
+    assert metrics["proposed"].value() == speculative.proposed
+    assert metrics["accepted"].value() == speculative.accepted
+    assert metrics["accepted"].labels == {"model": "tiny/target", "outcome": "accepted"}
+    stats = speculative.stats()
+    assert stats["accept_rate"] == speculative.accepted / speculative.proposed
+    assert 1 <= stats["tokens_per_pass"] <= 4
@@ -0,0 +1,114 @@
+"""
+A stand-in for the module Triton provides to python backends, with what `python_backend/model.py` uses of it, and
+for the requests and response senders Triton hands to the backend. It lets the backend run in tests without Triton.
+"""
+
+import threading
+
+import torch
+import torch.utils.dlpack
+
+TRITONSERVER_RESPONSE_COMPLETE_FINAL = 1
+
+
+class Tensor:
+    def __init__(self, name, array):
+        self._name = name
+        self._array = array
+
+    def name(self):
+        return self._name
+
+    def as_numpy(self):
+        return self._array
+
+    def to_dlpack(self):
+        return torch.utils.dlpack.to_dlpack(torch.from_numpy(self._array))
+
+    @staticmethod
+    def from_dlpack(name, capsule):
+        return Tensor(name, torch.utils.dlpack.from_dlpack(capsule).numpy())
+
+
+class TritonError(Exception):
+    def message(self):
+        return str(self)
+
+
+class InferenceResponse:
+    def __init__(self, output_tensors=None, error=None):
+        self._output_tensors = output_tensors or []
+        self._error = error
+
+    def output_tensors(self):
+        return self._output_tensors
+
+    def has_error(self):
+        return self._error is not None
+
+    def error(self):
+        return self._error
+
+    def outputs(self):
+        """Returns the output tensors by name, as numpy arrays."""
+        return {tensor.name(): tensor.as_numpy() for tensor in self._output_tensors}
+
+
+class ResponseSender:
+    """Collects the responses to a request in decoupled mode. Once it has `cancel_after` of them, the request counts as
+    cancelled."""
+
+    def __init__(self, cancel_after=None):
+        self.responses = []
+        self.cancel_after = cancel_after
+        self.complete = threading.Event()
+
+    def send(self, response=None, flags=0):
+        if response is not None:
+            self.responses.append(response)
+        if flags & TRITONSERVER_RESPONSE_COMPLETE_FINAL:
+            self.complete.set()
+
+    def is_cancelled(self):
+        return self.cancel_after is not None and len(self.responses) >= self.cancel_after
+
+
+class InferenceRequest:
+    def __init__(self, inputs, response_sender=None):
+        self.inputs = inputs
+        self.response_sender = response_sender or ResponseSender()
+
+    def get_response_sender(self):
+        return self.response_sender
+
+
+class Metric:
+    def __init__(self, labels):
+        self.labels = labels
+        self._value = 0
+
+    def increment(self, value):
+        self._value += value
+
+    def value(self):
+        return self._value
+
+
+class MetricFamily:
+    COUNTER = "counter"
+
+    def __init__(self, name, description, kind):
+        self.name = name
+        self.metrics = []
+
+    def Metric(self, labels):
+        self.metrics.append(Metric(labels))
+        return self.metrics[-1]
+
+
+def get_input_tensor_by_name(request, name):
+    return Tensor(name, request.inputs[name]) if name in request.inputs else None
+
+
+def using_decoupled_model_transaction_policy(model_config):
+    return model_config.get("model_transaction_policy", {}).get("decoupled", False)